@@ -48,6 +48,13 @@
 #define AP_ERR_INVALID_REFRESH_INTERVAL     (-17)
 #define AP_ERR_INVALID_TIMESTAMP            (-18)
 #define AP_ERR_INVALID_MACHINE_NAME         (-19)
+#define AP_ERR_INVALID_BIN_FILE             (-20)
+#define AP_ERR_BIN_FILE_BUSY                (-21)
+
+/*"AEMP", the magic of the memory mapped counter file*/
+#define AP_BIN_MAGIC        (0x504d4541)
+#define AP_BIN_VERSION      (1)
+#define AP_BIN_RETRY_MAX    (100)
 
 
 typedef struct 
@@ -78,12 +85,28 @@ typedef struct
     char            *ap_file;
 } ap_handler;
 
+/*
+ * Layout of the memory mapped counter file written by the extension.
+ * seq is odd while the counters are updated, a consistent copy is one
+ * taken while seq is even and unchanged.
+ */
+typedef struct
+{
+    unsigned int    magic;
+    unsigned int    version;
+    unsigned int    seq;
+    int             len;
+    perf_counter    buf[PERF_COUNT_MAX];
+} ap_bin_file;
+
 ap_handler* ap_open();
 
 extern void ap_close(ap_handler* handler);
 
 extern void ap_refresh(ap_handler* handler);
 
+extern void ap_refresh_bin(ap_handler* handler, const char* bin_file);
+
 extern int ap_metric_all(ap_handler *handler, perf_counter *pc, size_t size);
 
 //config\Cloud Provider
@@ -18,6 +18,11 @@
 #include <stdlib.h> 
 #include <string.h> 
 #include <errno.h>
+#include <fcntl.h>
+#include <sched.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
 #include <azureperf.h> 
 
 #define INTMIN(X, Y) (((X) < (Y)) ? (X) : (Y))
@@ -31,6 +36,7 @@
 
 static char FIELD_SEPRATOR = ';';
 static char DEFAULT_AP_FILE[] = "/var/lib/AzureEnhancedMonitor/PerfCounters";
+static char DEFAULT_AP_BIN_FILE[] = "/var/lib/AzureEnhancedMonitor/PerfCounters.bin";
 
 ap_handler* ap_open()
 {
@@ -315,6 +321,87 @@ EXIT:
     }
 }
 
+void ap_refresh_bin(ap_handler *handler, const char *bin_file)
+{
+    int fd = -1;
+    struct stat st;
+    volatile ap_bin_file *file = MAP_FAILED;
+    unsigned int seq = 0;
+    int len = 0;
+    int retry = 0;
+
+    //Reset handler 
+    memset(handler->buf, 0, sizeof(perf_counter) * PERF_COUNT_MAX);
+    handler->len = 0;
+    handler->err = 0;
+
+    if(0 == bin_file)
+    {
+        bin_file = DEFAULT_AP_BIN_FILE;
+    }
+
+    errno = 0;
+    fd = open(bin_file, O_RDONLY);
+    if(fd < 0)
+    {
+        handler->err = errno;
+        goto EXIT;
+    }
+    if(fstat(fd, &st) != 0)
+    {
+        handler->err = errno;
+        goto EXIT;
+    }
+    if(st.st_size < sizeof(ap_bin_file))
+    {
+        handler->err = AP_ERR_INVALID_BIN_FILE;
+        goto EXIT;
+    }
+    file = mmap(0, sizeof(ap_bin_file), PROT_READ, MAP_SHARED, fd, 0);
+    if(file == MAP_FAILED)
+    {
+        handler->err = errno;
+        goto EXIT;
+    }
+    if(file->magic != AP_BIN_MAGIC || file->version != AP_BIN_VERSION)
+    {
+        handler->err = AP_ERR_INVALID_BIN_FILE;
+        goto EXIT;
+    }
+
+    //Copy the counters until the writer didn't touch them during the copy
+    for(; retry < AP_BIN_RETRY_MAX; retry++)
+    {
+        seq = file->seq;
+        if(seq & 1)
+        {
+            sched_yield();
+            continue;
+        }
+        __sync_synchronize();
+        len = INTMAX(0, INTMIN(file->len, PERF_COUNT_MAX));
+        memcpy(handler->buf, (const void*)file->buf, sizeof(perf_counter) * len);
+        __sync_synchronize();
+        if(seq == file->seq)
+        {
+            handler->len = len;
+            goto EXIT;
+        }
+    }
+    memset(handler->buf, 0, sizeof(perf_counter) * PERF_COUNT_MAX);
+    handler->err = AP_ERR_BIN_FILE_BUSY;
+
+EXIT:
+    if(file != MAP_FAILED)
+    {
+        munmap((void*)file, sizeof(ap_bin_file));
+    }
+    if(fd >= 0)
+    {
+        close(fd);
+    }
+}
+
 int ap_metric_all(ap_handler *handler, perf_counter *all, size_t size)
 {
     int size_to_cp = 0;
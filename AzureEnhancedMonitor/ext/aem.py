@@ -13,9 +13,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import mmap
 import os
 import re
 import socket
+import struct
+import threading
 import traceback
 import time
 import datetime
@@ -30,6 +33,7 @@ FAILED_TO_RETRIEVE_MDS_DATA="(03100)Failed to retrieve mds data"
 FAILED_TO_RETRIEVE_LOCAL_DATA="(03101)Failed to retrieve local data"
 FAILED_TO_RETRIEVE_STORAGE_DATA="(03102)Failed to retrieve storage data"
 FAILED_TO_SERIALIZE_PERF_COUNTERS="(03103)Failed to serialize perf counters"
+FAILED_TO_COLLECT_IN_TIME="(03104)Failed to collect data in time"
 
 def timedelta_total_seconds(delta):
 
@@ -70,7 +74,15 @@ def getLatestErrorRecord():
 
     return "0"
 
+#Set on the threads of CollectorPool, the errors of a collect task are kept on
+#the task and only recorded if it finishes in time.
+collectContext = threading.local()
+
 def updateLatestErrorRecord(s):
+    task = getattr(collectContext, "task", None)
+    if task is not None:
+        task.errorRecords.append(s)
+        return
     errFile = os.path.join(LibDir, LatestErrorRecord)
     maxRetry = 3
     for i in range(0, maxRetry):
@@ -106,8 +118,18 @@ def getMDSTimestamp(unixTimestamp):
     startTimestamp = int(timedelta_total_seconds(unixTime - Epoch))
     return startTimestamp * tickInOneSecond
 
+Hostname = None
+def getHostname():
+    """
+    The host name is looked up once per process
+    """
+    global Hostname
+    if Hostname is None:
+        Hostname = socket.gethostname()
+    return Hostname
+
 def getIdentity():
-    identity = socket.gethostname()
+    identity = getHostname()
     return identity
 
 def getMDSPartitionKey(identity, timestamp):
@@ -136,10 +158,10 @@ def getAzureDiagnosticCPUData(accountName, accountKey, hostBase,
         ofilter = ("PartitionKey ge '{0}' and PartitionKey lt '{1}' "
                    "and DeploymentId eq '{2}'").format(startKey, endKey, deploymentId)
         oselect = ("PercentProcessorTime,DeploymentId")
-        data = tableService.query_entities(table, ofilter, oselect, 1)
-        if data is None or len(data) == 0:
+        data = getFirstEntity(tableService, table, ofilter, oselect)
+        if data is None:
             return None
-        cpuPercent = float(data[0].PercentProcessorTime)
+        cpuPercent = float(data.PercentProcessorTime)
         return cpuPercent
     except Exception as e:
         waagent.Error((u"Failed to retrieve diagnostic data(CPU): {0} {1}"
@@ -160,10 +182,10 @@ def getAzureDiagnosticMemoryData(accountName, accountKey, hostBase,
         ofilter = ("PartitionKey ge '{0}' and PartitionKey lt '{1}' "
                    "and DeploymentId eq '{2}'").format(startKey, endKey, deploymentId)
         oselect = ("PercentAvailableMemory,DeploymentId")
-        data = tableService.query_entities(table, ofilter, oselect, 1)
-        if data is None or len(data) == 0:
+        data = getFirstEntity(tableService, table, ofilter, oselect)
+        if data is None:
             return None
-        memoryPercent = 100 - float(data[0].PercentAvailableMemory)
+        memoryPercent = 100 - float(data.PercentAvailableMemory)
         return memoryPercent
     except Exception as e:
         waagent.Error((u"Failed to retrieve diagnostic data(Memory): {0} {1}"
@@ -178,7 +200,7 @@ class AzureDiagnosticData(object):
         accountName = config.getLADName()
         accountKey = config.getLADKey()
         hostBase = config.getLADHostBase()
-        hostname = socket.gethostname()
+        hostname = getHostname()
         deploymentId = config.getVmDeploymentId()
         startKey, endKey = getAzureDiagnosticKeyRange()
         self.cpuPercent = getAzureDiagnosticCPUData(accountName, 
@@ -282,6 +304,58 @@ class AzureDiagnosticMetric(object):
     def getLastHardwareChange(self):
         return self.linux.getLastHardwareChange()
 
+class FactCache(object):
+    """
+    Facts that only change with the hardware, like the cpu topology, the
+    hypervisor and the lun of the data disks, are computed once and kept until
+    the adapters, the block devices or the online cpus change. The check only
+    reads sysfs, and is done at most once per checkInterval.
+    """
+    def __init__(self, checkInterval=MonitoringInterval / 2):
+        self.checkInterval = checkInterval
+        self.facts = {}
+        self.signature = None
+        self.lastCheck = None
+        self.lock = threading.Lock()
+
+    def getSignature(self):
+        try:
+            nics = sorted(os.listdir("/sys/class/net"))
+            macs = map(lambda x : getMacAddress(x), nics)
+            blockDevs = sorted(os.listdir("/sys/block"))
+        except OSError as e:
+            waagent.Warn("Failed to read hardware from sysfs: {0}".format(e))
+            return None
+        cpus = waagent.GetFileContents("/sys/devices/system/cpu/online")
+        return (nics, macs, blockDevs, cpus)
+
+    def checkHardwareChange(self):
+        now = time.time()
+        if self.lastCheck is not None and 0 <= now - self.lastCheck < self.checkInterval:
+            return
+        self.lastCheck = now
+        signature = self.getSignature()
+        if signature != self.signature:
+            if self.signature is not None:
+                waagent.Log("Hardware change detected, recompute static facts.")
+            self.signature = signature
+            self.facts = {}
+
+    def get(self, name, compute):
+        with self.lock:
+            self.checkHardwareChange()
+            if name not in self.facts:
+                self.facts[name] = compute()
+            return self.facts[name]
+
+    def invalidate(self):
+        with self.lock:
+            self.facts = {}
+            self.signature = None
+            self.lastCheck = None
+
+staticFacts = FactCache()
+
 class CPUInfo(object):
 
     @staticmethod
@@ -290,6 +364,18 @@ class CPUInfo(object):
         ret, lscpu = waagent.RunGetOutput("lscpu")
         return CPUInfo(cpuinfo, lscpu)
 
+    @staticmethod
+    def getCurrentFrequency():
+        """
+        Unlike the rest of CPUInfo the frequency changes, so it is read every
+        cycle from /proc/cpuinfo, which is cheaper than running lscpu again.
+        """
+        cpuinfo = waagent.GetFileContents("/proc/cpuinfo")
+        freqMatch = re.search("cpu MHz\s+:\s+(.*)\s", cpuinfo or "")
+        if freqMatch:
+            return float(freqMatch.group(1))
+        return None
+
     def __init__(self, cpuinfo, lscpu):
         self.cpuinfo = cpuinfo
         self.lscpu = lscpu
@@ -374,11 +460,115 @@ def sameList(l1, l2):
             return False
     return True
 
+NetDevFile = "/proc/net/dev"
+SnmpFile = "/proc/net/snmp"
+NetworkSampleFile = os.path.join(LibDir, "NetworkSample")
+
+def parseNetDev(content):
+    """
+    Returns {adapterId: (bytesRecv, bytesSent)} from the content of /proc/net/dev
+    """
+    nics = {}
+    for line in content.split("\n")[2:]:
+        if ":" not in line:
+            continue
+        nicName, stats = line.split(":", 1)
+        stats = stats.split()
+        if len(stats) < 9:
+            continue
+        nics[nicName.strip()] = (long(stats[0]), long(stats[8]))
+    return nics
+
+class NetworkCounterSampler(object):
+    """
+    Keeps the previous reading of /proc/net/dev, in memory and in LibDir, so
+    that the rates are measured over the whole monitoring interval with a
+    single read per cycle, instead of sleeping between two reads.
+    """
+    def __init__(self, netDevFile=NetDevFile, sampleFile=NetworkSampleFile):
+        self.netDevFile = netDevFile
+        self.sampleFile = sampleFile
+        self.prevTime, self.prevNics = self.loadSample()
+        self.nics = self.prevNics
+        self.rates = {}
+
+    def loadSample(self):
+        if not os.path.isfile(self.sampleFile):
+            return None, {}
+        try:
+            lines = waagent.GetFileContents(self.sampleFile).split("\n")
+            nics = {}
+            for line in lines[1:]:
+                fields = line.split()
+                if len(fields) == 3:
+                    nics[fields[0]] = (long(fields[1]), long(fields[2]))
+            return float(lines[0]), nics
+        except (IOError, ValueError) as e:
+            waagent.Warn("Ignore invalid network sample: {0}".format(e))
+            return None, {}
+
+    def saveSample(self, timestamp, nics):
+        content = str(timestamp)
+        for nicName, (bytesRecv, bytesSent) in nics.iteritems():
+            content = content + "\n{0} {1} {2}".format(nicName, bytesRecv,
+                                                       bytesSent)
+        waagent.SetFileContents(self.sampleFile, content)
+
+    def sample(self):
+        """
+        Reads the counters once. The rates are only updated when at least half
+        a monitoring interval has passed since the previous reading, so that
+        sampling twice in one cycle doesn't measure a tiny window.
+        """
+        now = time.time()
+        self.nics = parseNetDev(waagent.GetFileContents(self.netDevFile))
+        if self.prevTime is not None and now - self.prevTime < MonitoringInterval / 2.0 and now >= self.prevTime:
+            return
+
+        rates = {}
+        #Counters from a sample too old or from before a reboot are not usable
+        if self.prevTime is not None and now > self.prevTime and now - self.prevTime <= 2 * MonitoringInterval:
+            interval = now - self.prevTime
+            for nicName, (bytesRecv, bytesSent) in self.nics.iteritems():
+                prev = self.prevNics.get(nicName)
+                if prev is None or bytesRecv < prev[0] or bytesSent < prev[1]:
+                    continue
+                rates[nicName] = ((bytesRecv - prev[0]) / interval,
+                                  (bytesSent - prev[1]) / interval)
+        self.rates = rates
+        self.prevTime = now
+        self.prevNics = self.nics
+        try:
+            self.saveSample(now, self.nics)
+        except IOError as e:
+            waagent.Warn("Failed to save network sample: {0}".format(e))
+
+    def getAdapterIds(self):
+        return self.nics.keys()
+
+    def getReadBytes(self, adapterId):
+        rate = self.rates.get(adapterId)
+        return rate[0] if rate is not None else None
+
+    def getWriteBytes(self, adapterId):
+        rate = self.rates.get(adapterId)
+        return rate[1] if rate is not None else None
+
+networkCounterSampler = None
+def getNetworkCounterSampler():
+    global networkCounterSampler
+    if networkCounterSampler is None:
+        networkCounterSampler = NetworkCounterSampler()
+    return networkCounterSampler
+
 class NetworkInfo(object):
-    def __init__(self):
-        self.nics = psutil.net_io_counters(pernic=True)
+    def __init__(self, sampler=None):
+        if sampler is None:
+            sampler = getNetworkCounterSampler()
+        self.sampler = sampler
+        self.sampler.sample()
         self.nicNames = []
-        for nicName, stat in self.nics.iteritems():
+        for nicName in sorted(self.sampler.getAdapterIds()):
             if nicName != 'lo':
                 self.nicNames.append(nicName)
 
@@ -386,55 +576,26 @@ class NetworkInfo(object):
         return self.nicNames
 
     def getNetworkReadBytes(self, adapterId):
-        net = psutil.net_io_counters(pernic=True)
-        if net[adapterId] != None:
-            bytes_recv1 = net[adapterId][1]
-            time1 = time.time()
-            
-            time.sleep(0.2)
-            
-            net = psutil.net_io_counters(pernic=True)
-            bytes_recv2 = net[adapterId][1]
-            time2 = time.time()
-            
-            interval = (time2 - time1)
-            
-            return (bytes_recv2 - bytes_recv1) / interval
-        else:
-            return 0
+        return self.sampler.getReadBytes(adapterId)
 
     def getNetworkWriteBytes(self, adapterId):
-        net = psutil.net_io_counters(pernic=True)
-        if net[adapterId] != None:
-            bytes_sent1 = net[adapterId][0]
-            time1 = time.time()
-            
-            time.sleep(0.2)
-            
-            net = psutil.net_io_counters(pernic=True)
-            bytes_sent2 = net[adapterId][0]
-            time2 = time.time()
-            
-            interval = (time2 - time1)
-            
-            return (bytes_sent2 - bytes_sent1) / interval
-        else:
-            return 0
+        return self.sampler.getWriteBytes(adapterId)
 
-    def getNetstat(self):
-        retCode, output = waagent.RunGetOutput("netstat -s", chk_err=False)
-        return output
+    def getSnmp(self):
+        return waagent.GetFileContents(SnmpFile)
 
     def getNetworkPacketRetransmitted(self):
-        netstat = self.getNetstat()
-        match = re.search("(\d+)\s*segments retransmited", netstat)
-        if match != None:
-            return int(match.group(1))
-        else:
-            waagent.Error("Failed to parse netstat output: {0}".format(netstat))
-            updateLatestErrorRecord(FAILED_TO_RETRIEVE_LOCAL_DATA)
-            AddExtensionEvent(message=FAILED_TO_RETRIEVE_LOCAL_DATA)
-            return None
+        snmp = self.getSnmp()
+        tcpLines = filter(lambda l : l.startswith("Tcp:"), 
+                          (snmp or "").split("\n"))
+        if len(tcpLines) >= 2:
+            tcp = dict(zip(tcpLines[0].split()[1:], tcpLines[1].split()[1:]))
+            if "RetransSegs" in tcp:
+                return int(tcp["RetransSegs"])
+        waagent.Error("Failed to parse snmp output: {0}".format(snmp))
+        updateLatestErrorRecord(FAILED_TO_RETRIEVE_LOCAL_DATA)
+        AddExtensionEvent(message=FAILED_TO_RETRIEVE_LOCAL_DATA)
+        return None
 
 
 HwInfoFile = os.path.join(LibDir, "HwInfo")
@@ -474,7 +635,7 @@ class LinuxMetric(object):
     def __init__(self, config):
         self.config = config
         #CPU
-        self.cpuInfo = CPUInfo.getCPUInfo()
+        self.cpuInfo = staticFacts.get("cpuInfo", CPUInfo.getCPUInfo)
         #Memory
         self.memInfo = MemoryInfo()
         #Network
@@ -487,7 +648,10 @@ class LinuxMetric(object):
         return self.timestamp
 
     def getCurrHwFrequency(self):
-        return self.cpuInfo.getFrequency()
+        frequency = CPUInfo.getCurrentFrequency()
+        if frequency is None:
+            frequency = self.cpuInfo.getFrequency()
+        return frequency
 
     def getMaxHwFrequency(self):
         return self.getCurrHwFrequency()
@@ -610,10 +774,10 @@ class VMDataSource(object):
         #Hardware change
         counters.append(self.createCounterLastHardwareChange(metrics))
 
-        #Error
-        counters.append(self.createCounterError())
-
         return counters
+
+    def getCollectTasks(self):
+        return [("vm", self.collect)]
     
     def createCounterLastHardwareChange(self, metrics):
         return PerfCounter(counterType = PerfCounterType.COUNTER_TYPE_LARGE,
@@ -622,12 +786,6 @@ class VMDataSource(object):
                            value = metrics.getLastHardwareChange(),
                            unit="posixtime")
 
-    def createCounterError(self):
-        return PerfCounter(counterType = PerfCounterType.COUNTER_TYPE_LARGE,
-                           category = "config",
-                           name = "Error",
-                           value = getLatestErrorRecord())
-
     def createCounterCurrHwFrequency(self, metrics):
         return PerfCounter(counterType = PerfCounterType.COUNTER_TYPE_DOUBLE,
                            category = "cpu",
@@ -809,17 +967,100 @@ def getStorageTableKeyRange():
     startTime = endTime - MonitoringInterval
     return getStorageTimestamp(startTime), getStorageTimestamp(endTime)
 
+#Page size of the storage metrics queries
+StorageMetricsPageSize = 1000
+
+def getContinuation(entities, name):
+    continuation = getattr(entities, "x_ms_continuation", None)
+    if continuation is None:
+        return None
+    try:
+        return continuation[name]
+    except KeyError:
+        return None
+
+def getFirstEntity(tableService, table, ofilter, oselect):
+    """
+    Returns the first entity matching the filter, or None. A page can come back
+    empty with a continuation when the service stops scanning at a partition
+    boundary or a time limit. The continuation is then followed until an entity
+    is found or the query ends.
+    """
+    nextPartitionKey = None
+    nextRowKey = None
+    while True:
+        entities = tableService.query_entities(table, ofilter, oselect, 1,
+                                               nextPartitionKey, nextRowKey)
+        if entities is None:
+            return None
+        if len(entities) > 0:
+            return entities[0]
+        nextPartitionKey = getContinuation(entities, "NextPartitionKey")
+        nextRowKey = getContinuation(entities, "NextRowKey")
+        if nextPartitionKey is None:
+            return None
+
+class StorageMetricsFetcher(object):
+    """
+    Fetches the minute metrics of one storage account. The TableService, and
+    with it the connection, is kept across cycles, the continuation pages are
+    followed, and the last PartitionKey ingested is remembered so that a
+    minute is only fetched once.
+    """
+    def __init__(self, account, key, hostBase, table):
+        self.table = table
+        self.tableService = TableService(account_name = account, 
+                                         account_key = key,
+                                         host_base = hostBase)
+        self.lastPartitionKey = None
+        self.lastKeyRange = None
+        self.lastMetrics = None
+
+    def fetch(self, startKey, endKey):
+        if self.lastKeyRange == (startKey, endKey):
+            return self.lastMetrics
+
+        if self.lastPartitionKey is not None and self.lastPartitionKey >= startKey:
+            ofilter = ("PartitionKey gt '{0}' and PartitionKey lt '{1}'"
+                       "").format(self.lastPartitionKey, endKey)
+        else:
+            ofilter = ("PartitionKey ge '{0}' and PartitionKey lt '{1}'"
+                       "").format(startKey, endKey)
+        oselect = ("TotalRequests,TotalIngress,TotalEgress,AverageE2ELatency,"
+                   "AverageServerLatency,PartitionKey,RowKey")
+        metrics = []
+        nextPartitionKey = None
+        nextRowKey = None
+        while True:
+            entities = self.tableService.query_entities(self.table, 
+                                                        ofilter, 
+                                                        oselect,
+                                                        StorageMetricsPageSize,
+                                                        nextPartitionKey,
+                                                        nextRowKey)
+            metrics.extend(entities)
+            nextPartitionKey = getContinuation(entities, "NextPartitionKey")
+            nextRowKey = getContinuation(entities, "NextRowKey")
+            if nextPartitionKey is None:
+                break
+
+        for metric in metrics:
+            if self.lastPartitionKey is None or metric.PartitionKey > self.lastPartitionKey:
+                self.lastPartitionKey = metric.PartitionKey
+        self.lastKeyRange = (startKey, endKey)
+        self.lastMetrics = metrics
+        return metrics
+
+storageMetricsFetchers = {}
+
 def getStorageMetrics(account, key, hostBase, table, startKey, endKey):
     try:
         waagent.Log("Retrieve storage metrics data.")
-        tableService = TableService(account_name = account, 
-                                    account_key = key,
-                                    host_base = hostBase)
-        ofilter = ("PartitionKey ge '{0}' and PartitionKey lt '{1}'"
-                   "").format(startKey, endKey)
-        oselect = ("TotalRequests,TotalIngress,TotalEgress,AverageE2ELatency,"
-                   "AverageServerLatency,RowKey")
-        metrics = tableService.query_entities(table, ofilter, oselect)
+        fetcher = storageMetricsFetchers.get(account)
+        if fetcher is None or fetcher.table != table:
+            fetcher = StorageMetricsFetcher(account, key, hostBase, table)
+            storageMetricsFetchers[account] = fetcher
+        metrics = fetcher.fetch(startKey, endKey)
         waagent.Log("{0} records returned.".format(len(metrics)))
         return metrics
     except Exception as e:
@@ -839,6 +1080,16 @@ def getFirstLun(dev):
     for lun in os.listdir(path):
         return int(lun[-1])
 
+def getLunToDevMap():
+    lunToDevMap = {}
+    dataDisks = getDataDisks()
+    if dataDisks is None:
+        return lunToDevMap
+    for dev in dataDisks:
+        lun = getFirstLun(dev)
+        lunToDevMap[lun] = dev
+    return lunToDevMap
+
 class DiskInfo(object):
     def __init__(self, config):
         self.config = config
@@ -858,14 +1109,9 @@ class DiskInfo(object):
                 "/dev/sda": osdisk,
         }
 
-        dataDisks = getDataDisks()
-        if dataDisks is None or len(dataDisks) == 0:
+        lunToDevMap = staticFacts.get("lunToDevMap", getLunToDevMap)
+        if len(lunToDevMap) == 0:
             return diskMapping
-        
-        lunToDevMap = {}
-        for dev in dataDisks:
-            lun = getFirstLun(dev)
-            lunToDevMap[lun] = dev
 
         diskCount = self.config.getDataDiskCount()
         for i in range(0, diskCount):
@@ -905,37 +1151,49 @@ def isUserWrite(op):
             return True
     return False
 
-def storageStat(metrics, opFilter):
-    stat = {}
-    stat['bytes'] = None
-    stat['ops'] = None
-    stat['e2eLatency'] = None
-    stat['serverLatency'] = None
-    stat['throughput'] = None
+def storageStats(metrics, opFilters):
+    """
+    Aggregates the metrics of every opFilter in a single pass.
+    """
+    stats = []
+    for opFilter in opFilters:
+        stat = {}
+        stat['bytes'] = None
+        stat['ops'] = None
+        stat['e2eLatency'] = None
+        stat['serverLatency'] = None
+        stat['throughput'] = None
+        stats.append(stat)
     if metrics is None:
-        return stat
-
-    metrics = filter(lambda x : opFilter(x.RowKey), metrics)
-    stat['bytes'] = sum(map(lambda x : x.TotalIngress + x.TotalEgress, 
-                            metrics))
-    stat['ops'] = sum(map(lambda x : x.TotalRequests, metrics))
-    if stat['ops'] != 0:
-        stat['e2eLatency'] = sum(map(lambda x : x.TotalRequests * \
-                                                x.AverageE2ELatency, 
-                                     metrics)) / stat['ops']
-        stat['serverLatency'] = sum(map(lambda x : x.TotalRequests * \
-                                                   x.AverageServerLatency, 
-                                        metrics)) / stat['ops']
-    #Convert to MB/s
-    stat['throughput'] = float(stat['bytes']) / (1024 * 1024) / 60 
-    return stat
+        return stats
+
+    sums = [[0, 0, 0, 0] for opFilter in opFilters]
+    for x in metrics:
+        for i, opFilter in enumerate(opFilters):
+            if opFilter(x.RowKey):
+                sums[i][0] += x.TotalIngress + x.TotalEgress
+                sums[i][1] += x.TotalRequests
+                sums[i][2] += x.TotalRequests * x.AverageE2ELatency
+                sums[i][3] += x.TotalRequests * x.AverageServerLatency
+
+    for stat, (totalBytes, ops, e2eLatency, serverLatency) in zip(stats, sums):
+        stat['bytes'] = totalBytes
+        stat['ops'] = ops
+        if ops != 0:
+            stat['e2eLatency'] = e2eLatency / ops
+            stat['serverLatency'] = serverLatency / ops
+        #Convert to MB/s
+        stat['throughput'] = float(totalBytes) / (1024 * 1024) / 60 
+    return stats
+
+def storageStat(metrics, opFilter):
+    return storageStats(metrics, [opFilter])[0]
 
 class AzureStorageStat(object):
 
     def __init__(self, metrics):
         self.metrics = metrics
-        self.rStat = storageStat(metrics, isUserRead)
-        self.wStat = storageStat(metrics, isUserWrite)
+        self.rStat, self.wStat = storageStats(metrics, [isUserRead, isUserWrite])
 
     def getReadBytes(self):
         return self.rStat['bytes']
@@ -974,6 +1232,26 @@ class StorageDataSource(object):
 
     def collect(self):
         counters = []
+        for name, collect in self.getCollectTasks():
+            counters.extend(collect())
+        return counters
+
+    def getCollectTasks(self):
+        """
+        Every standard storage account is queried by its own task, so that a
+        slow account doesn't hold back the others.
+        """
+        tasks = [("disk", self.collectDiskMapping)]
+        accounts = self.config.getStorageAccountNames()
+        for account in accounts:
+            if self.config.getStorageAccountType(account) == "Standard":
+                collect = lambda account=account : \
+                        self.collectMetrixForStandardStorage(account)
+                tasks.append(("storage.{0}".format(account), collect))
+        return tasks
+
+    def collectDiskMapping(self):
+        counters = []
 
         #Add disk mapping for resource disk
         counters.append(self.createCounterDiskMapping("/dev/sdb", 
@@ -987,11 +1265,6 @@ class StorageDataSource(object):
             if disk.get("type") == "Premium":
                 counters.append(self.createCounterDiskIOPS(dev, disk.get("iops")))
                 counters.append(self.createCounterDiskThroughput(dev, disk.get("throughput")))
-
-        accounts = self.config.getStorageAccountNames()
-        for account in accounts:
-            if self.config.getStorageAccountType(account) == "Standard":
-                counters.extend(self.collectMetrixForStandardStorage(account))
         return counters
 
     def collectMetrixForStandardStorage(self, account):
@@ -1179,7 +1452,7 @@ class StaticDataSource(object):
 
     def collect(self):
         counters = []
-        hvInfo = HvInfo()
+        hvInfo = staticFacts.get("hvInfo", HvInfo)
         counters.append(self.createCounterCloudProvider())
         counters.append(self.createCounterCpuOverCommitted())
         counters.append(self.createCounterMemoryOverCommitted())
@@ -1196,6 +1469,9 @@ class StaticDataSource(object):
             counters.append(self.createCounterVMSLAIOPS(vmSLAIOPS))
 
         return counters
+
+    def getCollectTasks(self):
+        return [("static", self.collect)]
     
     def createCounterVMSLAThroughput(self, throughput):
         return PerfCounter(counterType = PerfCounterType.COUNTER_TYPE_INT,
@@ -1290,7 +1566,7 @@ class PerfCounter(object):
             self.timestamp = timestamp
         else:
             self.timestamp = int(time.time())
-        self.machine = socket.gethostname()
+        self.machine = getHostname()
 
     def __str__(self):
         return (u"{0};{1};{2};{3};{4};{5};{6};{7};{8};{9};\n"
@@ -1307,20 +1583,121 @@ class PerfCounter(object):
 
     __repr__ = __str__
 
+def createCounterError():
+    return PerfCounter(counterType = PerfCounterType.COUNTER_TYPE_LARGE,
+                       category = "config",
+                       name = "Error",
+                       value = getLatestErrorRecord())
+
+#Leave enough of the interval to write the counters
+CollectTimeout = MonitoringInterval / 2
+MaxCollectThreads = 4
+
+class CollectTask(object):
+    def __init__(self, name, collect):
+        self.name = name
+        self.collect = collect
+        self.counters = None
+        self.error = None
+        self.errorRecords = []
+        self.done = threading.Event()
+
+class CollectorPool(object):
+    """
+    Runs the collect tasks of the data sources concurrently, at most maxThreads
+    at a time, and waits for them until timeout. A task that misses the
+    deadline or fails is reported with the counters of its last successful run,
+    which may have finished after an earlier deadline, and the error record is
+    set. The error records of a task that misses the deadline are dropped, so
+    they don't show up in the next cycle. A task that is still running from an
+    earlier cycle is not started again.
+    """
+    def __init__(self, maxThreads=MaxCollectThreads, timeout=CollectTimeout):
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(maxThreads)
+        self.runningTasks = {}
+        self.lastCounters = {}
+        self.lastCountersLock = threading.Lock()
+
+    def _run(self, task):
+        with self.slots:
+            collectContext.task = task
+            try:
+                task.counters = task.collect()
+                with self.lastCountersLock:
+                    self.lastCounters[task.name] = task.counters
+            except Exception as e:
+                task.error = e
+                waagent.Error(u"Failed to collect {0}: {1} {2}".format(task.name, 
+                                                                       e, 
+                                                                       traceback.format_exc()))
+            finally:
+                collectContext.task = None
+                task.done.set()
+
+    def run(self, collectTasks):
+        deadline = time.time() + self.timeout
+        tasks = []
+        for name, collect in collectTasks:
+            task = self.runningTasks.get(name)
+            if task is None or task.done.is_set():
+                task = CollectTask(name, collect)
+                self.runningTasks[name] = task
+                thread = threading.Thread(target=self._run, args=(task,))
+                thread.daemon = True
+                thread.start()
+            else:
+                waagent.Warn("Collecting {0} is still running.".format(name))
+            tasks.append(task)
+
+        counters = []
+        for task in tasks:
+            done = task.done.wait(max(0, deadline - time.time()))
+            if done:
+                for errorRecord in task.errorRecords:
+                    updateLatestErrorRecord(errorRecord)
+            if done and task.error is None:
+                counters.extend(task.counters)
+                continue
+            if not done:
+                waagent.Error("Collecting {0} timed out.".format(task.name))
+                updateLatestErrorRecord(FAILED_TO_COLLECT_IN_TIME)
+                AddExtensionEvent(message=FAILED_TO_COLLECT_IN_TIME)
+            elif task.name.startswith("storage."):
+                updateLatestErrorRecord(FAILED_TO_RETRIEVE_STORAGE_DATA)
+            else:
+                updateLatestErrorRecord(FAILED_TO_RETRIEVE_LOCAL_DATA)
+            #Stale values, the error counter tells they are not current
+            with self.lastCountersLock:
+                counters.extend(self.lastCounters.get(task.name, []))
+        return counters
+
 class EnhancedMonitor(object):
     def __init__(self, config):
         self.dataSources = []
         self.dataSources.append(VMDataSource(config))
         self.dataSources.append(StorageDataSource(config))
         self.dataSources.append(StaticDataSource(config))
+        self.collectorPool = CollectorPool()
         self.writer = PerfCounterWriter()
+        self.binaryWriter = None
+        if config.isBinaryCounterFileEnabled():
+            self.binaryWriter = PerfCounterBinaryWriter()
 
     def run(self):
-        counters = []
+        collectTasks = []
         for dataSource in self.dataSources:
-            counters.extend(dataSource.collect())
+            collectTasks.extend(dataSource.getCollectTasks())
+        counters = self.collectorPool.run(collectTasks)
+        #Error
+        counters.append(createCounterError())
         clearLastErrorRecord()
         self.writer.write(counters)
+        if self.binaryWriter is not None:
+            try:
+                self.binaryWriter.write(counters)
+            except EnvironmentError as e:
+                waagent.Error(u"Failed to write binary perf counters: {0}".format(e))
 
 EventFile=os.path.join(LibDir, "PerfCounters")
 class PerfCounterWriter(object):
@@ -1344,8 +1721,119 @@ class PerfCounterWriter(object):
         raise
 
     def _write(self, counters, eventFile):
-        with open(eventFile, "w+") as F:
-            F.write("".join(map(lambda c : str(c), counters)).encode("utf8"))
+        """
+        The counters are written to a temp file which then replaces the event
+        file, so that readers never see a partially written file.
+        """
+        if os.path.exists(eventFile) and not os.path.isfile(eventFile):
+            raise IOError("Not a regular file: {0}".format(eventFile))
+        content = u"".join([unicode(c) for c in counters]).encode("utf8")
+        tmpFile = eventFile + ".tmp"
+        with open(tmpFile, "w") as F:
+            F.write(content)
+            F.flush()
+            os.fsync(F.fileno())
+        os.chmod(tmpFile, 0644)
+        os.rename(tmpFile, eventFile)
+
+#Layout of perf_counter in clib/include/azureperf.h
+PERF_COUNT_MAX = 128
+PerfCounterRecord = struct.Struct("=i64s128s256si256s64sI4xq128s")
+#magic, version, sequence, number of counters
+PerfCounterFileHeader = struct.Struct("=IIIi")
+PERF_COUNTER_FILE_MAGIC = 0x504d4541 #"AEMP"
+PERF_COUNTER_FILE_VERSION = 1
+
+BinaryEventFile=os.path.join(LibDir, "PerfCounters.bin")
+class PerfCounterBinaryWriter(object):
+    """
+    Publishes the counters as an array of perf_counter structs in a memory
+    mapped file, for readers that don't want to parse the text file.
+    The sequence in the header is odd while the counters are being updated,
+    readers retry if it is odd or changed during their copy.
+    """
+    def __init__(self, binaryFile=BinaryEventFile):
+        self.binaryFile = binaryFile
+        self.map = None
+        self.sequence = 0
+
+    def open(self):
+        size = PerfCounterFileHeader.size + PERF_COUNT_MAX * PerfCounterRecord.size
+        fd = os.open(self.binaryFile, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        magic, version, sequence, length = PerfCounterFileHeader.unpack_from(self.map, 0)
+        if magic == PERF_COUNTER_FILE_MAGIC:
+            self.sequence = sequence + (sequence & 1)
+
+    def packValue(self, counter):
+        value = counter.value
+        if counter.counterType == PerfCounterType.COUNTER_TYPE_INT:
+            return struct.pack("=i", int(value))
+        elif counter.counterType == PerfCounterType.COUNTER_TYPE_LARGE:
+            return struct.pack("=q", long(value))
+        elif counter.counterType == PerfCounterType.COUNTER_TYPE_DOUBLE:
+            return struct.pack("=d", float(value))
+        else:
+            return toCString(value, 256)
+
+    def packCounter(self, counter):
+        isEmpty = 1
+        value = ""
+        if counter.value is not None:
+            try:
+                value = self.packValue(counter)
+                isEmpty = 0
+            except (ValueError, TypeError, OverflowError, struct.error):
+                waagent.Warn(("Invalid value for counter {0}: {1}"
+                              "").format(counter.name, counter.value))
+        return PerfCounterRecord.pack(counter.counterType,
+                                      toCString(counter.category, 64),
+                                      toCString(counter.name, 128),
+                                      toCString(counter.instance, 256),
+                                      isEmpty,
+                                      value,
+                                      toCString(counter.unit, 64),
+                                      int(counter.refreshInterval),
+                                      long(counter.timestamp),
+                                      toCString(counter.machine, 128))
+
+    def write(self, counters):
+        if self.map is None:
+            self.open()
+        if len(counters) > PERF_COUNT_MAX:
+            waagent.Warn(("Only {0} of {1} counters fit in the binary file."
+                          "").format(PERF_COUNT_MAX, len(counters)))
+            counters = counters[:PERF_COUNT_MAX]
+        records = "".join([self.packCounter(c) for c in counters])
+
+        self.sequence += 1
+        PerfCounterFileHeader.pack_into(self.map, 0, PERF_COUNTER_FILE_MAGIC,
+                                        PERF_COUNTER_FILE_VERSION,
+                                        self.sequence, 0)
+        self.map[PerfCounterFileHeader.size:PerfCounterFileHeader.size + len(records)] = records
+        self.sequence += 1
+        PerfCounterFileHeader.pack_into(self.map, 0, PERF_COUNTER_FILE_MAGIC,
+                                        PERF_COUNTER_FILE_VERSION,
+                                        self.sequence, len(counters))
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+def toCString(value, size):
+    """
+    Encodes value as a nul terminated utf-8 string that fits in size bytes
+    """
+    if value is None:
+        value = ""
+    if not isinstance(value, unicode):
+        value = str(value).decode("utf8", "replace")
+    return value.encode("utf8")[:size - 1]
 
 class EnhancedMonitorConfig(object):
     def __init__(self, publicConfig, privateConfig):
@@ -1477,6 +1965,10 @@ class EnhancedMonitorConfig(object):
     def getStorageAccountHourUri(self, name):
         return self.configData.get("{0}.hour.uri".format(name))
 
+    def isBinaryCounterFileEnabled(self):
+        flag = self.configData.get("binarycounters.isenabled")
+        return flag == "1" or flag == 1
+
     def isLADEnabled(self):
         flag = self.configData.get("wad.isenabled")
         return flag == "1" or flag == 1
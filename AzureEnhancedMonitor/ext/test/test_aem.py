@@ -19,6 +19,9 @@
 import datetime
 import os
 import json
+import struct
+import threading
+import time
 import unittest
 
 import env
@@ -164,6 +167,7 @@ class TestAEM(unittest.TestCase):
         self.assertNotEquals(0, cpuinfo.getNumOfCores())
         self.assertNotEquals(None, cpuinfo.getProcessorType())
         self.assertEquals(float, type(cpuinfo.getFrequency()))
+        self.assertEquals(float, type(aem.CPUInfo.getCurrentFrequency()))
         self.assertEquals(bool, type(cpuinfo.isHyperThreadingOn()))
         percent = cpuinfo.getCPUPercent()
         self.assertEquals(float, type(percent))
@@ -188,6 +192,58 @@ class TestAEM(unittest.TestCase):
         self.assertNotEquals(None, netinfo.getNetworkWriteBytes())
         self.assertNotEquals(None, netinfo.getNetworkPacketRetransmitted())
 
+    def test_network_sampler(self):
+        testNetDevFile = "/tmp/NetDev"
+        testSampleFile = "/tmp/NetworkSample"
+        if os.path.isfile(testSampleFile):
+            os.remove(testSampleFile)
+        header = ("Inter-|   Receive                      |  Transmit\n"
+                  " face |bytes    packets errs drop fifo frame compressed "
+                  "multicast|bytes    packets errs drop fifo colls carrier "
+                  "compressed\n")
+        waagent.SetFileContents(testNetDevFile, header + 
+                                ("    lo: 10 1 0 0 0 0 0 0 10 1 0 0 0 0 0 0\n"
+                                 "  eth0: 1000 1 0 0 0 0 0 0 2000 1 0 0 0 0 0 0\n"))
+        sampler = aem.NetworkCounterSampler(testNetDevFile, testSampleFile)
+        netinfo = aem.NetworkInfo(sampler)
+        self.assertEquals(["eth0"], netinfo.getAdapterIds())
+        #No previous sample, no rate
+        self.assertEquals(None, netinfo.getNetworkReadBytes("eth0"))
+        self.assertTrue(os.path.isfile(testSampleFile))
+
+        #Pretend the previous sample was taken one interval ago
+        waagent.SetFileContents(testSampleFile, ("{0}\neth0 1000 2000"
+                                                 "").format(time.time() - 60))
+        waagent.SetFileContents(testNetDevFile, header + 
+                                ("  eth0: 7000 1 0 0 0 0 0 0 14000 1 0 0 0 0 0 0\n"))
+        sampler = aem.NetworkCounterSampler(testNetDevFile, testSampleFile)
+        netinfo = aem.NetworkInfo(sampler)
+        self.assertAlmostEquals(100, netinfo.getNetworkReadBytes("eth0"), 0)
+        self.assertAlmostEquals(200, netinfo.getNetworkWriteBytes("eth0"), 0)
+
+    def test_fact_cache(self):
+        factCache = aem.FactCache()
+        computed = []
+        def compute():
+            computed.append(1)
+            return len(computed)
+        self.assertEquals(1, factCache.get("test", compute))
+        self.assertEquals(1, factCache.get("test", compute))
+        self.assertEquals(1, len(computed))
+
+        #Pretend the hardware changed since the last check
+        factCache.signature = "changed"
+        factCache.lastCheck = None
+        self.assertEquals(2, factCache.get("test", compute))
+
+    def test_packet_retransmitted(self):
+        netinfo = aem.NetworkInfo()
+        netinfo.getSnmp = lambda : ("Ip: Forwarding DefaultTTL\n"
+                                    "Ip: 1 64\n"
+                                    "Tcp: RtoAlgorithm RtoMin RetransSegs InErrs\n"
+                                    "Tcp: 1 200 42 0\n")
+        self.assertEquals(42, netinfo.getNetworkPacketRetransmitted())
+
     def test_hwchangeinfo(self):
         netinfo = aem.NetworkInfo()
         testHwInfoFile = "/tmp/HwInfo"
@@ -299,6 +355,76 @@ class TestAEM(unittest.TestCase):
         self.assertNotEquals(None, stat.getWriteOpServerLatency())
         self.assertNotEquals(None, stat.getWriteOpThroughput())
 
+    def test_storagemetric_single_pass(self):
+        metrics = mock_getStorageMetrics()
+        stat = aem.AzureStorageStat(metrics)
+        reads = filter(lambda x : aem.isUserRead(x.RowKey), metrics)
+        self.assertEquals(sum(map(lambda x : x.TotalRequests, reads)), 
+                          stat.getReadOps())
+        self.assertEquals(sum(map(lambda x : x.TotalIngress + x.TotalEgress, 
+                                  reads)), 
+                          stat.getReadBytes())
+
+    def test_storage_metrics_fetcher(self):
+        class Page(list):
+            pass
+        class MockTableService(object):
+            def __init__(self):
+                self.queries = []
+            def query_entities(self, table, ofilter, oselect, top, 
+                               nextPartitionKey, nextRowKey):
+                self.queries.append((ofilter, nextPartitionKey))
+                metric = mock_getStorageMetrics()[0]
+                metric.PartitionKey = "20150126T0354"
+                page = Page([metric])
+                if nextPartitionKey is None:
+                    page.x_ms_continuation = {"NextPartitionKey" : "20150126T0354",
+                                              "NextRowKey" : "user;All"}
+                return page
+        fetcher = aem.StorageMetricsFetcher("asdf", "qwer", 
+                                            ".table.core.windows.net", 
+                                            "$metricsminuteprimarytransactionsblob")
+        fetcher.tableService = MockTableService()
+        metrics = fetcher.fetch("20150126T0354", "20150126T0355")
+        self.assertEquals(2, len(metrics))
+        self.assertEquals(2, len(fetcher.tableService.queries))
+        self.assertEquals("20150126T0354", fetcher.lastPartitionKey)
+
+        #The same range is not fetched again
+        fetcher.fetch("20150126T0354", "20150126T0355")
+        self.assertEquals(2, len(fetcher.tableService.queries))
+
+        #Only the minutes after the last one ingested are fetched
+        fetcher.fetch("20150126T0354", "20150126T0356")
+        self.assertTrue(fetcher.tableService.queries[2][0].startswith(
+            "PartitionKey gt '20150126T0354'"))
+
+    def test_get_first_entity(self):
+        class Page(list):
+            pass
+        class MockTableService(object):
+            def __init__(self):
+                self.queries = []
+            def query_entities(self, table, ofilter, oselect, top, 
+                               nextPartitionKey, nextRowKey):
+                self.queries.append((top, nextPartitionKey, nextRowKey))
+                #The first page is empty but has a continuation
+                if nextPartitionKey is None:
+                    page = Page()
+                    page.x_ms_continuation = {"NextPartitionKey" : "1",
+                                              "NextRowKey" : "a"}
+                    return page
+                return Page([nextRowKey])
+        tableService = MockTableService()
+        entity = aem.getFirstEntity(tableService, "LinuxCpuVer2v0", "", "")
+        self.assertEquals("a", entity)
+        self.assertEquals([(1, None, None), (1, "1", "a")], 
+                          tableService.queries)
+
+        tableService.query_entities = lambda *args : Page()
+        self.assertEquals(None, aem.getFirstEntity(tableService, 
+                                                   "LinuxCpuVer2v0", "", ""))
+
     def test_disk_info(self):
         config = self.test_config()
         mapping = aem.DiskInfo(config).getDiskMapping()
@@ -342,6 +468,69 @@ class TestAEM(unittest.TestCase):
             self.assertNotEquals(None, counter)
             self.assertNotEquals(None, counter.value)
 
+    def test_collector_pool(self):
+        aem.LibDir = "/tmp"
+        pool = aem.CollectorPool(maxThreads = 2, timeout = 0.5)
+        release = threading.Event()
+        state = {"fail" : False}
+        def fast():
+            if state["fail"]:
+                raise Exception("expected failure")
+            return ["fast"]
+        def slow():
+            release.wait()
+            return ["slow late"]
+        tasks = [("fast", fast), ("slow", lambda : ["slow"])]
+        self.assertEquals(["fast", "slow"], pool.run(tasks))
+
+        #A slow or failing task is reported with its last counters
+        state["fail"] = True
+        aem.clearLastErrorRecord()
+        tasks = [("fast", fast), ("slow", slow)]
+        self.assertEquals(["fast", "slow"], pool.run(tasks))
+        self.assertNotEquals("0", aem.getLatestErrorRecord())
+
+        #A task that finished after the deadline still updates its last counters
+        release.set()
+        pool.runningTasks["slow"].done.wait(1)
+        tasks = [("fast", fast), ("slow", fast)]
+        self.assertEquals(["fast", "slow late"], pool.run(tasks))
+
+    def test_collector_pool_error_records(self):
+        aem.LibDir = "/tmp"
+        pool = aem.CollectorPool(maxThreads = 2, timeout = 0.5)
+        def failStorage():
+            raise Exception("expected failure")
+        aem.clearLastErrorRecord()
+        pool.run([("storage.account", failStorage)])
+        self.assertEquals(aem.FAILED_TO_RETRIEVE_STORAGE_DATA,
+                          aem.getLatestErrorRecord())
+
+        #A task that misses the deadline doesn't leak its errors into the
+        #next cycle
+        release = threading.Event()
+        def late():
+            release.wait()
+            aem.updateLatestErrorRecord(aem.FAILED_TO_RETRIEVE_LOCAL_DATA)
+            return ["late"]
+        aem.clearLastErrorRecord()
+        pool.run([("late", late)])
+        self.assertEquals(aem.FAILED_TO_COLLECT_IN_TIME,
+                          aem.getLatestErrorRecord())
+        aem.clearLastErrorRecord()
+        release.set()
+        pool.runningTasks["late"].done.wait(1)
+        self.assertEquals("0", aem.getLatestErrorRecord())
+
+        #The errors of a task that finishes in time are recorded
+        def partial():
+            aem.updateLatestErrorRecord(aem.FAILED_TO_RETRIEVE_LOCAL_DATA)
+            return ["partial"]
+        self.assertEquals(["partial"], pool.run([("vm", partial)]))
+        self.assertEquals(aem.FAILED_TO_RETRIEVE_LOCAL_DATA,
+                          aem.getLatestErrorRecord())
+        aem.clearLastErrorRecord()
+
     def test_writer(self):
         testEventFile = "/tmp/Event"
         if os.path.isfile(testEventFile):
@@ -364,6 +553,39 @@ class TestAEM(unittest.TestCase):
         self.assertRaises(IOError, writer.write, counters, 2, testEventFile)
         print("==============================")
 
+    def test_binary_writer(self):
+        testBinaryFile = "/tmp/Event.bin"
+        if os.path.isfile(testBinaryFile):
+            os.remove(testBinaryFile)
+        writer = aem.PerfCounterBinaryWriter(testBinaryFile)
+        counters = [aem.PerfCounter(counterType = aem.PerfCounterType.COUNTER_TYPE_INT,
+                                    category = "test",
+                                    name = "int",
+                                    value = 42),
+                    aem.PerfCounter(counterType = aem.PerfCounterType.COUNTER_TYPE_STRING,
+                                    category = "test",
+                                    name = "empty",
+                                    value = None)]
+        writer.write(counters)
+        writer.write(counters)
+        writer.close()
+
+        with open(testBinaryFile, "rb") as F:
+            content = F.read()
+        magic, version, sequence, length = aem.PerfCounterFileHeader.unpack_from(content, 0)
+        self.assertEquals(aem.PERF_COUNTER_FILE_MAGIC, magic)
+        self.assertEquals(4, sequence)
+        self.assertEquals(2, length)
+        record = aem.PerfCounterRecord.unpack_from(content, 
+                                                   aem.PerfCounterFileHeader.size)
+        self.assertEquals("int", record[2].rstrip("\0"))
+        self.assertEquals(0, record[4])
+        self.assertEquals(42, struct.unpack_from("=i", record[5])[0])
+        record = aem.PerfCounterRecord.unpack_from(content, 
+                                                   aem.PerfCounterFileHeader.size +
+                                                   aem.PerfCounterRecord.size)
+        self.assertEquals(1, record[4])
+
     def test_easyHash(self):
         hashVal = aem.easyHash('a')
         self.assertEquals(97, hashVal)
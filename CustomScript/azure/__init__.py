@@ -94,6 +94,8 @@ _ERROR_CANNOT_SERIALIZE_VALUE_TO_ENTITY = \
 _ERROR_PAGE_BLOB_SIZE_ALIGNMENT = \
     'Invalid page blob size: {0}. ' + \
     'The size must be aligned to a 512-byte boundary.'
+_ERROR_BLOB_RANGE_MD5_MISMATCH = \
+    'Content-MD5 mismatch for bytes {0}-{1} of blob {2}.'
 
 _USER_AGENT_STRING = 'pyazure/' + __version__
 
@@ -419,16 +421,23 @@ def _clone_node_with_namespaces(node_to_clone, original_doc):
     return clone
 
 
+def _get_response_continuation(response):
+    ''' The x-ms-continuation-* headers of the response, by the name that
+    follows the prefix, e.g. 'NextPartitionKey'. '''
+    x_ms_continuation = HeaderDict()
+    for name, value in response.headers:
+        if 'x-ms-continuation' in name:
+            x_ms_continuation[name[len('x-ms-continuation') + 1:]] = value
+    return x_ms_continuation
+
+
 def _convert_response_to_feeds(response, convert_callback):
     if response is None:
         return None
 
     feeds = _list_of(Feed)
 
-    x_ms_continuation = HeaderDict()
-    for name, value in response.headers:
-        if 'x-ms-continuation' in name:
-            x_ms_continuation[name[len('x-ms-continuation') + 1:]] = value
+    x_ms_continuation = _get_response_continuation(response)
     if x_ms_continuation:
         setattr(feeds, 'x_ms_continuation', x_ms_continuation)
 
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+#
+#CustomScript extension
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import hashlib
+import re
+import threading
+
+import env
+from azure.http import HTTPError, HTTPResponse
+from azure.storage import BlobService
+
+class MockBlobStorage:
+    """
+    Stands in for the _filter of a BlobService and answers its requests
+    from one blob kept in memory, with its committed and uncommitted blocks.
+    """
+    def __init__(self, content=b""):
+        self.content = content
+        self.lock = threading.Lock()
+        self.ranges = []
+        #Start offsets of the ranges answered once with a wrong body
+        self.corrupt_ranges = set()
+        self.committed_blocks = []
+        self.uncommitted_blocks = {}
+        self.put_block_ids = []
+        #Block ids whose put_block fails
+        self.failing_blocks = set()
+        self.block_list_headers = None
+
+    def create_service(self, chunk_size, max_data_size=None):
+        service = BlobService("account", base64.b64encode(b"key").decode())
+        service._BLOB_MAX_CHUNK_DATA_SIZE = chunk_size
+        if max_data_size is not None:
+            service._BLOB_MAX_DATA_SIZE = max_data_size
+        service._filter = self.perform_request
+        return service
+
+    def perform_request(self, request):
+        headers = dict(request.headers)
+        query = dict(request.query)
+        comp = query.get("comp")
+        if request.method == "GET" and comp is None:
+            return self.get_range(headers)
+        if request.method == "PUT" and comp == "block":
+            return self.put_block(query, request.body)
+        if request.method == "PUT" and comp == "blocklist":
+            return self.put_block_list(headers, request.body)
+        if request.method == "GET" and comp == "blocklist":
+            return self.get_block_list()
+        raise HTTPError(400, "Bad Request", [], b"")
+
+    def put_block(self, query, body):
+        block_id = base64.b64decode(query["blockid"]).decode()
+        with self.lock:
+            if block_id in self.failing_blocks:
+                raise HTTPError(400, "Bad Request", [], b"")
+            self.put_block_ids.append(block_id)
+            self.uncommitted_blocks[block_id] = body
+        return HTTPResponse(201, "Created", [], b"")
+
+    def put_block_list(self, headers, body):
+        if not isinstance(body, str):
+            body = body.decode()
+        block_ids = [base64.b64decode(block_id).decode() for block_id in
+                     re.findall("<Latest>([^<]*)</Latest>", body)]
+        with self.lock:
+            blocks = dict(self.committed_blocks)
+            blocks.update(self.uncommitted_blocks)
+            self.committed_blocks = [(block_id, blocks[block_id])
+                                     for block_id in block_ids]
+            self.uncommitted_blocks = {}
+            self.content = b"".join(block for block_id, block in
+                                    self.committed_blocks)
+            self.block_list_headers = headers
+        return HTTPResponse(201, "Created", [], b"")
+
+    def get_block_list(self):
+        def to_xml(blocks):
+            return "".join("<Block><Name>{0}</Name><Size>{1}</Size></Block>"
+                           "".format(base64.b64encode(block_id.encode())
+                                     .decode(), len(block))
+                           for block_id, block in blocks)
+        with self.lock:
+            if not self.committed_blocks and not self.uncommitted_blocks:
+                raise HTTPError(404, "Not Found", [], b"")
+            xml = ('<?xml version="1.0" encoding="utf-8"?><BlockList>'
+                   "<CommittedBlocks>{0}</CommittedBlocks>"
+                   "<UncommittedBlocks>{1}</UncommittedBlocks>"
+                   "</BlockList>").format(
+                       to_xml(self.committed_blocks),
+                       to_xml(sorted(self.uncommitted_blocks.items())))
+        return HTTPResponse(200, "OK", [], xml.encode())
+
+    def get_range(self, headers):
+        start, _, end = headers["x-ms-range"][len("bytes="):].partition("-")
+        start, end = int(start), int(end)
+        with self.lock:
+            self.ranges.append(start)
+            corrupt = start in self.corrupt_ranges
+            self.corrupt_ranges.discard(start)
+        if start >= len(self.content):
+            raise HTTPError(416, "Requested Range Not Satisfiable", [], b"")
+        body = self.content[start:end + 1]
+        response_headers = [("content-range", "bytes {0}-{1}/{2}".format(
+            start, start + len(body) - 1, len(self.content)))]
+        if headers.get("x-ms-range-get-content-md5") == "true":
+            md5 = base64.b64encode(hashlib.md5(body).digest()).decode()
+            response_headers.append(("content-md5", md5))
+        if corrupt:
+            body = b"\0" + body[1:]
+        return HTTPResponse(206, "Partial Content", response_headers, body)
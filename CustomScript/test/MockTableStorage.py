@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+#
+#CustomScript extension
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import threading
+
+import env
+from azure.http import HTTPResponse
+from azure.storage import TableService
+
+AtomContentType = "application/atom+xml;charset=utf-8"
+
+class MockTableStorage:
+    """
+    Stands in for the _filter of a TableService, answers the requests in
+    order with the given (headers, body) responses and records them.
+    """
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.lock = threading.Lock()
+        self.requests = []
+
+    def create_service(self):
+        service = TableService("account", base64.b64encode(b"key").decode())
+        service._filter = self.perform_request
+        return service
+
+    def perform_request(self, request):
+        with self.lock:
+            self.requests.append(request)
+            response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        headers, body = response
+        if not isinstance(body, bytes):
+            body = body.encode("utf-8")
+        return HTTPResponse(200, "OK", list(headers), body)
+
+    def get_query(self, index):
+        return dict(self.requests[index].query)
+
+    def get_headers(self, index):
+        return dict(self.requests[index].headers)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+#
+#CustomScript extension
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+import tempfile
+import unittest
+
+from MockBlobStorage import MockBlobStorage
+
+ChunkSize = 1024
+
+class UnseekableStream:
+    def __init__(self):
+        self.data = b""
+
+    def write(self, data):
+        self.data += data
+
+class TestBlobChunkDownload(unittest.TestCase):
+    def setUp(self):
+        self.content = os.urandom(10 * ChunkSize + 100)
+        self.storage = MockBlobStorage(self.content)
+        self.service = self.storage.create_service(ChunkSize)
+        self.progress = []
+
+    def download(self, stream, **kwargs):
+        self.service.get_blob_to_file("container", "blob", stream,
+                                      progress_callback=self.on_progress,
+                                      retry_wait=0, **kwargs)
+
+    def on_progress(self, current, total):
+        self.progress.append((current, total))
+
+    def assertRanges(self):
+        expected = list(range(0, len(self.content), ChunkSize))
+        self.assertEqual(expected, sorted(self.storage.ranges))
+        self.assertEqual((len(self.content), len(self.content)),
+                         max(self.progress))
+
+    def test_download_to_file(self):
+        with tempfile.TemporaryFile() as stream:
+            stream.write(b"head")
+            self.download(stream)
+            self.assertEqual(4 + len(self.content), stream.tell())
+            stream.seek(0)
+            self.assertEqual(b"head" + self.content, stream.read())
+        self.assertRanges()
+
+    def test_download_to_seekable_stream(self):
+        stream = io.BytesIO()
+        self.download(stream)
+        self.assertEqual(self.content, stream.getvalue())
+        self.assertRanges()
+
+    def test_download_to_unseekable_stream(self):
+        stream = UnseekableStream()
+        self.download(stream)
+        self.assertEqual(self.content, stream.data)
+        self.assertEqual(list(range(0, len(self.content), ChunkSize)),
+                         self.storage.ranges)
+        self.assertEqual((len(self.content), len(self.content)),
+                         self.progress[-1])
+
+    def test_download_empty_blob(self):
+        self.storage.content = b""
+        stream = io.BytesIO()
+        self.download(stream)
+        self.assertEqual(b"", stream.getvalue())
+        self.assertEqual([0], self.storage.ranges)
+        self.assertEqual([(0, 0)], self.progress)
+
+    def test_retry_after_content_md5_mismatch(self):
+        self.storage.corrupt_ranges = set([0, 3 * ChunkSize])
+        stream = io.BytesIO()
+        self.download(stream, verify_content_md5=True)
+        self.assertEqual(self.content, stream.getvalue())
+        self.assertEqual(2, self.storage.ranges.count(0))
+        self.assertEqual(2, self.storage.ranges.count(3 * ChunkSize))
+        self.assertEqual(len(range(0, len(self.content), ChunkSize)) + 2,
+                         len(self.storage.ranges))
+
+    def test_content_md5_mismatch_after_retries(self):
+        self.storage.corrupt_ranges = set([2 * ChunkSize])
+        stream = io.BytesIO()
+        self.assertRaises(Exception, self.download, stream,
+                          verify_content_md5=True, max_retries=0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+#
+#CustomScript extension
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import hashlib
+import io
+import os
+import unittest
+
+from MockBlobStorage import MockBlobStorage
+
+BlockSize = 1024
+
+class TestBlobChunkUpload(unittest.TestCase):
+    def setUp(self):
+        self.content = os.urandom(10 * BlockSize + 100)
+        self.storage = MockBlobStorage()
+        self.service = self.storage.create_service(BlockSize, 4 * BlockSize)
+
+    def upload(self, **kwargs):
+        self.service.put_block_blob_from_file("container", "blob",
+                                              io.BytesIO(self.content),
+                                              count=len(self.content),
+                                              max_connections=4,
+                                              retry_wait=0, **kwargs)
+
+    def expected_block_ids(self):
+        block_ids = []
+        for offset in range(0, len(self.content), BlockSize):
+            block = self.content[offset:offset + BlockSize]
+            block_ids.append("{0:08d}-{1}".format(
+                len(block_ids), hashlib.md5(block).hexdigest()))
+        return block_ids
+
+    def test_block_order(self):
+        self.upload()
+        block_ids = [block_id for block_id, block in
+                     self.storage.committed_blocks]
+        self.assertEqual(self.expected_block_ids(), block_ids)
+        self.assertEqual(self.content, self.storage.content)
+
+    def test_blob_content_md5(self):
+        self.upload()
+        md5 = base64.b64encode(hashlib.md5(self.content).digest()).decode()
+        self.assertEqual(md5,
+                         self.storage.block_list_headers["x-ms-blob-content-md5"])
+
+    def test_explicit_blob_content_md5(self):
+        self.upload(x_ms_blob_content_md5="given")
+        self.assertEqual("given",
+                         self.storage.block_list_headers["x-ms-blob-content-md5"])
+
+    def test_resume(self):
+        block_ids = self.expected_block_ids()
+        self.storage.failing_blocks = set([block_ids[6]])
+        self.assertRaises(Exception, self.upload)
+        self.assertEqual([], self.storage.committed_blocks)
+        uploaded = set(self.storage.put_block_ids)
+        self.assertTrue(block_ids[0] in uploaded)
+
+        self.storage.failing_blocks = set()
+        del self.storage.put_block_ids[:]
+        self.upload(resume=True)
+        #Only the blocks that were not there yet are uploaded again
+        self.assertEqual(set(block_ids) - uploaded,
+                         set(self.storage.put_block_ids))
+        self.assertEqual(self.content, self.storage.content)
+
+    def test_no_resume_uploads_every_block(self):
+        self.upload()
+        del self.storage.put_block_ids[:]
+        self.upload()
+        self.assertEqual(self.expected_block_ids(),
+                         sorted(self.storage.put_block_ids))
+
+if __name__ == '__main__':
+    unittest.main()
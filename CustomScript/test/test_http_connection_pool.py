@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+#
+#CustomScript extension
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+import sys
+import threading
+import unittest
+
+import env
+from azure.http import HTTPRequest
+from azure.http.httpclient import _HTTPClient
+
+if sys.version_info < (3,):
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+else:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def handle(self):
+        with self.server.lock:
+            self.server.connections.append(self.connection)
+        BaseHTTPRequestHandler.handle(self)
+
+    def respond(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        self.server.requests.append((self.command, self.path))
+        if self.server.drop_next:
+            #Close the kept connection without answering
+            self.server.drop_next = False
+            self.close_connection = 1
+            return
+        body = b"ok"
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = respond
+    do_PUT = respond
+
+    def log_message(self, format, *args):
+        pass
+
+
+class KeepAliveServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), KeepAliveHandler)
+        self.lock = threading.Lock()
+        self.connections = []
+        self.requests = []
+        self.drop_next = False
+
+    def kill_connections(self):
+        with self.lock:
+            connections = self.connections
+            self.connections = []
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+class TestHTTPConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.server = KeepAliveServer()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.client = _HTTPClient(None, protocol="http")
+
+    def tearDown(self):
+        self.client.close_connections()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def request(self, method, query=None):
+        request = HTTPRequest()
+        request.host = "127.0.0.1:{0}".format(self.server.server_address[1])
+        request.method = method
+        request.query = query or []
+        request.path = "/container/blob"
+        if request.query:
+            request.path += "?" + "&".join("{0}={1}".format(name, value)
+                                           for name, value in request.query)
+        request.headers = [("Content-Length", "0")]
+        return self.client.perform_request(request)
+
+    def test_reuse(self):
+        self.assertEqual(200, self.request("GET").status)
+        self.assertEqual(200, self.request("GET").status)
+        stats = self.client.get_connection_pool_stats()
+        self.assertEqual(1, stats["created"])
+        self.assertEqual(1, stats["reused"])
+        self.assertEqual(1, stats["idle"])
+
+    def test_killed_idle_connection_is_discarded(self):
+        self.request("GET")
+        self.server.kill_connections()
+        self.assertEqual(200, self.request("GET").status)
+        stats = self.client.get_connection_pool_stats()
+        self.assertEqual(2, stats["created"])
+        self.assertEqual(0, stats["reused"])
+        self.assertEqual(1, stats["discarded"])
+        self.assertEqual(0, stats["retried"])
+
+    def test_retry_when_closed_without_response(self):
+        self.request("GET")
+        self.server.drop_next = True
+        self.assertEqual(200, self.request("PUT").status)
+        stats = self.client.get_connection_pool_stats()
+        self.assertEqual(2, stats["created"])
+        self.assertEqual(1, stats["reused"])
+        self.assertEqual(1, stats["retried"])
+        self.assertEqual(1, stats["idle"])
+        self.assertEqual(3, len(self.server.requests))
+
+    def test_no_retry_for_snapshot_and_lease(self):
+        for comp in ("snapshot", "lease"):
+            self.request("GET")
+            self.server.drop_next = True
+            del self.server.requests[:]
+            self.assertRaises(Exception, self.request, "PUT", [("comp", comp)])
+            #The request reached the server once and was not sent again
+            self.assertEqual(1, len(self.server.requests))
+        self.assertEqual(0, self.client.get_connection_pool_stats()["retried"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#CustomScript extension
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import unittest
+from datetime import datetime
+from xml.dom import minidom
+
+from MockTableStorage import MockTableStorage, AtomContentType
+from azure import (
+    METADATA_NS,
+    _get_child_nodes,
+    _get_child_nodesNS,
+    _get_children_from_path,
+    _get_entry_properties_from_node,
+    )
+from azure.storage import (
+    Entity,
+    EntityProperty,
+    TABLE_ACCEPT_ATOM,
+    TABLE_ACCEPT_JSON_MINIMAL_METADATA,
+    TABLE_ACCEPT_JSON_NO_METADATA,
+    X_MS_VERSION_JSON,
+    _ENTITY_TO_PYTHON_CONVERSIONS,
+    _iter_entities_from_atom,
+    _set_entity_attr,
+    )
+
+Feed = (
+    '<?xml version="1.0" encoding="utf-8" standalone="yes"?>'
+    '<feed xml:base="https://account.table.core.windows.net/" '
+    'xmlns:d="http://schemas.microsoft.com/ado/2007/08/dataservices" '
+    'xmlns:m="http://schemas.microsoft.com/ado/2007/08/dataservices/metadata" '
+    'xmlns="http://www.w3.org/2005/Atom">'
+    '<id>https://account.table.core.windows.net/Customers</id>'
+    '<title type="text">Customers</title>'
+    '<updated>2014-06-27T08:00:00Z</updated>'
+    '<link rel="self" title="Customers" href="Customers" />'
+    '{0}</feed>')
+
+Entries = [
+    '<entry m:etag="W/&quot;datetime\'2014-06-27T08%3A00%3A00.1234567Z\'&quot;">'
+    '<id>https://account.table.core.windows.net/Customers(PartitionKey=\'p\',RowKey=\'1\')</id>'
+    '<title type="text"></title>'
+    '<updated>2014-06-27T08:00:00Z</updated>'
+    '<author><name /></author>'
+    '<category term="account.Customers" scheme="http://schemas.microsoft.com/ado/2007/08/dataservices/scheme" />'
+    '<content type="application/xml"><m:properties>'
+    '<d:PartitionKey>p</d:PartitionKey>'
+    '<d:RowKey>1</d:RowKey>'
+    '<d:Timestamp m:type="Edm.DateTime">2014-06-27T08:00:00.123456Z</d:Timestamp>'
+    '<d:Address>Mountain View</d:Address>'
+    '<d:City>S&#233;te</d:City>'
+    '<d:Age m:type="Edm.Int32">23</d:Age>'
+    '<d:NumOfOrders m:type="Edm.Int64">9223372036854775807</d:NumOfOrders>'
+    '<d:AmountDue m:type="Edm.Double">200.23</d:AmountDue>'
+    '<d:IsActive m:type="Edm.Boolean">true</d:IsActive>'
+    '<d:IsClosed m:type="Edm.Boolean">false</d:IsClosed>'
+    '<d:CustomerSince m:type="Edm.DateTime">2008-07-10T00:00:00Z</d:CustomerSince>'
+    '<d:LastOrder m:type="Edm.DateTime">2014-06-27T08:00:00.123456Z</d:LastOrder>'
+    '<d:BinaryData m:type="Edm.Binary">AQID</d:BinaryData>'
+    '<d:CustomerCode m:type="Edm.Guid">c9da6455-213d-42c9-9a79-3e9149a57833</d:CustomerCode>'
+    '<d:Empty></d:Empty>'
+    '<d:NoBinary m:type="Edm.Binary" m:null="true" />'
+    '<d:NoString m:null="true" />'
+    '</m:properties></content></entry>',
+    '<entry m:etag="W/&quot;datetime\'2014-06-27T08%3A00%3A01Z\'&quot;">'
+    '<id>https://account.table.core.windows.net/Customers(PartitionKey=\'p\',RowKey=\'2\')</id>'
+    '<title type="text"></title>'
+    '<updated>2014-06-27T08:00:01Z</updated>'
+    '<author><name /></author>'
+    '<content type="application/xml"><m:properties>'
+    '<d:PartitionKey>p</d:PartitionKey>'
+    '<d:RowKey>2</d:RowKey>'
+    '<d:Age m:type="Edm.Int32">-1</d:Age>'
+    '</m:properties></content></entry>',
+]
+
+def _remove_prefix(name):
+    colon = name.find(':')
+    if colon != -1:
+        return name[colon + 1:]
+    return name
+
+def minidom_entities(xmlstr):
+    """
+    The minidom decoder the incremental one replaced, as reference.
+    """
+    entities = []
+    xmldoc = minidom.parseString(xmlstr)
+    for entry in _get_children_from_path(xmldoc, "feed", "entry"):
+        entity = Entity()
+        for content in _get_child_nodes(entry, "content"):
+            xml_properties = _get_child_nodesNS(content, METADATA_NS,
+                                                "properties")
+        for xml_property in xml_properties[0].childNodes:
+            name = _remove_prefix(xml_property.nodeName)
+            if name in ["Timestamp"]:
+                continue
+            if xml_property.firstChild:
+                value = xml_property.firstChild.nodeValue
+            else:
+                value = ""
+            isnull = xml_property.getAttributeNS(METADATA_NS, "null")
+            mtype = xml_property.getAttributeNS(METADATA_NS, "type")
+            if not isnull and not mtype:
+                _set_entity_attr(entity, name, value)
+            elif isnull != "true":
+                conv = _ENTITY_TO_PYTHON_CONVERSIONS.get(mtype)
+                if conv is not None:
+                    value = conv(value)
+                else:
+                    value = EntityProperty(mtype, value)
+                _set_entity_attr(entity, name, value)
+        properties = _get_entry_properties_from_node(entry, False)
+        if "etag" in properties:
+            _set_entity_attr(entity, "etag", properties["etag"])
+        entities.append(entity)
+    return entities
+
+def comparable(entity):
+    properties = {}
+    for name, value in entity.__dict__.items():
+        if isinstance(value, EntityProperty):
+            value = ("EntityProperty", value.type, value.value)
+        properties[name] = value
+    return properties
+
+class TestTableEntities(unittest.TestCase):
+    def query(self, headers, body, accept=TABLE_ACCEPT_ATOM):
+        self.storage = MockTableStorage([(headers, body)])
+        service = self.storage.create_service()
+        return service.query_entities("Customers", accept=accept)
+
+    def test_atom_matches_minidom(self):
+        xmlstr = Feed.format("".join(Entries))
+        entities = self.query([("content-type", AtomContentType)], xmlstr)
+        expected = minidom_entities(xmlstr)
+        self.assertEqual(2, len(entities))
+        self.assertEqual([comparable(entity) for entity in expected],
+                         [comparable(entity) for entity in entities])
+
+    def test_atom_types(self):
+        xmlstr = Feed.format("".join(Entries))
+        entity = self.query([("content-type", AtomContentType)], xmlstr)[0]
+        self.assertEqual(u"Séte", entity.City)
+        self.assertEqual(23, entity.Age)
+        self.assertEqual(9223372036854775807, entity.NumOfOrders)
+        self.assertEqual(200.23, entity.AmountDue)
+        self.assertEqual(True, entity.IsActive)
+        self.assertEqual(False, entity.IsClosed)
+        self.assertEqual(datetime(2008, 7, 10), entity.CustomerSince)
+        self.assertEqual(datetime(2014, 6, 27, 8, 0, 0, 123456),
+                         entity.LastOrder)
+        self.assertEqual("Edm.Binary", entity.BinaryData.type)
+        self.assertEqual(b"\x01\x02\x03", entity.BinaryData.value)
+        self.assertEqual("Edm.Guid", entity.CustomerCode.type)
+        self.assertEqual("", entity.Empty)
+        self.assertFalse(hasattr(entity, "Timestamp"))
+        self.assertFalse(hasattr(entity, "NoBinary"))
+        self.assertFalse(hasattr(entity, "NoString"))
+        self.assertEqual("W/\"datetime'2014-06-27T08%3A00%3A00.1234567Z'\"",
+                         entity.etag)
+
+    def test_atom_seven_digit_datetime(self):
+        entry = Entries[1].replace(
+            '<d:Age m:type="Edm.Int32">-1</d:Age>',
+            '<d:Since m:type="Edm.DateTime">2014-06-27T08:00:00.1234567Z</d:Since>'
+            '<d:Until m:type="Edm.DateTime">2014-06-27T08:00:00.9999999</d:Until>')
+        entity = self.query([], Feed.format(entry))[0]
+        self.assertEqual(datetime(2014, 6, 27, 8, 0, 0, 123456), entity.Since)
+        self.assertEqual(datetime(2014, 6, 27, 8, 0, 0, 999999), entity.Until)
+
+    def test_atom_continuation(self):
+        headers = [("content-type", AtomContentType),
+                   ("x-ms-continuation-nextpartitionkey", "1!8!cA--"),
+                   ("x-ms-continuation-nextrowkey", "1!4!Mw--")]
+        entities = self.query(headers, Feed.format(Entries[1]))
+        self.assertEqual(1, len(entities))
+        self.assertEqual("1!8!cA--",
+                         entities.x_ms_continuation["NextPartitionKey"])
+        self.assertEqual("1!4!Mw--", entities.x_ms_continuation["NextRowKey"])
+
+    def test_atom_empty_feed(self):
+        entities = self.query([("content-type", AtomContentType)],
+                              Feed.format(""))
+        self.assertEqual(0, len(entities))
+        self.assertFalse(hasattr(entities, "x_ms_continuation"))
+
+    def test_single_entry(self):
+        xmlstr = Entries[1].replace(
+            "<entry ",
+            '<entry xmlns:d="http://schemas.microsoft.com/ado/2007/08/dataservices" '
+            'xmlns:m="http://schemas.microsoft.com/ado/2007/08/dataservices/metadata" '
+            'xmlns="http://www.w3.org/2005/Atom" ')
+        entities = list(_iter_entities_from_atom(xmlstr))
+        self.assertEqual(1, len(entities))
+        self.assertEqual(-1, entities[0].Age)
+
+    def test_json_no_metadata(self):
+        body = json.dumps({"value": [{
+            "PartitionKey": "p", "RowKey": "1",
+            "Timestamp": "2014-06-27T08:00:00.1234567Z",
+            "Age": 23, "AmountDue": 200.23, "IsActive": True,
+            "NumOfOrders": "255", "City": u"Séte",
+            "CustomerSince": "2008-07-10T00:00:00Z",
+            "Nothing": None}]})
+        headers = [("content-type",
+                    "application/json;odata=nometadata;streaming=true;charset=utf-8"),
+                   ("x-ms-continuation-nextpartitionkey", "1!8!cA--")]
+        entities = self.query(headers, body, TABLE_ACCEPT_JSON_NO_METADATA)
+        request_headers = self.storage.get_headers(0)
+        self.assertEqual(TABLE_ACCEPT_JSON_NO_METADATA, request_headers["Accept"])
+        self.assertEqual(X_MS_VERSION_JSON, request_headers["x-ms-version"])
+
+        self.assertEqual("1!8!cA--",
+                         entities.x_ms_continuation["NextPartitionKey"])
+        entity = entities[0]
+        self.assertEqual("p", entity.PartitionKey)
+        self.assertEqual(23, entity.Age)
+        self.assertEqual(200.23, entity.AmountDue)
+        self.assertEqual(True, entity.IsActive)
+        #Untyped without metadata
+        self.assertEqual("255", entity.NumOfOrders)
+        self.assertEqual("2008-07-10T00:00:00Z", entity.CustomerSince)
+        self.assertEqual(u"Séte", entity.City)
+        self.assertFalse(hasattr(entity, "Timestamp"))
+        self.assertFalse(hasattr(entity, "Nothing"))
+
+    def test_json_minimal_metadata(self):
+        body = json.dumps({
+            "odata.metadata": "https://account.table.core.windows.net/$metadata#Customers",
+            "value": [{
+                "odata.etag": "W/\"datetime'2014-06-27T08%3A00%3A00.1234567Z'\"",
+                "PartitionKey": "p", "RowKey": "1",
+                "Timestamp@odata.type": "Edm.DateTime",
+                "Timestamp": "2014-06-27T08:00:00.1234567Z",
+                "Age": 23,
+                "NumOfOrders@odata.type": "Edm.Int64",
+                "NumOfOrders": "9223372036854775807",
+                "CustomerSince@odata.type": "Edm.DateTime",
+                "CustomerSince": "2008-07-10T00:00:00.1234567Z",
+                "BinaryData@odata.type": "Edm.Binary",
+                "BinaryData": "AQID",
+                "CustomerCode@odata.type": "Edm.Guid",
+                "CustomerCode": "c9da6455-213d-42c9-9a79-3e9149a57833"}]})
+        headers = [("content-type",
+                    "application/json;odata=minimalmetadata;streaming=true;charset=utf-8")]
+        entity = self.query(headers, body, TABLE_ACCEPT_JSON_MINIMAL_METADATA)[0]
+        self.assertEqual(TABLE_ACCEPT_JSON_MINIMAL_METADATA,
+                         self.storage.get_headers(0)["Accept"])
+        self.assertEqual(23, entity.Age)
+        self.assertEqual(9223372036854775807, entity.NumOfOrders)
+        self.assertEqual(datetime(2008, 7, 10, 0, 0, 0, 123456),
+                         entity.CustomerSince)
+        self.assertEqual(b"\x01\x02\x03", entity.BinaryData.value)
+        self.assertEqual("Edm.Guid", entity.CustomerCode.type)
+        self.assertEqual("c9da6455-213d-42c9-9a79-3e9149a57833",
+                         entity.CustomerCode.value)
+        self.assertEqual("W/\"datetime'2014-06-27T08%3A00%3A00.1234567Z'\"",
+                         entity.etag)
+        self.assertFalse(hasattr(entity, "Timestamp"))
+
+if __name__ == '__main__':
+    unittest.main()
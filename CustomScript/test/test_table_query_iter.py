@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+#
+#CustomScript extension
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import time
+import unittest
+
+from MockTableStorage import MockTableStorage
+from azure import WindowsAzureError
+from azure.http import HTTPError
+from azure.storage import TABLE_ACCEPT_JSON_NO_METADATA
+
+JsonContentType = "application/json;odata=nometadata;streaming=true;charset=utf-8"
+
+def page(row_keys, next_row_key=None):
+    headers = [("content-type", JsonContentType)]
+    if next_row_key is not None:
+        headers.append(("x-ms-continuation-nextpartitionkey", "p"))
+        headers.append(("x-ms-continuation-nextrowkey", next_row_key))
+    body = json.dumps({"value": [{"PartitionKey": "p", "RowKey": row_key}
+                                 for row_key in row_keys]})
+    return headers, body
+
+class TestTableQueryIter(unittest.TestCase):
+    def query(self, responses, **kwargs):
+        self.storage = MockTableStorage(responses)
+        service = self.storage.create_service()
+        return service.query_entities_iter("Customers",
+                                           accept=TABLE_ACCEPT_JSON_NO_METADATA,
+                                           **kwargs)
+
+    def row_keys(self, entities):
+        return [entity.RowKey for entity in entities]
+
+    def assertContinuation(self, index, next_row_key):
+        query = self.storage.get_query(index)
+        if next_row_key is None:
+            self.assertEqual(None, query["NextPartitionKey"])
+        else:
+            self.assertEqual("p", query["NextPartitionKey"])
+        self.assertEqual(next_row_key, query["NextRowKey"])
+
+    def wait_for_requests(self, count):
+        deadline = time.time() + 10
+        while len(self.storage.requests) < count and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_follow_continuation(self):
+        responses = [page(["1", "2"], "3"), page(["3", "4"], "5"), page(["5"])]
+        entities = self.query(responses, page_size=2)
+        self.assertEqual(["1", "2", "3", "4", "5"], self.row_keys(entities))
+        self.assertEqual(3, len(self.storage.requests))
+        self.assertContinuation(0, None)
+        self.assertContinuation(1, "3")
+        self.assertContinuation(2, "5")
+        for index in range(3):
+            self.assertEqual("2", self.storage.get_query(index)["$top"])
+
+    def test_top_shrinks_last_page(self):
+        responses = [page(["1", "2"], "3"), page(["3", "4"], "5"), page(["5"])]
+        entities = self.query(responses, top=3, page_size=2)
+        self.assertEqual(["1", "2", "3"], self.row_keys(entities))
+        self.assertEqual(2, len(self.storage.requests))
+        self.assertEqual("2", self.storage.get_query(0)["$top"])
+        self.assertEqual("1", self.storage.get_query(1)["$top"])
+
+    def test_top_reached_stops(self):
+        responses = [page(["1", "2"], "3"), page(["3"])]
+        entities = self.query(responses, top=2, page_size=2)
+        self.assertEqual(["1", "2"], self.row_keys(entities))
+        #The continuation is not followed once top entities are yielded
+        self.assertEqual(1, len(self.storage.requests))
+
+    def test_top_without_page_size(self):
+        responses = [page(["1", "2"])]
+        entities = self.query(responses, top=5)
+        self.assertEqual(["1", "2"], self.row_keys(entities))
+        self.assertEqual("5", self.storage.get_query(0)["$top"])
+
+    def test_empty_page_with_continuation(self):
+        responses = [page(["1"], "2"), page([], "2"), page(["2"])]
+        entities = self.query(responses)
+        self.assertEqual(["1", "2"], self.row_keys(entities))
+        self.assertEqual(3, len(self.storage.requests))
+        self.assertContinuation(2, "2")
+
+    def test_prefetch(self):
+        responses = [page(["1", "2"], "3"), page(["3"], "4"), page(["4"])]
+        entities = self.query(responses)
+        self.assertEqual("1", next(entities).RowKey)
+        #The next page is requested while the first one is consumed
+        self.wait_for_requests(2)
+        self.assertEqual(2, len(self.storage.requests))
+        entities.close()
+        self.assertEqual(2, len(self.storage.requests))
+
+    def test_no_prefetch(self):
+        responses = [page(["1", "2"], "3"), page(["3"], "4"), page(["4"])]
+        entities = self.query(responses, prefetch=False)
+        self.assertEqual("1", next(entities).RowKey)
+        self.assertEqual("2", next(entities).RowKey)
+        self.assertEqual(1, len(self.storage.requests))
+        self.assertEqual(["3", "4"], self.row_keys(entities))
+        self.assertEqual(3, len(self.storage.requests))
+        self.assertContinuation(1, "3")
+        self.assertContinuation(2, "4")
+
+    def test_prefetch_error(self):
+        responses = [page(["1", "2"], "3"),
+                     HTTPError(500, "Internal Server Error", [], b"")]
+        entities = self.query(responses)
+        self.assertEqual("1", next(entities).RowKey)
+        self.assertEqual("2", next(entities).RowKey)
+        self.assertRaises(WindowsAzureError, next, entities)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,11 +13,18 @@
 # limitations under the License.
 #--------------------------------------------------------------------------
 import base64
+import errno
 import os
+import select
+import socket
 import sys
+import threading
+import time
 
 if sys.version_info < (3,):
     from httplib import (
+        BadStatusLine,
+        HTTPException,
         HTTPSConnection,
         HTTPConnection,
         HTTP_PORT,
@@ -26,6 +33,8 @@ if sys.version_info < (3,):
     from urlparse import urlparse
 else:
     from http.client import (
+        BadStatusLine,
+        HTTPException,
         HTTPSConnection,
         HTTPConnection,
         HTTP_PORT,
@@ -36,6 +45,33 @@ else:
 from azure.http import HTTPError, HTTPResponse
 from azure import _USER_AGENT_STRING, _update_request_uri_query
 
+# Requests that can be sent again when a kept connection turns out to be
+# closed by the server after the request was sent, as sending them twice has
+# the same effect as once. Snapshot and lease requests are PUTs that are not.
+_IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+_NOT_IDEMPOTENT_COMPS = ('snapshot', 'lease')
+
+
+def _is_idempotent(request):
+    if request.method not in _IDEMPOTENT_METHODS:
+        return False
+    for name, value in request.query:
+        if name == 'comp' and value in _NOT_IDEMPOTENT_COMPS:
+            return False
+    return True
+
+
+def _is_closed_without_response(error):
+    '''
+    The server closed a kept connection instead of answering, so it dropped
+    the request. A timeout says nothing about whether it was handled.
+    '''
+    if isinstance(error, BadStatusLine):
+        return True
+    if isinstance(error, socket.timeout):
+        return False
+    return getattr(error, 'errno', None) == errno.ECONNRESET
+
 
 class _HTTPClient(object):
 
@@ -67,6 +103,14 @@ class _HTTPClient(object):
         self.proxy_user = None
         self.proxy_password = None
         self.use_httplib = self.should_use_httplib()
+        # Idle connections by (protocol, host, proxy host, proxy port). A
+        # connection is only ever used by one request at a time.
+        self.max_idle_connections = 4
+        self.max_idle_seconds = 60
+        self._pool = {}
+        self._pool_lock = threading.Lock()
+        self._pool_stats = {'created': 0, 'reused': 0, 'discarded': 0,
+                            'retried': 0}
 
     def should_use_httplib(self):
         if sys.platform.lower().startswith('win') and self.cert_file:
@@ -104,6 +148,28 @@ class _HTTPClient(object):
         self.proxy_port = port
         self.proxy_user = user
         self.proxy_password = password
+        self.close_connections()
+
+    def get_connection_pool_stats(self):
+        '''
+        Returns how many connections were created, reused for another
+        request, discarded as closed or idle for too long, and how many
+        requests were retried on a fresh connection, along with the number of
+        idle connections.
+        '''
+        with self._pool_lock:
+            stats = dict(self._pool_stats)
+            stats['idle'] = sum(len(idle) for idle in self._pool.values())
+        return stats
+
+    def close_connections(self):
+        ''' Closes the idle connections. '''
+        with self._pool_lock:
+            pool = self._pool
+            self._pool = {}
+        for idle in pool.values():
+            for connection, released_at in idle:
+                connection.close()
 
     def get_uri(self, request):
         ''' Return the target uri for the request.'''
@@ -153,6 +219,50 @@ class _HTTPClient(object):
 
         return connection
 
+    def _get_connection_key(self, request):
+        protocol = request.protocol_override \
+            if request.protocol_override else self.protocol
+        return (protocol, request.host, self.proxy_host, self.proxy_port)
+
+    @staticmethod
+    def _is_closed_by_server(connection):
+        '''
+        An idle connection has nothing to read, unless the server closed it.
+        '''
+        if connection.sock is None:
+            return True
+        try:
+            return bool(select.select([connection.sock], [], [], 0)[0])
+        except (select.error, socket.error, ValueError):
+            return True
+
+    def _acquire_connection(self, request, key):
+        '''
+        Returns an idle connection to the host of the request, or a new one,
+        and whether it was reused.
+        '''
+        now = time.time()
+        with self._pool_lock:
+            idle = self._pool.get(key, [])
+            while idle:
+                connection, released_at = idle.pop()
+                if now - released_at < self.max_idle_seconds and \
+                        not self._is_closed_by_server(connection):
+                    self._pool_stats['reused'] += 1
+                    return connection, True
+                connection.close()
+                self._pool_stats['discarded'] += 1
+            self._pool_stats['created'] += 1
+        return self.get_connection(request), False
+
+    def _release_connection(self, key, connection):
+        with self._pool_lock:
+            idle = self._pool.setdefault(key, [])
+            if len(idle) < self.max_idle_connections:
+                idle.append((connection, time.time()))
+                return
+        connection.close()
+
     def send_request_headers(self, connection, request_headers):
         if self.use_httplib:
             if self.proxy_host:
@@ -180,45 +290,79 @@ class _HTTPClient(object):
 
     def perform_request(self, request):
         ''' Sends request to cloud service server and return the response. '''
-        connection = self.get_connection(request)
-        try:
-            connection.putrequest(request.method, request.path)
-
-            if not self.use_httplib:
-                if self.proxy_host and self.proxy_user:
-                    connection.set_proxy_credentials(
-                        self.proxy_user, self.proxy_password)
-
-            self.send_request_headers(connection, request.headers)
-            self.send_request_body(connection, request.body)
-
-            resp = connection.getresponse()
-            self.status = int(resp.status)
-            self.message = resp.reason
-            self.respheader = headers = resp.getheaders()
-
-            # for consistency across platforms, make header names lowercase
-            for i, value in enumerate(headers):
-                headers[i] = (value[0].lower(), value[1])
-
-            respbody = None
-            if resp.length is None:
-                respbody = resp.read()
-            elif resp.length > 0:
-                respbody = resp.read(resp.length)
-
-            response = HTTPResponse(
-                int(resp.status), resp.reason, headers, respbody)
-            if self.status == 307:
-                new_url = urlparse(dict(headers)['location'])
-                request.host = new_url.hostname
-                request.path = new_url.path
-                request.path, request.query = _update_request_uri_query(request)
-                return self.perform_request(request)
-            if self.status >= 300:
-                raise HTTPError(self.status, self.message,
-                                self.respheader, respbody)
-
-            return response
-        finally:
-            connection.close()
+        # winhttp connections are not kept
+        key = self._get_connection_key(request) if self.use_httplib else None
+        retried = False
+        while True:
+            if key is not None:
+                connection, reused = self._acquire_connection(request, key)
+            else:
+                connection, reused = self.get_connection(request), False
+            keep_connection = False
+            try:
+                # A kept connection may have been closed by the server after
+                # it was checked, so try once more on a new one. Once the
+                # request is out, only if sending it again is harmless.
+                sent = False
+                try:
+                    connection.putrequest(request.method, request.path)
+
+                    if not self.use_httplib:
+                        if self.proxy_host and self.proxy_user:
+                            connection.set_proxy_credentials(
+                                self.proxy_user, self.proxy_password)
+
+                    self.send_request_headers(connection, request.headers)
+                    self.send_request_body(connection, request.body)
+                    sent = True
+
+                    resp = connection.getresponse()
+                except (HTTPException, socket.error) as e:
+                    if reused and not retried and \
+                            (not sent or (_is_closed_without_response(e) and
+                                          _is_idempotent(request))):
+                        retried = True
+                        with self._pool_lock:
+                            self._pool_stats['retried'] += 1
+                        continue
+                    raise
+
+                status = int(resp.status)
+                self.status = status
+                self.message = resp.reason
+                self.respheader = headers = resp.getheaders()
+
+                # for consistency across platforms, make header names lowercase
+                for i, value in enumerate(headers):
+                    headers[i] = (value[0].lower(), value[1])
+
+                respbody = None
+                if resp.length is None:
+                    respbody = resp.read()
+                elif resp.length > 0:
+                    respbody = resp.read(resp.length)
+                keep_connection = key is not None and not resp.will_close
+                if keep_connection and not resp.isclosed():
+                    # httplib only finishes an empty response when it is
+                    # read, and the connection can't send the next request
+                    # before.
+                    resp.read()
+
+                response = HTTPResponse(
+                    int(resp.status), resp.reason, headers, respbody)
+                if status == 307:
+                    new_url = urlparse(dict(headers)['location'])
+                    request.host = new_url.hostname
+                    request.path = new_url.path
+                    request.path, request.query = \
+                        _update_request_uri_query(request)
+                    return self.perform_request(request)
+                if status >= 300:
+                    raise HTTPError(status, resp.reason, headers, respbody)
+
+                return response
+            finally:
+                if keep_connection:
+                    self._release_connection(key, connection)
+                else:
+                    connection.close()
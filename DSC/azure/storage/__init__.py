@@ -12,11 +12,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #--------------------------------------------------------------------------
+import json
 import sys
 import types
 
 from datetime import datetime
+from io import BytesIO
 from xml.dom import minidom
+try:
+    from xml.etree import cElementTree as ETree
+except ImportError:
+    from xml.etree import ElementTree as ETree
 from azure import (WindowsAzureData,
                    WindowsAzureError,
                    METADATA_NS,
@@ -28,9 +34,9 @@ from azure import (WindowsAzureData,
                    _fill_data_minidom,
                    _fill_instance_element,
                    _get_child_nodes,
-                   _get_child_nodesNS,
                    _get_children_from_path,
                    _get_entry_properties,
+                   _get_response_continuation,
                    _general_error_handler,
                    _list_of,
                    _parse_response_for_dict,
@@ -42,6 +48,18 @@ from azure import (WindowsAzureData,
 # x-ms-version for storage service.
 X_MS_VERSION = '2012-02-12'
 
+# x-ms-version for table requests accepting JSON, which older versions don't
+# support.
+X_MS_VERSION_JSON = '2013-08-15'
+
+# Formats a table query can ask for in its Accept header.
+TABLE_ACCEPT_ATOM = 'application/atom+xml'
+TABLE_ACCEPT_JSON_NO_METADATA = 'application/json;odata=nometadata'
+TABLE_ACCEPT_JSON_MINIMAL_METADATA = 'application/json;odata=minimalmetadata'
+
+_ATOM_NS_TAG = '{http://www.w3.org/2005/Atom}'
+_METADATA_NS_TAG = '{' + METADATA_NS + '}'
+
 
 class EnumResultsBase(object):
 
@@ -454,8 +472,18 @@ def _update_storage_table_header(request):
             break
     else:
         request.headers.append(('Content-Type', 'application/atom+xml'))
-    request.headers.append(('DataServiceVersion', '2.0;NetFx'))
-    request.headers.append(('MaxDataServiceVersion', '2.0;NetFx'))
+
+    data_service_version = '2.0;NetFx'
+    for name, value in request.headers:
+        if name.lower() == 'accept' and value.startswith('application/json'):
+            # JSON needs a later x-ms-version and OData 3.0
+            request.headers = [
+                (name, X_MS_VERSION_JSON if name == 'x-ms-version' else value)
+                for name, value in request.headers]
+            data_service_version = '3.0;NetFx'
+            break
+    request.headers.append(('DataServiceVersion', data_service_version))
+    request.headers.append(('MaxDataServiceVersion', data_service_version))
     current_time = datetime.utcnow().strftime('%a, %d %b %Y %H:%M:%S GMT')
     request.headers.append(('x-ms-date', current_time))
     request.headers.append(('Date', current_time))
@@ -597,6 +625,10 @@ def _from_entity_int(value):
 def _from_entity_datetime(value):
     format = '%Y-%m-%dT%H:%M:%S'
     if '.' in value:
+        # the service sends up to 7 fractional digits, strptime takes 6
+        seconds, fraction = value.split('.', 1)
+        digits = fraction.rstrip('Z')
+        value = seconds + '.' + digits[:6] + fraction[len(digits):]
         format = format + '.%f'
     if value.endswith('Z'):
         format = format + 'Z'
@@ -766,13 +798,6 @@ def _convert_response_to_block_list(response):
     return blob_block_list
 
 
-def _remove_prefix(name):
-    colon = name.find(':')
-    if colon != -1:
-        return name[colon + 1:]
-    return name
-
-
 def _convert_response_to_entity(response):
     if response is None:
         return response
@@ -807,59 +832,111 @@ def _convert_xml_to_entity(xmlstr):
       </content>
     </entry>
     '''
-    xmldoc = minidom.parseString(xmlstr)
+    for entity in _iter_entities_from_atom(xmlstr):
+        return entity
+    return None
 
-    xml_properties = None
-    for entry in _get_child_nodes(xmldoc, 'entry'):
-        for content in _get_child_nodes(entry, 'content'):
-            # TODO: Namespace
-            xml_properties = _get_child_nodesNS(
-                content, METADATA_NS, 'properties')
 
-    if not xml_properties:
+def _convert_response_to_entities(response):
+    ''' Converts a query response, Atom or JSON, to a list of entities. Like
+    _convert_response_to_feeds, the continuation headers are kept in
+    x_ms_continuation. '''
+    if response is None:
         return None
 
-    entity = Entity()
-    # extract each property node and get the type from attribute and node value
-    for xml_property in xml_properties[0].childNodes:
-        name = _remove_prefix(xml_property.nodeName)
-        # exclude the Timestamp since it is auto added by azure when
-        # inserting entity. We don't want this to mix with real properties
-        if name in ['Timestamp']:
+    entities = _list_of(Entity)
+    x_ms_continuation = _get_response_continuation(response)
+    if x_ms_continuation:
+        setattr(entities, 'x_ms_continuation', x_ms_continuation)
+    entities.extend(_iter_entities_from_response(response))
+    return entities
+
+
+def _iter_entities_from_response(response):
+    ''' Yields the entities of a query response in the format the service
+    answered with. '''
+    for name, value in response.headers:
+        if name == 'content-type' and value.startswith('application/json'):
+            return _iter_entities_from_json(response.body)
+    return _iter_entities_from_atom(response.body)
+
+
+def _iter_entities_from_atom(xmlstr):
+    ''' Yields the entities of an Atom feed, or of a single entry, while the
+    xml is parsed. An entry is converted as soon as its end tag is read and
+    its elements are dropped right after, so no document tree is built and
+    nothing is parsed twice. '''
+    if isinstance(xmlstr, _unicode_type):
+        xmlstr = xmlstr.encode('utf-8')
+
+    for _, element in ETree.iterparse(BytesIO(xmlstr)):
+        if element.tag != _ATOM_NS_TAG + 'entry':
             continue
-
-        if xml_property.firstChild:
-            value = xml_property.firstChild.nodeValue
+        xml_properties = element.find(
+            _ATOM_NS_TAG + 'content/' + _METADATA_NS_TAG + 'properties')
+        entity = None
+        if xml_properties is not None:
+            entity = Entity()
+            for xml_property in xml_properties:
+                isnull = xml_property.get(_METADATA_NS_TAG + 'null')
+                if isnull == 'true':
+                    continue
+                _set_entity_property(
+                    entity,
+                    xml_property.tag[xml_property.tag.find('}') + 1:],
+                    _unicode_type(xml_property.text or ''),
+                    xml_property.get(_METADATA_NS_TAG + 'type'))
+            etag = element.get(_METADATA_NS_TAG + 'etag')
+            if etag:
+                _set_entity_attr(entity, 'etag', _unicode_type(etag))
+        element.clear()
+        if entity is not None:
+            yield entity
+
+
+def _iter_entities_from_json(jsonstr):
+    ''' Yields the entities of a JSON response, the "value" list of a query
+    or a single entity.
+
+    With odata=nometadata there are no types: numbers and booleans come back
+    as such and everything else, Edm.Int64 and Edm.DateTime included, as
+    strings. With odata=minimalmetadata the types JSON can't tell apart are
+    given by "<name>@odata.type" and are converted like the Atom ones. '''
+    if isinstance(jsonstr, bytes):
+        jsonstr = jsonstr.decode('utf-8')
+
+    result = json.loads(jsonstr)
+    for json_entity in result.get('value', [result]):
+        entity = Entity()
+        for name, value in json_entity.items():
+            if value is None or name.startswith('odata.') or '@' in name:
+                continue
+            mtype = json_entity.get(name + '@odata.type')
+            if not isinstance(value, _unicode_type):
+                # already typed by JSON
+                mtype = None
+            _set_entity_property(entity, name, value, mtype)
+        etag = json_entity.get('odata.etag')
+        if etag:
+            _set_entity_attr(entity, 'etag', etag)
+        yield entity
+
+
+def _set_entity_property(entity, name, value, mtype):
+    # exclude the Timestamp since it is auto added by azure when
+    # inserting entity. We don't want this to mix with real properties
+    if name in ['Timestamp']:
+        return
+
+    # if there is no type info, then it is a string and we just need the
+    # str type to hold the property.
+    if mtype:
+        conv = _ENTITY_TO_PYTHON_CONVERSIONS.get(mtype)
+        if conv is not None:
+            value = conv(value)
         else:
-            value = ''
-
-        isnull = xml_property.getAttributeNS(METADATA_NS, 'null')
-        mtype = xml_property.getAttributeNS(METADATA_NS, 'type')
-
-        # if not isnull and no type info, then it is a string and we just
-        # need the str type to hold the property.
-        if not isnull and not mtype:
-            _set_entity_attr(entity, name, value)
-        elif isnull == 'true':
-            if mtype:
-                property = EntityProperty(mtype, None)
-            else:
-                property = EntityProperty('Edm.String', None)
-        else:  # need an object to hold the property
-            conv = _ENTITY_TO_PYTHON_CONVERSIONS.get(mtype)
-            if conv is not None:
-                property = conv(value)
-            else:
-                property = EntityProperty(mtype, value)
-            _set_entity_attr(entity, name, property)
-
-        # extract id, updated and name value from feed entry and set them of
-        # rule.
-    for name, value in _get_entry_properties(xmlstr, True).items():
-        if name in ['etag']:
-            _set_entity_attr(entity, name, value)
-
-    return entity
+            value = EntityProperty(mtype, value)
+    _set_entity_attr(entity, name, value)
 
 
 def _set_entity_attr(entity, name, value):
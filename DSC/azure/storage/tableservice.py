@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #--------------------------------------------------------------------------
+import threading
+
 from azure import (
     WindowsAzureError,
     TABLE_SERVICE_HOST_BASE,
@@ -34,10 +36,11 @@ from azure.http import HTTPRequest
 from azure.http.batchclient import _BatchClient
 from azure.storage import (
     StorageServiceProperties,
+    TABLE_ACCEPT_ATOM,
     _convert_entity_to_xml,
+    _convert_response_to_entities,
     _convert_response_to_entity,
     _convert_table_to_xml,
-    _convert_xml_to_entity,
     _convert_xml_to_table,
     _sign_storage_table_request,
     _update_storage_table_header,
@@ -45,6 +48,46 @@ from azure.storage import (
 from azure.storage.storageclient import _StorageClient
 
 
+def _get_continuation(feeds, name):
+    x_ms_continuation = getattr(feeds, 'x_ms_continuation', None)
+    if not x_ms_continuation:
+        return None
+    try:
+        return x_ms_continuation[name]
+    except KeyError:
+        return None
+
+
+class _PagePrefetch(object):
+
+    '''
+    Requests a page of a query on a thread of its own, so that it is on its
+    way while the previous page is consumed. The service's connection pool
+    gives the request a connection of its own.
+    '''
+
+    def __init__(self, get_page, *args):
+        self.get_page = get_page
+        self.args = args
+        self.page = None
+        self.error = None
+        self.thread = threading.Thread(target=self.worker)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def worker(self):
+        try:
+            self.page = self.get_page(*self.args)
+        except Exception as ex:
+            self.error = ex
+
+    def result(self):
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.page
+
+
 class TableService(_StorageClient):
 
     '''
@@ -233,7 +276,8 @@ class TableService(_StorageClient):
         return _convert_response_to_entity(response)
 
     def query_entities(self, table_name, filter=None, select=None, top=None,
-                       next_partition_key=None, next_row_key=None):
+                       next_partition_key=None, next_row_key=None,
+                       accept=TABLE_ACCEPT_ATOM):
         '''
         Get entities in a table; includes the $filter and $select options.
 
@@ -249,12 +293,21 @@ class TableService(_StorageClient):
         next_row_key:
             Optional. When top is used, the next partition key is stored in
             result.x_ms_continuation['NextRowKey']
+        accept:
+            Optional. Format of the response. TABLE_ACCEPT_JSON_NO_METADATA
+            is the smallest and quickest to parse, but the properties come
+            back untyped: anything that is not a number or a boolean, such
+            as Edm.Int64 and Edm.DateTime, is returned as a string.
+            TABLE_ACCEPT_JSON_MINIMAL_METADATA adds the types JSON can't
+            tell. Defaults to Atom.
         '''
         _validate_not_none('table_name', table_name)
+        _validate_not_none('accept', accept)
         request = HTTPRequest()
         request.method = 'GET'
         request.host = self._get_host()
         request.path = '/' + _str(table_name) + '()'
+        request.headers = [('Accept', _str_or_none(accept))]
         request.query = [
             ('$filter', _str_or_none(filter)),
             ('$select', _str_or_none(select)),
@@ -267,7 +320,69 @@ class TableService(_StorageClient):
         request.headers = _update_storage_table_header(request)
         response = self._perform_request(request)
 
-        return _convert_response_to_feeds(response, _convert_xml_to_entity)
+        return _convert_response_to_entities(response)
+
+    def query_entities_iter(self, table_name, filter=None, select=None,
+                            top=None, page_size=None, accept=TABLE_ACCEPT_ATOM,
+                            prefetch=True):
+        '''
+        Yields the entities of a query, following NextPartitionKey and
+        NextRowKey from page to page until the query is complete. The
+        caller may stop at any time; no page is requested past the one
+        that is being consumed and the next one.
+
+        table_name: Table to query.
+        filter:
+            Optional. Filter as described at
+            http://msdn.microsoft.com/en-us/library/windowsazure/dd894031.aspx
+        select: Optional. Property names to select from the entities.
+        top: Optional. Maximum number of entities to yield in all.
+        page_size:
+            Optional. Maximum number of entities per request, sent as $top.
+            The service returns at most 1000 in any case.
+        accept: Optional. Format of the responses, see query_entities.
+        prefetch:
+            Optional. Requests the next page in the background while the
+            current one is consumed.
+        '''
+        _validate_not_none('table_name', table_name)
+
+        def get_page(next_partition_key, next_row_key, remaining):
+            page_top = page_size
+            if remaining is not None and (page_top is None or
+                                          remaining < page_top):
+                page_top = remaining
+            return self.query_entities(table_name, filter, select, page_top,
+                                       next_partition_key, next_row_key,
+                                       accept)
+
+        remaining = top
+        page = get_page(None, None, remaining)
+        while True:
+            next_partition_key = _get_continuation(page, 'NextPartitionKey')
+            next_row_key = _get_continuation(page, 'NextRowKey')
+            if remaining is not None:
+                if len(page) > remaining:
+                    page = page[:remaining]
+                remaining -= len(page)
+            has_next = next_partition_key is not None and \
+                (remaining is None or remaining > 0)
+
+            next_page = None
+            if has_next and prefetch:
+                next_page = _PagePrefetch(get_page, next_partition_key,
+                                          next_row_key, remaining)
+            for entity in page:
+                yield entity
+            if not has_next:
+                return
+
+            # drop the consumed page before the next one arrives
+            page = None
+            if next_page is not None:
+                page = next_page.result()
+            else:
+                page = get_page(next_partition_key, next_row_key, remaining)
 
     def insert_entity(self, table_name, entity,
                       content_type='application/atom+xml'):
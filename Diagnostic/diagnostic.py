@@ -29,6 +29,7 @@ import xml.dom.minidom
 import xml.etree.ElementTree as ET
 
 # local imports
+import supervisorutil
 import watcherutil
 import Utils.LadDiagnosticUtil as LadUtil
 import Utils.XmlUtil as XmlUtil
@@ -728,25 +729,62 @@ def start_daemon():
         hutil.error("wait daemon start time out")
 
 
-def check_suspected_memory_leak(pid):
-    memory_leak_threshold_in_KB = 2000000  # Roughly 2GB. TODO: Make it configurable or automatically calculated
-    memory_usage_in_KB = 0
-    memory_leak_suspected = False
-
+def get_file_signature(path):
     try:
-        # Check /proc/[pid]/status file for "VmRSS" to find out the process's virtual memory usage
-        # Note: "VmSize" for some reason starts out very high (>2000000) at this moment, so can't use that.
-        with open("/proc/{0}/status".format(pid)) as proc_file:
-            for line in proc_file:
-                if line.startswith("VmRSS:"):  # Example line: "VmRSS:   33904 kB"
-                    memory_usage_in_KB = int(line.split()[1])
-                    memory_leak_suspected = memory_usage_in_KB > memory_leak_threshold_in_KB
-                    break
-    except Exception as e:
-        # Not to throw in case any statement above fails (e.g., invalid pid). Just log.
-        hutil.error("Failed to check memory usage of pid={0}.\nError: {1}\nTrace:\n{2}".format(pid, e, traceback.format_exc()))
+        file_stat = os.stat(path)
+    except OSError:
+        return None
+    return file_stat.st_ino, file_stat.st_size, file_stat.st_mtime
 
-    return memory_leak_suspected, memory_usage_in_KB
+
+def probe_omi_and_signal_mdsd(mdsd, omi_probe_state):
+    """
+    Issue #128 LAD should restart OMI if it crashes.
+    Runs an OMI noop query, restarts OMI if it fails and sends SIGHUP to mdsd once OMI is back
+    (or reinstalled). Returns False if OMI is installed but couldn't be brought back up.
+    """
+    omicli_path = "/opt/omi/bin/omicli"
+    omicli_noop_query_cmd = omicli_path + " noop"
+
+    omi_was_installed = omi_probe_state['installed']   # Remember the OMI install status from the last probe
+    omi_installed = os.path.isfile(omicli_path)
+    omi_probe_state['installed'] = omi_installed
+
+    if omi_was_installed and not omi_installed:
+        hutil.log("OMI is uninstalled. This must have been intentional and externally done. Will no longer check if OMI is up and running.")
+
+    omi_reinstalled = not omi_was_installed and omi_installed
+    if omi_reinstalled:
+        hutil.log("OMI is reinstalled. Will resume checking if OMI is up and running.")
+
+    should_restart_omi = False
+    if omi_installed:
+        cmd_exit_status, cmd_output = RunGetOutput(cmd=omicli_noop_query_cmd, should_log=False)
+        should_restart_omi = cmd_exit_status is not 0
+        if should_restart_omi:
+            hutil.error("OMI noop query failed. Output: " + cmd_output + ". OMI crash suspected. Restarting OMI and sending SIGHUP to mdsd after 5 seconds.")
+            omi_restart_msg = RunGetOutput("/opt/omi/bin/service_control restart")[1]
+            hutil.log("OMI restart result: " + omi_restart_msg)
+            time.sleep(5)
+
+    should_signal_mdsd = should_restart_omi or omi_reinstalled
+    if not should_signal_mdsd:
+        return True
+
+    omi_up_and_running = RunGetOutput(omicli_noop_query_cmd)[0] is 0
+    if omi_up_and_running:
+        mdsd.send_signal(signal.SIGHUP)
+        hutil.log("SIGHUP sent to mdsd")
+        return True
+
+    # OMI restarted but not staying up...
+    log_msg = "OMI restarted but not staying up. Will be restarted at the next probe."
+    hutil.error(log_msg)
+    # Also log this issue on syslog as well
+    syslog.openlog('diagnostic.py', syslog.LOG_PID, syslog.LOG_DAEMON)  # syslog.openlog(ident, logoption, facility) -- not taking kw args in Python 2.6
+    syslog.syslog(syslog.LOG_ALERT, log_msg)    # syslog.syslog(priority, message) -- not taking kw args
+    syslog.closelog()
+    return False
 
 
 def start_mdsd():
@@ -792,6 +830,8 @@ def start_mdsd():
 
     mdsd_log_path = os.path.join(WorkDir,"mdsd.log")
     mdsd_log = None
+    child_waiter = None
+    error_log_watcher = None
     copy_env = os.environ
     copy_env['LD_LIBRARY_PATH']=MdsdFolder
     if 'mdsd_env_vars' in distConfig:
@@ -845,7 +885,20 @@ def start_mdsd():
         threadObj.daemon = True
         threadObj.start()
 
+        mdsd_memory_limit_in_KB = 2000000  # Roughly 2GB. Recycled earlier if the usage is on track to reach it.
+        mdsd_memory_check_interval_in_seconds = 10  # Only reads /proc/[pid]/statm
+        mdsd_err_poll_interval_in_seconds = 10  # Only used where inotify is not available
+        omi_probe_interval_in_seconds = 60
+        omi_probe_max_interval_in_seconds = 600
+        quick_crash_restart_delay_in_seconds = 30
+
         num_quick_consecutive_crashes = 0
+        child_waiter = supervisorutil.ChildEventWaiter()
+        error_log_watcher = supervisorutil.ErrorLogWatcher(monitor_file_path)
+        # The OMI probe forks omicli, so it runs on its own, slower schedule and backs off
+        # while OMI keeps failing to come back up.
+        omi_probe_schedule = supervisorutil.BackoffSchedule(omi_probe_interval_in_seconds, omi_probe_max_interval_in_seconds, time.time())
+        omi_probe_state = {'installed': True}
 
         while num_quick_consecutive_crashes < 3:  # We consider only quick & consecutive crashes for retries
 
@@ -864,82 +917,69 @@ def start_mdsd():
                 pidfile.close()
 
             last_mdsd_start_time = datetime.datetime.now()
-            last_error_time = last_mdsd_start_time
-            omi_installed = True
-            omicli_path = "/opt/omi/bin/omicli"
-            omicli_noop_query_cmd = omicli_path + " noop"
-            # Continuously monitors mdsd process
+            error_log_watcher.skip_existing_content()
+            memory_trend = supervisorutil.MemoryTrendDetector(limit_in_KB=mdsd_memory_limit_in_KB,
+                                                              floor_in_KB=mdsd_memory_limit_in_KB / 2)
+            pid_file_signature = get_file_signature(MDSDPidFile)
+            next_memory_check_time = time.time()
+
+            # Continuously monitors mdsd process. Wakes up as soon as mdsd exits (SIGCHLD) or
+            # writes to mdsd.err, and otherwise when the next memory sample or OMI probe is due.
             while True:
-                time.sleep(30)
-                if " ".join(get_mdsd_process()).find(str(mdsd.pid)) < 0 and len(get_mdsd_process()) >= 2:
-                    mdsd.kill()
-                    hutil.log("Another process is started, now exit")
-                    return
+                wait_until = min(next_memory_check_time, omi_probe_schedule.next_time)
+                if error_log_watcher.fileno() is None:
+                    wait_until = min(wait_until, time.time() + mdsd_err_poll_interval_in_seconds)
+                child_waiter.wait(wait_until - time.time(), [error_log_watcher])
+
                 if mdsd.poll() is not None:     # if mdsd has terminated
-                    time.sleep(60)
                     mdsd_log.flush()
+                    hutil.log("mdsd (pid={0}) exited with code {1}".format(mdsd.pid, mdsd.returncode))
                     break
 
-                # mdsd is now up for at least 30 seconds.
-
-                # Mitigate if memory leak is suspected.
-                mdsd_memory_leak_suspected, mdsd_memory_usage_in_KB = check_suspected_memory_leak(mdsd.pid)
-                if mdsd_memory_leak_suspected:
-                    memory_leak_msg = "Suspected mdsd memory leak (Virtual memory usage: {0}MB). " \
-                                      "Recycling mdsd to self-mitigate.".format(int((mdsd_memory_usage_in_KB+1023)/1024))
-                    hutil.log(memory_leak_msg)
-                    # Add a telemetry for a possible statistical analysis
-                    waagent.AddExtensionEvent(name=hutil.get_name(),
-                                              op=waagent.WALAEventOperation.HeartBeat,
-                                              isSuccess=True,
-                                              version=hutil.get_extension_version(),
-                                              message=memory_leak_msg)
-                    mdsd.kill()
-                    break
-
-                # Issue #128 LAD should restart OMI if it crashes
-                omi_was_installed = omi_installed   # Remember the OMI install status from the last iteration
-                omi_installed = os.path.isfile(omicli_path)
-
-                if omi_was_installed and not omi_installed:
-                    hutil.log("OMI is uninstalled. This must have been intentional and externally done. Will no longer check if OMI is up and running.")
-
-                omi_reinstalled = not omi_was_installed and omi_installed
-                if omi_reinstalled:
-                    hutil.log("OMI is reinstalled. Will resume checking if OMI is up and running.")
-
-                should_restart_omi = False
-                if omi_installed:
-                    cmd_exit_status, cmd_output = RunGetOutput(cmd=omicli_noop_query_cmd, should_log=False)
-                    should_restart_omi = cmd_exit_status is not 0
-                    if should_restart_omi:
-                        hutil.error("OMI noop query failed. Output: " + cmd_output + ". OMI crash suspected. Restarting OMI and sending SIGHUP to mdsd after 5 seconds.")
-                        omi_restart_msg = RunGetOutput("/opt/omi/bin/service_control restart")[1]
-                        hutil.log("OMI restart result: " + omi_restart_msg)
-                        time.sleep(5)
-
-                should_signal_mdsd = should_restart_omi or omi_reinstalled
-                if should_signal_mdsd:
-                    omi_up_and_running = RunGetOutput(omicli_noop_query_cmd)[0] is 0
-                    if omi_up_and_running:
-                        mdsd.send_signal(signal.SIGHUP)
-                        hutil.log("SIGHUP sent to mdsd")
-                    else:   # OMI restarted but not staying up...
-                        log_msg = "OMI restarted but not staying up. Will be restarted in the next iteration."
-                        hutil.error(log_msg)
-                        # Also log this issue on syslog as well
-                        syslog.openlog('diagnostic.py', syslog.LOG_PID, syslog.LOG_DAEMON)  # syslog.openlog(ident, logoption, facility) -- not taking kw args in Python 2.6
-                        syslog.syslog(syslog.LOG_ALERT, log_msg)    # syslog.syslog(priority, message) -- not taking kw args
-                        syslog.closelog()
-
-                if not os.path.exists(monitor_file_path):
-                    continue
-                monitor_file_ctime = datetime.datetime.strptime(time.ctime(int(os.path.getctime(monitor_file_path))), "%a %b %d %H:%M:%S %Y")
-                if last_error_time >= monitor_file_ctime:
-                    continue
-                last_error_time = monitor_file_ctime
-                last_error = tail(monitor_file_path)
-                if len(last_error) > 0 and (datetime.datetime.now() - last_error_time) < datetime.timedelta(minutes=30):
+                # Only another daemon rewrites the pid file, so it's enough to look at the
+                # live processes when it changed.
+                current_pid_file_signature = get_file_signature(MDSDPidFile)
+                if current_pid_file_signature != pid_file_signature:
+                    pid_file_signature = current_pid_file_signature
+                    mdsd_pids = get_mdsd_process()
+                    if " ".join(mdsd_pids).find(str(mdsd.pid)) < 0 and len(mdsd_pids) >= 2:
+                        mdsd.kill()
+                        mdsd.wait()
+                        hutil.log("Another process is started, now exit")
+                        return
+
+                now = time.time()
+                if now >= next_memory_check_time:
+                    next_memory_check_time = now + mdsd_memory_check_interval_in_seconds
+                    mdsd_memory_usage_in_KB = supervisorutil.read_rss_in_KB(mdsd.pid)
+                    if mdsd_memory_usage_in_KB is not None:
+                        memory_trend.add_sample(now, mdsd_memory_usage_in_KB)
+                        # Mitigate if memory leak is suspected.
+                        if memory_trend.is_leak_suspected():
+                            growth_rate = memory_trend.get_growth_rate() or 0
+                            memory_leak_msg = "Suspected mdsd memory leak (Resident memory usage: {0}MB, growing {1}MB/hour). " \
+                                              "Recycling mdsd to self-mitigate.".format(int((mdsd_memory_usage_in_KB+1023)/1024),
+                                                                                        int(growth_rate*3600/1024))
+                            hutil.log(memory_leak_msg)
+                            # Add a telemetry for a possible statistical analysis
+                            waagent.AddExtensionEvent(name=hutil.get_name(),
+                                                      op=waagent.WALAEventOperation.HeartBeat,
+                                                      isSuccess=True,
+                                                      version=hutil.get_extension_version(),
+                                                      message=memory_leak_msg)
+                            mdsd.kill()
+                            mdsd.wait()
+                            break
+
+                if omi_probe_schedule.is_due(now):
+                    if probe_omi_and_signal_mdsd(mdsd, omi_probe_state):
+                        omi_probe_schedule.succeeded(time.time())
+                    else:
+                        omi_probe_schedule.failed(time.time())
+
+                last_error = error_log_watcher.get_new_content()
+                if len(last_error) > 0:
+                    last_error_time = datetime.datetime.now()
                     hutil.log("Error in MDSD:"+last_error)
                     hutil.do_status_report(ExtensionOperationType, "success", '1', "message in /var/log/mdsd.err:"+str(last_error_time)+":"+last_error)
 
@@ -967,6 +1007,11 @@ def start_mdsd():
             # Needs to reset rsyslog omazurelinuxmds config before retrying mdsd
             install_rsyslogom()
 
+            # The crash is noticed right away, so give whatever made mdsd crash some time
+            # before the next attempt, more after each consecutive quick crash.
+            if num_quick_consecutive_crashes < 3:
+                time.sleep(quick_crash_restart_delay_in_seconds * num_quick_consecutive_crashes)
+
         # mdsd all 3 allowed quick/consecutive crashes exhausted
         hutil.do_status_report(ExtensionOperationType, "error", '1', "mdsd stopped:"+error)
 
@@ -993,6 +1038,10 @@ def start_mdsd():
     finally:
         if mdsd_log:
             mdsd_log.close()
+        if child_waiter:
+            child_waiter.close()
+        if error_log_watcher:
+            error_log_watcher.close()
 
 
 def stop_mdsd():
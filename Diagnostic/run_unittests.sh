@@ -3,4 +3,4 @@
 
 python -m tests.watchertests
 python -m tests.test_commonActions
-
+python -m tests.test_supervisorutil
@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+#
+# Azure Linux extension
+#
+# Linux Azure Diagnostic Extension (Current version is specified in manifest.xml)
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+# MIT License
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the ""Software""), to deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+# Software.
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Building blocks of the mdsd supervision loop in diagnostic.py: waking up on SIGCHLD,
+following mdsd.err, watching the memory usage of mdsd and spacing out the OMI probes.
+"""
+
+import collections
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+import select
+import signal
+import string
+import struct
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+
+_inotify_event = struct.Struct('iIII')
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    _inotify_init = _libc.inotify_init
+    _inotify_add_watch = _libc.inotify_add_watch
+    _inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+except (OSError, AttributeError):
+    _inotify_init = None
+    _inotify_add_watch = None
+
+
+def set_nonblocking_and_cloexec(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+
+def read_rss_in_KB(pid):
+    """
+    The resident set size of the process from /proc/[pid]/statm, or None if the process is gone.
+    Note: VmSize starts out very high (>2GB) for mdsd, so the resident size is used.
+    """
+    try:
+        with open('/proc/{0}/statm'.format(pid)) as statm_file:
+            resident_pages = int(statm_file.read().split()[1])
+    except (IOError, IndexError, ValueError):
+        return None
+    return resident_pages * (os.sysconf('SC_PAGE_SIZE') / 1024)
+
+
+class ChildEventWaiter:
+    """
+    Sleeps until a child process changes state (SIGCHLD), one of the given watchers
+    has something to read, or the timeout expires. SIGCHLD reaches the sleeping select
+    through a self-pipe registered with signal.set_wakeup_fd, so a crashed child is
+    noticed right away instead of at the next polling interval. The wakeup fd can only be
+    set from the main thread; anywhere else this degrades to a plain sleep.
+    """
+
+    def __init__(self):
+        self._read_fd = None
+        self._write_fd = None
+        self._previous_handler = None
+        self._previous_wakeup_fd = -1
+        try:
+            read_fd, write_fd = os.pipe()
+            set_nonblocking_and_cloexec(read_fd)
+            set_nonblocking_and_cloexec(write_fd)
+            self._previous_wakeup_fd = signal.set_wakeup_fd(write_fd)
+        except ValueError:  # Not the main thread
+            os.close(read_fd)
+            os.close(write_fd)
+            return
+        self._read_fd = read_fd
+        self._write_fd = write_fd
+        # The handler itself does nothing. It has to be installed, as the default disposition
+        # of SIGCHLD discards the signal without waking up the wakeup fd. Interrupted reads
+        # and writes elsewhere in the daemon are restarted.
+        self._previous_handler = signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.siginterrupt(signal.SIGCHLD, False)
+
+    def wait(self, timeout, watchers=()):
+        """
+        Returns the watchers whose fd became readable. The caller checks its children itself
+        (Popen.poll) after every return, whatever the reason for waking up was.
+        """
+        read_fds = [watcher.fileno() for watcher in watchers if watcher.fileno() is not None]
+        if self._read_fd is not None:
+            read_fds.append(self._read_fd)
+        try:
+            readable = select.select(read_fds, [], [], max(0, timeout))[0]
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            readable = []
+        if self._read_fd in readable:
+            self._drain()
+        return [watcher for watcher in watchers if watcher.fileno() in readable]
+
+    def _drain(self):
+        try:
+            while os.read(self._read_fd, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def close(self):
+        if self._read_fd is None:
+            return
+        signal.signal(signal.SIGCHLD, self._previous_handler)
+        signal.set_wakeup_fd(self._previous_wakeup_fd)
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+        self._read_fd = None
+        self._write_fd = None
+
+
+class ErrorLogWatcher:
+    """
+    Follows a log file that is appended to (mdsd.err) and returns only what was written
+    since the last look. Changes are noticed through inotify on the file's directory, so
+    the file may be created, truncated or replaced at any time. Without inotify every
+    call to get_new_content() compares the file's stat instead.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._name = os.path.basename(path)
+        self._fd = None
+        self._changed = True
+        self._signature = None
+        self._inode = None
+        self._offset = 0
+        if _inotify_init is not None:
+            fd = _inotify_init()
+            if fd >= 0:
+                set_nonblocking_and_cloexec(fd)
+                mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+                if _inotify_add_watch(fd, os.path.dirname(path) or '.', mask) >= 0:
+                    self._fd = fd
+                else:
+                    os.close(fd)
+
+    def fileno(self):
+        """
+        The inotify fd to wait on, or None when falling back to polling.
+        """
+        return self._fd
+
+    def _stat(self):
+        try:
+            return os.stat(self.path)
+        except OSError:
+            return None
+
+    def skip_existing_content(self):
+        """
+        Only content written after this call is returned, e.g. what a freshly started mdsd writes.
+        """
+        self._read_events()
+        file_stat = self._stat()
+        self._inode = file_stat.st_ino if file_stat else None
+        self._offset = file_stat.st_size if file_stat else 0
+        self._signature = self._get_signature(file_stat)
+        self._changed = False
+
+    @staticmethod
+    def _get_signature(file_stat):
+        if file_stat is None:
+            return None
+        return file_stat.st_ino, file_stat.st_size, file_stat.st_mtime
+
+    def _read_events(self):
+        if self._fd is None:
+            return
+        data = ''
+        try:
+            while True:
+                chunk = os.read(self._fd, 4096)
+                if not chunk:
+                    break
+                data += chunk
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+        position = 0
+        while position + _inotify_event.size <= len(data):
+            wd, mask, cookie, name_length = _inotify_event.unpack_from(data, position)
+            position += _inotify_event.size
+            name = data[position:position + name_length].rstrip('\0')
+            position += name_length
+            if name == self._name or mask & IN_Q_OVERFLOW:
+                self._changed = True
+
+    def get_new_content(self, max_size=1024):
+        """
+        The printable part of at most the last max_size bytes written since the previous
+        call, or '' if nothing was written.
+        """
+        if self._fd is not None:
+            self._read_events()
+            if not self._changed:
+                return ''
+            self._changed = False
+            file_stat = self._stat()
+        else:
+            file_stat = self._stat()
+            signature = self._get_signature(file_stat)
+            if signature == self._signature:
+                return ''
+            self._signature = signature
+
+        if file_stat is None:
+            self._inode = None
+            self._offset = 0
+            return ''
+        if file_stat.st_ino != self._inode or file_stat.st_size < self._offset:
+            # Replaced or truncated, so everything in it is new.
+            self._inode = file_stat.st_ino
+            self._offset = 0
+        if file_stat.st_size == self._offset:
+            return ''
+
+        start = max(self._offset, file_stat.st_size - max_size)
+        try:
+            with open(self.path, 'r') as log_file:
+                log_file.seek(start)
+                content = log_file.read(file_stat.st_size - start)
+        except IOError:
+            return ''
+        self._offset = file_stat.st_size
+        return filter(lambda x: x in string.printable, content).decode('ascii', 'ignore')
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class MemoryTrendDetector:
+    """
+    Suspects a memory leak when the resident size reaches limit_in_KB, or, once it is above
+    floor_in_KB, when the growth rate over the last window_in_seconds would take it to the
+    limit within horizon_in_seconds. The rate is a least squares fit over the samples of the
+    window and is only trusted once they span min_span_in_seconds, so a single spike does
+    not recycle mdsd but a steady or runaway growth is acted upon well before the limit.
+    """
+
+    def __init__(self, limit_in_KB=2000000, floor_in_KB=1000000, window_in_seconds=1800,
+                 horizon_in_seconds=1800, min_span_in_seconds=120):
+        self.limit_in_KB = limit_in_KB
+        self.floor_in_KB = floor_in_KB
+        self.window_in_seconds = window_in_seconds
+        self.horizon_in_seconds = horizon_in_seconds
+        self.min_span_in_seconds = min_span_in_seconds
+        self.samples = collections.deque()
+
+    def add_sample(self, timestamp, rss_in_KB):
+        self.samples.append((timestamp, rss_in_KB))
+        while self.samples and self.samples[0][0] < timestamp - self.window_in_seconds:
+            self.samples.popleft()
+
+    def get_last_rss_in_KB(self):
+        if not self.samples:
+            return 0
+        return self.samples[-1][1]
+
+    def get_growth_rate(self):
+        """
+        KB per second over the window, or None if the samples don't span long enough yet.
+        """
+        if len(self.samples) < 3 or self.samples[-1][0] - self.samples[0][0] < self.min_span_in_seconds:
+            return None
+        count = float(len(self.samples))
+        mean_time = sum(t for t, rss in self.samples) / count
+        mean_rss = sum(rss for t, rss in self.samples) / count
+        covariance = sum((t - mean_time) * (rss - mean_rss) for t, rss in self.samples)
+        variance = sum((t - mean_time) ** 2 for t, rss in self.samples)
+        if variance == 0:
+            return None
+        return covariance / variance
+
+    def is_leak_suspected(self):
+        rss_in_KB = self.get_last_rss_in_KB()
+        if rss_in_KB >= self.limit_in_KB:
+            return True
+        if rss_in_KB < self.floor_in_KB:
+            return False
+        growth_rate = self.get_growth_rate()
+        if growth_rate is None or growth_rate <= 0:
+            return False
+        return (self.limit_in_KB - rss_in_KB) / growth_rate <= self.horizon_in_seconds
+
+
+class BackoffSchedule:
+    """
+    Tells when a periodic check is due: every interval_in_seconds while it succeeds, and
+    with the interval doubled after each consecutive failure, up to max_interval_in_seconds.
+    """
+
+    def __init__(self, interval_in_seconds, max_interval_in_seconds, now):
+        self.interval_in_seconds = interval_in_seconds
+        self.max_interval_in_seconds = max_interval_in_seconds
+        self.current_interval_in_seconds = interval_in_seconds
+        self.next_time = now + interval_in_seconds
+
+    def is_due(self, now):
+        return now >= self.next_time
+
+    def succeeded(self, now):
+        self.current_interval_in_seconds = self.interval_in_seconds
+        self.next_time = now + self.current_interval_in_seconds
+
+    def failed(self, now):
+        self.next_time = now + self.current_interval_in_seconds
+        self.current_interval_in_seconds = min(self.current_interval_in_seconds * 2, self.max_interval_in_seconds)
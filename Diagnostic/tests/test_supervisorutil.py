@@ -0,0 +1,146 @@
+import unittest
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import supervisorutil
+
+
+class TestMemoryTrendDetector(unittest.TestCase):
+
+    def test_hard_limit(self):
+        detector = supervisorutil.MemoryTrendDetector(limit_in_KB=1000, floor_in_KB=500)
+        detector.add_sample(0, 999)
+        self.assertFalse(detector.is_leak_suspected())
+        detector.add_sample(10, 1000)
+        self.assertTrue(detector.is_leak_suspected())
+
+    def test_steady_growth_before_limit(self):
+        detector = supervisorutil.MemoryTrendDetector(limit_in_KB=2000000, floor_in_KB=1000000,
+                                                      horizon_in_seconds=1800, min_span_in_seconds=120)
+        # 1GB growing 100MB a minute reaches 2GB in about 10 minutes
+        for i in range(13):
+            detector.add_sample(i * 10, 1000000 + i * 10 * 1700)
+        self.assertTrue(detector.get_growth_rate() > 1000)
+        self.assertTrue(detector.is_leak_suspected())
+
+    def test_too_short_span_is_not_trusted(self):
+        detector = supervisorutil.MemoryTrendDetector(limit_in_KB=2000000, floor_in_KB=1000000, min_span_in_seconds=120)
+        for i in range(5):
+            detector.add_sample(i * 10, 1000000 + i * 100000)
+        self.assertEqual(detector.get_growth_rate(), None)
+        self.assertFalse(detector.is_leak_suspected())
+
+    def test_below_floor_or_flat(self):
+        detector = supervisorutil.MemoryTrendDetector(limit_in_KB=2000000, floor_in_KB=1000000)
+        for i in range(20):
+            detector.add_sample(i * 10, 100000 + i * 10000)
+        self.assertFalse(detector.is_leak_suspected())
+        detector = supervisorutil.MemoryTrendDetector(limit_in_KB=2000000, floor_in_KB=1000000)
+        for i in range(20):
+            detector.add_sample(i * 10, 1500000 + (i % 2) * 1000)
+        self.assertFalse(detector.is_leak_suspected())
+
+    def test_window(self):
+        detector = supervisorutil.MemoryTrendDetector(window_in_seconds=100)
+        for i in range(20):
+            detector.add_sample(i * 10, 1000)
+        self.assertEqual(len(detector.samples), 11)
+
+    def test_read_rss(self):
+        self.assertTrue(supervisorutil.read_rss_in_KB(os.getpid()) > 0)
+
+
+class TestErrorLogWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, 'mdsd.err')
+        with open(self._path, 'w') as f:
+            f.write('old error\n')
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def append(self, content):
+        with open(self._path, 'a') as f:
+            f.write(content)
+
+    def check_watcher(self, watcher):
+        watcher.skip_existing_content()
+        self.assertEqual(watcher.get_new_content(), '')
+        self.append('new error\n')
+        self.assertEqual(watcher.get_new_content(), 'new error\n')
+        self.assertEqual(watcher.get_new_content(), '')
+        self.append('x' * 2000)
+        self.assertEqual(watcher.get_new_content(max_size=10), 'x' * 10)
+        with open(self._path, 'w') as f:
+            f.write('after truncation\n')
+        self.assertEqual(watcher.get_new_content(), 'after truncation\n')
+        os.remove(self._path)
+        self.assertEqual(watcher.get_new_content(), '')
+        self.append('recreated\n')
+        self.assertEqual(watcher.get_new_content(), 'recreated\n')
+        watcher.close()
+
+    def test_inotify(self):
+        watcher = supervisorutil.ErrorLogWatcher(self._path)
+        self.assertNotEqual(watcher.fileno(), None)
+        self.check_watcher(watcher)
+
+    def test_polling(self):
+        watcher = supervisorutil.ErrorLogWatcher(self._path)
+        watcher.close()
+        self.assertEqual(watcher.fileno(), None)
+        self.check_watcher(watcher)
+
+    def test_wait_wakes_up_on_write(self):
+        watcher = supervisorutil.ErrorLogWatcher(self._path)
+        watcher.skip_existing_content()
+        waiter = supervisorutil.ChildEventWaiter()
+        try:
+            self.assertEqual(waiter.wait(0, [watcher]), [])
+            self.append('new error\n')
+            self.assertEqual(waiter.wait(5, [watcher]), [watcher])
+            self.assertEqual(watcher.get_new_content(), 'new error\n')
+        finally:
+            waiter.close()
+            watcher.close()
+
+
+class TestChildEventWaiter(unittest.TestCase):
+
+    def test_wakes_up_on_child_exit(self):
+        waiter = supervisorutil.ChildEventWaiter()
+        try:
+            child = subprocess.Popen(['sleep', '0.2'])
+            start = time.time()
+            while child.poll() is None:
+                waiter.wait(10)
+            self.assertTrue(time.time() - start < 5)
+        finally:
+            waiter.close()
+
+
+class TestBackoffSchedule(unittest.TestCase):
+
+    def test_backoff(self):
+        schedule = supervisorutil.BackoffSchedule(60, 300, 0)
+        self.assertFalse(schedule.is_due(59))
+        self.assertTrue(schedule.is_due(60))
+        schedule.failed(60)
+        self.assertEqual(schedule.next_time, 120)
+        schedule.failed(120)
+        self.assertEqual(schedule.next_time, 240)
+        schedule.failed(240)
+        schedule.failed(480)
+        self.assertEqual(schedule.next_time, 780)
+        schedule.failed(780)
+        self.assertEqual(schedule.next_time, 1080)
+        schedule.succeeded(1080)
+        self.assertEqual(schedule.next_time, 1140)
+
+
+if __name__ == '__main__':
+    unittest.main()
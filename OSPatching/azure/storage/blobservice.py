@@ -14,10 +14,12 @@
 #--------------------------------------------------------------------------
 from azure import (
     WindowsAzureError,
+    WindowsAzureMissingResourceError,
     BLOB_SERVICE_HOST_BASE,
     DEV_BLOB_HOST,
     _ERROR_VALUE_NEGATIVE,
     _ERROR_PAGE_BLOB_SIZE_ALIGNMENT,
+    _ERROR_BLOB_RANGE_MD5_MISMATCH,
     _convert_class_to_xml,
     _dont_fail_not_exist,
     _dont_fail_on_exist,
@@ -37,7 +39,7 @@ from azure import (
     _validate_type_bytes,
     _validate_not_none,
     )
-from azure.http import HTTPRequest
+from azure.http import HTTPError, HTTPRequest
 from azure.storage import (
     Container,
     ContainerEnumResults,
@@ -50,18 +52,281 @@ from azure.storage import (
     _create_blob_result,
     _parse_blob_enum_results_list,
     _update_storage_blob_header,
+    _storage_error_handler,
     )
 from azure.storage.storageclient import _StorageClient
 from os import path
+import base64
+import hashlib
+import os
 import sys
+import threading
+import time
 if sys.version_info >= (3,):
     from io import BytesIO
+    from http.client import HTTPException
+    from queue import Queue, Empty
 else:
     from cStringIO import StringIO as BytesIO
+    from httplib import HTTPException
+    from Queue import Queue, Empty
 
 # Keep this value sync with _ERROR_PAGE_BLOB_SIZE_ALIGNMENT
 _PAGE_SIZE = 512
 
+
+def _is_random_access_stream(stream):
+    ''' Whether the ranges of a blob can be written at their offsets. '''
+    if 'a' in getattr(stream, 'mode', ''):
+        # appending ignores the position
+        return False
+    if hasattr(stream, 'seekable'):
+        try:
+            return stream.seekable()
+        except (IOError, OSError, ValueError):
+            return False
+    try:
+        stream.tell()
+        return True
+    except (AttributeError, IOError, OSError):
+        return False
+
+
+def _get_stream_fileno(stream):
+    try:
+        return stream.fileno()
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+
+
+def _get_blob_size_from_content_range(response, default_size):
+    ''' Reads the blob size from a Content-Range like "bytes 0-1023/4096". '''
+    for name, value in response.headers:
+        if name == 'content-range' and '/' in value:
+            return int(value.rpartition('/')[2])
+    return default_size
+
+
+def _content_md5_matches(response):
+    for name, value in response.headers:
+        if name == 'content-md5':
+            md5 = base64.b64encode(hashlib.md5(response.body or b'').digest())
+            return md5.decode('utf-8') == value
+    # the service only sends it for ranges of up to 4 MB
+    return True
+
+
+class _BlobChunkDownloader(object):
+
+    '''
+    Downloads ranges of a blob with a bounded pool of worker threads, which
+    reuse the kept connections of the service, and writes every range at its
+    offset of the stream as soon as it arrives.
+    '''
+
+    def __init__(self, blob_service, container_name, blob_name, snapshot,
+                 x_ms_lease_id, blob_size, chunk_size, stream, stream_start,
+                 transferred, verify_content_md5, max_retries, retry_wait,
+                 progress_callback):
+        self.blob_service = blob_service
+        self.container_name = container_name
+        self.blob_name = blob_name
+        self.snapshot = snapshot
+        self.x_ms_lease_id = x_ms_lease_id
+        self.blob_size = blob_size
+        self.chunk_size = chunk_size
+        self.stream = stream
+        self.stream_start = stream_start
+        self.transferred = transferred
+        self.verify_content_md5 = verify_content_md5
+        self.max_retries = max_retries
+        self.retry_wait = retry_wait
+        self.progress_callback = progress_callback
+        self.progress_lock = threading.Lock()
+        self.stream_lock = threading.Lock()
+        self.errors = []
+
+        # Preallocate the file, so the ranges are written into place
+        # instead of growing it out of order.
+        self.fd = _get_stream_fileno(stream)
+        if self.fd is not None:
+            stream.flush()
+            end = stream_start + blob_size
+            if os.fstat(self.fd).st_size < end:
+                os.ftruncate(self.fd, end)
+            if not hasattr(os, 'pwrite'):
+                self.fd = None
+
+    def write_chunk(self, offset, data):
+        position = self.stream_start + offset
+        if self.fd is not None:
+            view = memoryview(data)
+            while len(view):
+                written = os.pwrite(self.fd, view, position)
+                view = view[written:]
+                position += written
+        else:
+            with self.stream_lock:
+                self.stream.seek(position)
+                self.stream.write(data)
+
+    def process_chunk(self, offset):
+        end = min(offset + self.chunk_size, self.blob_size) - 1
+        response = self.blob_service._get_blob_range(
+            self.container_name, self.blob_name, self.snapshot,
+            self.x_ms_lease_id, offset, end, self.verify_content_md5,
+            self.max_retries, self.retry_wait)
+        data = response.body or b''
+        self.write_chunk(offset, data)
+        with self.progress_lock:
+            self.transferred += len(data)
+            if self.progress_callback:
+                self.progress_callback(self.transferred, self.blob_size)
+
+    def worker(self, offsets):
+        while not self.errors:
+            try:
+                offset = offsets.get_nowait()
+            except Empty:
+                return
+            try:
+                self.process_chunk(offset)
+            except Exception as ex:
+                self.errors.append(ex)
+
+    def run(self, chunk_offsets, max_connections):
+        '''
+        Downloads the chunks starting at chunk_offsets. After an error no new
+        chunk is started and the error is raised once the running ones end.
+        '''
+        offsets = Queue()
+        for offset in chunk_offsets:
+            offsets.put(offset)
+
+        threads = []
+        for _ in range(min(max_connections, len(chunk_offsets))):
+            thread = threading.Thread(target=self.worker, args=(offsets,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        if self.errors:
+            raise self.errors[0]
+        self.stream.seek(self.stream_start + self.blob_size)
+
+
+class _BlobChunkUploader(object):
+
+    '''
+    Reads a stream block by block and uploads the blocks with a bounded pool
+    of worker threads, which reuse the kept connections of the service.
+    At most max_connections blocks more than are being uploaded are read
+    ahead, which bounds the memory used. Block ids are made of the index and
+    the MD5 of the block, so the list stays in order and an upload of the
+    same content can recognize the blocks that are already there.
+    '''
+
+    def __init__(self, blob_service, container_name, blob_name,
+                 x_ms_lease_id, count, block_size, max_connections,
+                 max_retries, retry_wait, progress_callback):
+        self.blob_service = blob_service
+        self.container_name = container_name
+        self.blob_name = blob_name
+        self.x_ms_lease_id = x_ms_lease_id
+        self.count = count
+        self.block_size = block_size
+        self.max_connections = max(1, max_connections)
+        self.max_in_flight_bytes = 2 * self.max_connections * block_size
+        self.max_retries = max_retries
+        self.retry_wait = retry_wait
+        self.progress_callback = progress_callback
+        self.condition = threading.Condition()
+        self.in_flight_bytes = 0
+        self.transferred = 0
+        self.errors = []
+
+    def add_progress(self, length):
+        # called with the condition held
+        self.transferred += length
+        if self.progress_callback:
+            self.progress_callback(self.transferred, self.count)
+
+    def worker(self, blocks):
+        while True:
+            block = blocks.get()
+            if block is None:
+                return
+            block_id, data, block_md5 = block
+            if not self.errors:
+                try:
+                    self.blob_service._put_block_with_retries(
+                        self.container_name, self.blob_name, data,
+                        block_id, block_md5, self.x_ms_lease_id,
+                        self.max_retries, self.retry_wait)
+                except Exception as ex:
+                    self.errors.append(ex)
+            with self.condition:
+                self.in_flight_bytes -= len(data)
+                if not self.errors:
+                    self.add_progress(len(data))
+                self.condition.notify_all()
+
+    def run(self, stream, uploaded_blocks):
+        '''
+        Uploads the content of the stream, skipping the blocks found with the
+        same id and size in uploaded_blocks. Returns the ids of all the blocks
+        in order and the base64 MD5 of the whole content.
+        '''
+        blocks = Queue()
+        threads = []
+        for _ in range(self.max_connections):
+            thread = threading.Thread(target=self.worker, args=(blocks,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        blob_md5 = hashlib.md5()
+        block_ids = []
+        remain_bytes = self.count
+        try:
+            while not self.errors:
+                request_count = self.block_size if remain_bytes is None \
+                    else min(remain_bytes, self.block_size)
+                data = stream.read(request_count) if request_count else None
+                if not data:
+                    break
+                if remain_bytes is not None:
+                    remain_bytes -= len(data)
+
+                blob_md5.update(data)
+                block_md5 = hashlib.md5(data)
+                block_id = '{0:08d}-{1}'.format(len(block_ids),
+                                                block_md5.hexdigest())
+                block_ids.append(block_id)
+
+                with self.condition:
+                    if uploaded_blocks.get(block_id) == len(data):
+                        self.add_progress(len(data))
+                        continue
+                    while self.in_flight_bytes > 0 and not self.errors and \
+                            self.in_flight_bytes + len(data) > \
+                            self.max_in_flight_bytes:
+                        self.condition.wait()
+                    self.in_flight_bytes += len(data)
+                blocks.put((block_id, data,
+                            _encode_base64(block_md5.digest())))
+        finally:
+            for _ in threads:
+                blocks.put(None)
+            for thread in threads:
+                thread.join()
+
+        if self.errors:
+            raise self.errors[0]
+        return block_ids, _encode_base64(blob_md5.digest())
+
 class BlobService(_StorageClient):
 
     '''
@@ -701,7 +966,9 @@ class BlobService(_StorageClient):
                                  x_ms_blob_content_md5=None,
                                  x_ms_blob_cache_control=None,
                                  x_ms_meta_name_values=None,
-                                 x_ms_lease_id=None, progress_callback=None):
+                                 x_ms_lease_id=None, progress_callback=None,
+                                 max_connections=4, max_retries=5, retry_wait=1.0,
+                                 resume=False):
         '''
         Creates a new block blob from a file path, or updates the content of an
         existing block blob, with automatic chunking and progress notifications.
@@ -736,6 +1003,16 @@ class BlobService(_StorageClient):
             Callback for progress with signature function(current, total) where
             current is the number of bytes transfered so far, and total is the
             size of the blob, or None if the total size is unknown.
+        max_connections:
+            Maximum number of blocks uploaded at the same time, when the blob
+            is uploaded in blocks.
+        max_retries:
+            Number of times a block is retried after a connection error or a
+            server error.
+        retry_wait: Seconds to wait before the first retry, growing linearly.
+        resume:
+            Optional. Skips the blocks that a previous, failed upload of the
+            same content to this blob has already uploaded.
         '''
         _validate_not_none('container_name', container_name)
         _validate_not_none('blob_name', blob_name)
@@ -758,7 +1035,11 @@ class BlobService(_StorageClient):
                                           x_ms_blob_cache_control,
                                           x_ms_meta_name_values,
                                           x_ms_lease_id,
-                                          progress_callback)
+                                          progress_callback,
+                                          max_connections,
+                                          max_retries,
+                                          retry_wait,
+                                          resume)
 
     def put_block_blob_from_file(self, container_name, blob_name, stream,
                                  count=None, content_encoding=None,
@@ -770,7 +1051,9 @@ class BlobService(_StorageClient):
                                  x_ms_blob_content_md5=None,
                                  x_ms_blob_cache_control=None,
                                  x_ms_meta_name_values=None,
-                                 x_ms_lease_id=None, progress_callback=None):
+                                 x_ms_lease_id=None, progress_callback=None,
+                                 max_connections=4, max_retries=5, retry_wait=1.0,
+                                 resume=False):
         '''
         Creates a new block blob from a file/stream, or updates the content of
         an existing block blob, with automatic chunking and progress
@@ -809,6 +1092,16 @@ class BlobService(_StorageClient):
             Callback for progress with signature function(current, total) where
             current is the number of bytes transfered so far, and total is the
             size of the blob, or None if the total size is unknown.
+        max_connections:
+            Maximum number of blocks uploaded at the same time, when the blob
+            is uploaded in blocks.
+        max_retries:
+            Number of times a block is retried after a connection error or a
+            server error.
+        retry_wait: Seconds to wait before the first retry, growing linearly.
+        resume:
+            Optional. Skips the blocks that a previous, failed upload of the
+            same content to this blob has already uploaded.
         '''
         _validate_not_none('container_name', container_name)
         _validate_not_none('blob_name', blob_name)
@@ -841,53 +1134,32 @@ class BlobService(_StorageClient):
             if progress_callback:
                 progress_callback(0, count)
 
-            self.put_blob(container_name,
-                          blob_name,
-                          None,
-                          'BlockBlob',
-                          content_encoding,
-                          content_language,
-                          content_md5,
-                          cache_control,
-                          x_ms_blob_content_type,
-                          x_ms_blob_content_encoding,
-                          x_ms_blob_content_language,
-                          x_ms_blob_content_md5,
-                          x_ms_blob_cache_control,
-                          x_ms_meta_name_values,
-                          x_ms_lease_id)
-
-            remain_bytes = count
-            block_ids = []
-            block_index = 0
-            index = 0
-            while True:
-                request_count = self._BLOB_MAX_CHUNK_DATA_SIZE\
-                    if remain_bytes is None else min(
-                        remain_bytes,
-                        self._BLOB_MAX_CHUNK_DATA_SIZE)
-                data = stream.read(request_count)
-                if data:
-                    length = len(data)
-                    index += length
-                    remain_bytes = remain_bytes - \
-                        length if remain_bytes else None
-                    block_id = '{0:08d}'.format(block_index)
-                    self.put_block(container_name, blob_name,
-                                   data, block_id, x_ms_lease_id=x_ms_lease_id)
-                    block_ids.append(block_id)
-                    block_index += 1
-                    if progress_callback:
-                        progress_callback(index, count)
-                else:
-                    break
+            # Without an empty put_blob first, the blocks of a failed upload
+            # stay around for a resumed one.
+            uploaded_blocks = {}
+            if resume:
+                try:
+                    block_list = self.get_block_list(
+                        container_name, blob_name, blocklisttype='all',
+                        x_ms_lease_id=x_ms_lease_id)
+                    for block in block_list.committed_blocks + \
+                            block_list.uncommitted_blocks:
+                        uploaded_blocks[block.id] = block.size
+                except WindowsAzureMissingResourceError:
+                    pass
+
+            uploader = _BlobChunkUploader(
+                self, container_name, blob_name, x_ms_lease_id, count,
+                self._BLOB_MAX_CHUNK_DATA_SIZE, max_connections, max_retries,
+                retry_wait, progress_callback)
+            block_ids, blob_md5 = uploader.run(stream, uploaded_blocks)
 
             self.put_block_list(container_name, blob_name, block_ids,
                                 content_md5, x_ms_blob_cache_control,
                                 x_ms_blob_content_type,
                                 x_ms_blob_content_encoding,
                                 x_ms_blob_content_language,
-                                x_ms_blob_content_md5,
+                                x_ms_blob_content_md5 or blob_md5,
                                 x_ms_meta_name_values,
                                 x_ms_lease_id)
 
@@ -901,7 +1173,9 @@ class BlobService(_StorageClient):
                                   x_ms_blob_content_md5=None,
                                   x_ms_blob_cache_control=None,
                                   x_ms_meta_name_values=None,
-                                  x_ms_lease_id=None, progress_callback=None):
+                                  x_ms_lease_id=None, progress_callback=None,
+                                  max_connections=4, max_retries=5, retry_wait=1.0,
+                                  resume=False):
         '''
         Creates a new block blob from an array of bytes, or updates the content
         of an existing block blob, with automatic chunking and progress
@@ -941,6 +1215,16 @@ class BlobService(_StorageClient):
             Callback for progress with signature function(current, total) where
             current is the number of bytes transfered so far, and total is the
             size of the blob, or None if the total size is unknown.
+        max_connections:
+            Maximum number of blocks uploaded at the same time, when the blob
+            is uploaded in blocks.
+        max_retries:
+            Number of times a block is retried after a connection error or a
+            server error.
+        retry_wait: Seconds to wait before the first retry, growing linearly.
+        resume:
+            Optional. Skips the blocks that a previous, failed upload of the
+            same content to this blob has already uploaded.
         '''
         _validate_not_none('container_name', container_name)
         _validate_not_none('blob_name', blob_name)
@@ -996,7 +1280,11 @@ class BlobService(_StorageClient):
                                           x_ms_blob_cache_control,
                                           x_ms_meta_name_values,
                                           x_ms_lease_id,
-                                          progress_callback)
+                                          progress_callback,
+                                          max_connections,
+                                          max_retries,
+                                          retry_wait,
+                                          resume)
 
     def put_block_blob_from_text(self, container_name, blob_name, text,
                                  text_encoding='utf-8',
@@ -1008,7 +1296,9 @@ class BlobService(_StorageClient):
                                  x_ms_blob_content_md5=None,
                                  x_ms_blob_cache_control=None,
                                  x_ms_meta_name_values=None,
-                                 x_ms_lease_id=None, progress_callback=None):
+                                 x_ms_lease_id=None, progress_callback=None,
+                                 max_connections=4, max_retries=5, retry_wait=1.0,
+                                 resume=False):
         '''
         Creates a new block blob from str/unicode, or updates the content of an
         existing block blob, with automatic chunking and progress notifications.
@@ -1044,6 +1334,16 @@ class BlobService(_StorageClient):
             Callback for progress with signature function(current, total) where
             current is the number of bytes transfered so far, and total is the
             size of the blob, or None if the total size is unknown.
+        max_connections:
+            Maximum number of blocks uploaded at the same time, when the blob
+            is uploaded in blocks.
+        max_retries:
+            Number of times a block is retried after a connection error or a
+            server error.
+        retry_wait: Seconds to wait before the first retry, growing linearly.
+        resume:
+            Optional. Skips the blocks that a previous, failed upload of the
+            same content to this blob has already uploaded.
         '''
         _validate_not_none('container_name', container_name)
         _validate_not_none('blob_name', blob_name)
@@ -1069,7 +1369,11 @@ class BlobService(_StorageClient):
                                        x_ms_blob_cache_control,
                                        x_ms_meta_name_values,
                                        x_ms_lease_id,
-                                       progress_callback)
+                                       progress_callback,
+                                       max_connections,
+                                       max_retries,
+                                       retry_wait,
+                                       resume)
 
     def put_page_blob_from_path(self, container_name, blob_name, file_path,
                                 content_encoding=None, content_language=None,
@@ -1392,7 +1696,9 @@ class BlobService(_StorageClient):
 
     def get_blob_to_path(self, container_name, blob_name, file_path,
                          open_mode='wb', snapshot=None, x_ms_lease_id=None,
-                         progress_callback=None):
+                         progress_callback=None, max_connections=4,
+                         max_retries=5, retry_wait=1.0,
+                         verify_content_md5=False):
         '''
         Downloads a blob to a file path, with automatic chunking and progress
         notifications.
@@ -1409,6 +1715,16 @@ class BlobService(_StorageClient):
             Callback for progress with signature function(current, total) where
             current is the number of bytes transfered so far, and total is the
             size of the blob.
+        max_connections:
+            Maximum number of ranges downloaded at the same time. Streams
+            that can't seek are written sequentially.
+        max_retries:
+            Number of times a range is retried after a connection error, a
+            server error or a Content-MD5 mismatch.
+        retry_wait: Seconds to wait before the first retry, growing linearly.
+        verify_content_md5:
+            Optional. Checks every range against the Content-MD5 returned by
+            the service.
         '''
         _validate_not_none('container_name', container_name)
         _validate_not_none('blob_name', blob_name)
@@ -1421,11 +1737,17 @@ class BlobService(_StorageClient):
                                   stream,
                                   snapshot,
                                   x_ms_lease_id,
-                                  progress_callback)
+                                  progress_callback,
+                                  max_connections,
+                                  max_retries,
+                                  retry_wait,
+                                  verify_content_md5)
 
     def get_blob_to_file(self, container_name, blob_name, stream,
                          snapshot=None, x_ms_lease_id=None,
-                         progress_callback=None):
+                         progress_callback=None, max_connections=4,
+                         max_retries=5, retry_wait=1.0,
+                         verify_content_md5=False):
         '''
         Downloads a blob to a file/stream, with automatic chunking and progress
         notifications.
@@ -1441,51 +1763,172 @@ class BlobService(_StorageClient):
             Callback for progress with signature function(current, total) where
             current is the number of bytes transfered so far, and total is the
             size of the blob.
+        max_connections:
+            Maximum number of ranges downloaded at the same time. Streams
+            that can't seek are written sequentially.
+        max_retries:
+            Number of times a range is retried after a connection error, a
+            server error or a Content-MD5 mismatch.
+        retry_wait: Seconds to wait before the first retry, growing linearly.
+        verify_content_md5:
+            Optional. Checks every range against the Content-MD5 returned by
+            the service.
         '''
         _validate_not_none('container_name', container_name)
         _validate_not_none('blob_name', blob_name)
         _validate_not_none('stream', stream)
 
-        props = self.get_blob_properties(container_name, blob_name)
-        blob_size = int(props['content-length'])
+        parallel = max_connections > 1 and _is_random_access_stream(stream)
+        stream_start = stream.tell() if parallel else None
+        chunk_size = self._BLOB_MAX_CHUNK_DATA_SIZE
 
-        if blob_size < self._BLOB_MAX_DATA_SIZE:
+        # The size of the blob comes with the first range, which saves
+        # asking for the blob properties first.
+        response = self._get_blob_range(
+            container_name, blob_name, snapshot, x_ms_lease_id,
+            0, chunk_size - 1, verify_content_md5, max_retries, retry_wait)
+        if response is None:
             if progress_callback:
-                progress_callback(0, blob_size)
-
-            data = self.get_blob(container_name,
-                                 blob_name,
-                                 snapshot,
-                                 x_ms_lease_id=x_ms_lease_id)
+                progress_callback(0, 0)
+            return
 
+        data = response.body or b''
+        blob_size = _get_blob_size_from_content_range(response, len(data))
+        if progress_callback:
+            progress_callback(0, blob_size)
+        stream.write(data)
+        index = len(data)
+        if progress_callback:
+            progress_callback(index, blob_size)
+
+        if parallel:
+            if index < blob_size:
+                downloader = _BlobChunkDownloader(
+                    self, container_name, blob_name, snapshot,
+                    x_ms_lease_id, blob_size, chunk_size, stream,
+                    stream_start, index, verify_content_md5, max_retries,
+                    retry_wait, progress_callback)
+                downloader.run(list(range(index, blob_size, chunk_size)),
+                               max_connections)
+            return
+
+        while index < blob_size:
+            response = self._get_blob_range(
+                container_name, blob_name, snapshot, x_ms_lease_id,
+                index, min(index + chunk_size, blob_size) - 1,
+                verify_content_md5, max_retries, retry_wait)
+            data = response.body or b''
+            if not data:
+                break
             stream.write(data)
-
-            if progress_callback:
-                progress_callback(blob_size, blob_size)
-        else:
+            index += len(data)
             if progress_callback:
-                progress_callback(0, blob_size)
-
-            index = 0
-            while index < blob_size:
-                chunk_range = 'bytes={0}-{1}'.format(
-                    index,
-                    index + self._BLOB_MAX_CHUNK_DATA_SIZE - 1)
-                data = self.get_blob(
-                    container_name, blob_name, x_ms_range=chunk_range)
-                length = len(data)
-                index += length
-                if length > 0:
-                    stream.write(data)
-                    if progress_callback:
-                        progress_callback(index, blob_size)
-                    if length < self._BLOB_MAX_CHUNK_DATA_SIZE:
-                        break
-                else:
-                    break
+                progress_callback(index, blob_size)
+
+    def _perform_request_with_retries(self, create_request, max_retries,
+                                      retry_wait, check_response=None):
+        '''
+        Sends the request returned by create_request, which is called again
+        for every retry so it is signed again. Connection errors, server
+        errors and the errors returned by check_response are retried up to
+        max_retries times. Other HTTPErrors are raised right away, as is.
+        '''
+        retries = 0
+        while True:
+            try:
+                response = self._filter(create_request())
+            except HTTPError as ex:
+                if ex.status < 500 and ex.status != 408:
+                    raise
+                error = ex
+            except (HTTPException, IOError) as ex:
+                error = ex
+            else:
+                error = check_response(response) if check_response else None
+                if error is None:
+                    return response
+
+            retries += 1
+            if retries > max_retries:
+                raise error
+            time.sleep(retry_wait * retries)
+
+    def _get_blob_range(self, container_name, blob_name, snapshot,
+                        x_ms_lease_id, start_range, end_range,
+                        verify_content_md5, max_retries, retry_wait):
+        '''
+        Downloads bytes start_range to end_range of a blob, retrying on
+        connection errors, server errors and Content-MD5 mismatches.
+        Returns None if the blob is empty and start_range is 0.
+        '''
+        def create_request():
+            request = HTTPRequest()
+            request.method = 'GET'
+            request.host = self._get_host()
+            request.path = '/' + _str(container_name) + '/' + _str(blob_name)
+            request.headers = [
+                ('x-ms-range', 'bytes={0}-{1}'.format(start_range, end_range)),
+                ('x-ms-lease-id', _str_or_none(x_ms_lease_id)),
+                ('x-ms-range-get-content-md5',
+                 'true' if verify_content_md5 else None)
+            ]
+            request.query = [('snapshot', _str_or_none(snapshot))]
+            request.path, request.query = \
+                _update_request_uri_query_local_storage(
+                    request, self.use_local_storage)
+            request.headers = _update_storage_blob_header(
+                request, self.account_name, self.account_key)
+            return request
+
+        def check_response(response):
+            if verify_content_md5 and not _content_md5_matches(response):
+                return WindowsAzureError(_ERROR_BLOB_RANGE_MD5_MISMATCH.format(
+                    start_range, end_range, blob_name))
+            return None
+
+        try:
+            return self._perform_request_with_retries(
+                create_request, max_retries, retry_wait, check_response)
+        except HTTPError as ex:
+            if ex.status == 416 and start_range == 0:
+                return None
+            _storage_error_handler(ex)
+
+    def _put_block_with_retries(self, container_name, blob_name, block,
+                                blockid, content_md5, x_ms_lease_id,
+                                max_retries, retry_wait):
+        '''
+        put_block, retried on connection errors and server errors.
+        '''
+        def create_request():
+            request = HTTPRequest()
+            request.method = 'PUT'
+            request.host = self._get_host()
+            request.path = '/' + \
+                _str(container_name) + '/' + _str(blob_name) + '?comp=block'
+            request.headers = [
+                ('Content-MD5', _str_or_none(content_md5)),
+                ('x-ms-lease-id', _str_or_none(x_ms_lease_id))
+            ]
+            request.query = [('blockid', _encode_base64(_str_or_none(blockid)))]
+            request.body = _get_request_body_bytes_only('block', block)
+            request.path, request.query = \
+                _update_request_uri_query_local_storage(
+                    request, self.use_local_storage)
+            request.headers = _update_storage_blob_header(
+                request, self.account_name, self.account_key)
+            return request
+
+        try:
+            self._perform_request_with_retries(
+                create_request, max_retries, retry_wait)
+        except HTTPError as ex:
+            _storage_error_handler(ex)
 
     def get_blob_to_bytes(self, container_name, blob_name, snapshot=None,
-                          x_ms_lease_id=None, progress_callback=None):
+                          x_ms_lease_id=None, progress_callback=None,
+                          max_connections=4, max_retries=5, retry_wait=1.0,
+                          verify_content_md5=False):
         '''
         Downloads a blob as an array of bytes, with automatic chunking and
         progress notifications.
@@ -1500,6 +1943,16 @@ class BlobService(_StorageClient):
             Callback for progress with signature function(current, total) where
             current is the number of bytes transfered so far, and total is the
             size of the blob.
+        max_connections:
+            Maximum number of ranges downloaded at the same time. Streams
+            that can't seek are written sequentially.
+        max_retries:
+            Number of times a range is retried after a connection error, a
+            server error or a Content-MD5 mismatch.
+        retry_wait: Seconds to wait before the first retry, growing linearly.
+        verify_content_md5:
+            Optional. Checks every range against the Content-MD5 returned by
+            the service.
         '''
         _validate_not_none('container_name', container_name)
         _validate_not_none('blob_name', blob_name)
@@ -1510,13 +1963,19 @@ class BlobService(_StorageClient):
                               stream,
                               snapshot,
                               x_ms_lease_id,
-                              progress_callback)
+                              progress_callback,
+                              max_connections,
+                              max_retries,
+                              retry_wait,
+                              verify_content_md5)
 
         return stream.getvalue()
 
     def get_blob_to_text(self, container_name, blob_name, text_encoding='utf-8',
                          snapshot=None, x_ms_lease_id=None,
-                         progress_callback=None):
+                         progress_callback=None, max_connections=4,
+                         max_retries=5, retry_wait=1.0,
+                         verify_content_md5=False):
         '''
         Downloads a blob as unicode text, with automatic chunking and progress
         notifications.
@@ -1532,6 +1991,16 @@ class BlobService(_StorageClient):
             Callback for progress with signature function(current, total) where
             current is the number of bytes transfered so far, and total is the
             size of the blob.
+        max_connections:
+            Maximum number of ranges downloaded at the same time. Streams
+            that can't seek are written sequentially.
+        max_retries:
+            Number of times a range is retried after a connection error, a
+            server error or a Content-MD5 mismatch.
+        retry_wait: Seconds to wait before the first retry, growing linearly.
+        verify_content_md5:
+            Optional. Checks every range against the Content-MD5 returned by
+            the service.
         '''
         _validate_not_none('container_name', container_name)
         _validate_not_none('blob_name', blob_name)
@@ -1541,7 +2010,11 @@ class BlobService(_StorageClient):
                                         blob_name,
                                         snapshot,
                                         x_ms_lease_id,
-                                        progress_callback)
+                                        progress_callback,
+                                        max_connections,
+                                        max_retries,
+                                        retry_wait,
+                                        verify_content_md5)
 
         return result.decode(text_encoding)
 
@@ -16,30 +16,133 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import errno
 import time
 import datetime
+import threading
 import traceback
 import urlparse
 import httplib
+import socket
 import shlex
 import subprocess
 from common import CommonVariables
 from subprocess import *
 from Utils.WAAgentUtil import waagent
 
+class HttpResponseBuffer(object):
+    """
+    the response of a pooled connection, the body is read eagerly so the
+    connection can go back to the pool before the caller looks at it.
+    """
+    def __init__(self, resp):
+        self.status = resp.status
+        self.reason = resp.reason
+        self.headers = resp.getheaders()
+        self.body = resp.read()
+
+    def getheaders(self):
+        return self.headers
+
+    def getheader(self, name, default = None):
+        name = name.lower()
+        for key, value in self.headers:
+            if(key.lower() == name):
+                return value
+        return default
+
+    def read(self):
+        body = self.body
+        self.body = ''
+        return body
+
+class HttpConnectionPool(object):
+    """
+    keep-alive https connections keyed by (storage host, proxy host, proxy port).
+    the snapshot calls, the blob writer and the log committer all hit the same
+    storage account, so reusing the connection saves a tcp+tls handshake per call.
+    """
+    max_idle_per_key = 32
+    max_idle_seconds = 30
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.pid = os.getpid()
+        self.created = 0
+        self.reused = 0
+
+    def _check_pid(self):
+        # the connections of the parent process must not be shared by a forked child.
+        if(self.pid != os.getpid()):
+            self.idle = {}
+            self.pid = os.getpid()
+            self.created = 0
+            self.reused = 0
+
+    def acquire(self, host, proxyHost, proxyPort, timeout):
+        key = (host, proxyHost, proxyPort)
+        with self.lock:
+            self._check_pid()
+            connections = self.idle.get(key)
+            now = time.time()
+            while connections:
+                connection, released_at = connections.pop()
+                if(now - released_at < self.max_idle_seconds):
+                    self.reused += 1
+                    connection.timeout = timeout
+                    if(connection.sock is not None):
+                        connection.sock.settimeout(timeout)
+                    return connection, True
+                connection.close()
+            self.created += 1
+        if(proxyHost is None or proxyPort is None):
+            connection = httplib.HTTPSConnection(host, timeout = timeout)
+        else:
+            connection = httplib.HTTPSConnection(proxyHost, proxyPort, timeout = timeout)
+            connection.set_tunnel(host, 443)
+        return connection, False
+
+    def release(self, host, proxyHost, proxyPort, connection):
+        key = (host, proxyHost, proxyPort)
+        with self.lock:
+            self._check_pid()
+            connections = self.idle.setdefault(key, [])
+            if(len(connections) < self.max_idle_per_key):
+                connections.append((connection, time.time()))
+                return
+        connection.close()
+
+    def clear(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for connection, released_at in connections:
+                    connection.close()
+            self.idle = {}
+
+    def stats(self):
+        with self.lock:
+            idle_count = sum([len(connections) for connections in self.idle.values()])
+            return {'created' : self.created, 'reused' : self.reused, 'idle' : idle_count}
+
 class HttpUtil(object):
     """description of class"""
+    connection_pool = HttpConnectionPool()
+    proxy_config = None
+
     def __init__(self, hutil):
-        try:
-            waagent.MyDistro = waagent.GetMyDistro()
-            Config = waagent.ConfigurationProvider(None)
-        except Exception as e:
-            errorMsg = "Failed to construct ConfigurationProvider, which may due to the old wala code."
-            hutil.log(errorMsg)
-            Config = waagent.ConfigurationProvider()
         self.logger = hutil
-        self.proxyHost = Config.get("HttpProxy.Host")
-        self.proxyPort = Config.get("HttpProxy.Port")
+        if(HttpUtil.proxy_config is None):
+            try:
+                waagent.MyDistro = waagent.GetMyDistro()
+                Config = waagent.ConfigurationProvider(None)
+            except Exception as e:
+                errorMsg = "Failed to construct ConfigurationProvider, which may due to the old wala code."
+                hutil.log(errorMsg)
+                Config = waagent.ConfigurationProvider()
+            HttpUtil.proxy_config = (Config.get("HttpProxy.Host"), Config.get("HttpProxy.Port"))
+        self.proxyHost, self.proxyPort = HttpUtil.proxy_config
         self.tmpFile = './tmp_file_FD76C85E-406F-4CFA-8EB0-CF18B123365C'
 
     """
@@ -57,8 +160,10 @@ class HttpUtil(object):
                 + '--proxy ' + self.proxyHost + ':' + self.proxyPort + ' -v'
         args = shlex.split(commandToExecute.encode('ascii'))
         proc = Popen(args,stdin=subprocess.PIPE,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-        proc.stdin.write(data)
-        curlResult,err = proc.communicate()
+        if(hasattr(data, 'read')):
+            data.seek(0)
+            data = data.read()
+        curlResult,err = proc.communicate(data)
         returnCode = proc.wait()
         self.logger.log("curl error is: " + str(err))
         self.logger.log("curl return code is : " + str(returnCode))
@@ -95,25 +200,71 @@ class HttpUtil(object):
             else:
                 return CommonVariables.error_http_failure
 
-    def HttpCallGetResponse(self, method, sasuri_obj, data, headers):
+    def IsStaleConnectionError(self, e):
+        """
+        a send that fails with a reset or a broken pipe hit a connection the
+        server had already closed. a timeout says nothing about that.
+        """
+        if(isinstance(e, socket.timeout)):
+            return False
+        return getattr(e, 'errno', None) in (errno.ECONNRESET, errno.EPIPE)
+
+    def IsSnapshotRequest(self, method, sasuri_obj):
+        return method == 'PUT' and 'comp=snapshot' in (sasuri_obj.query or '')
+
+    def HttpCallGetResponse(self, method, sasuri_obj, data, headers, timeout = 10):
         result = CommonVariables.error_http_failure
         resp = None
         errorMsg = None
         try:
             resp = None
             if(self.proxyHost == None or self.proxyPort == None):
-                connection = httplib.HTTPSConnection(sasuri_obj.hostname, timeout = 10)
-                connection.request(method=method, url=(sasuri_obj.path + '?' + sasuri_obj.query), body=data, headers = headers)
-                resp = connection.getresponse()
-                connection.close()
+                url = sasuri_obj.path + '?' + sasuri_obj.query
             else:
-                connection = httplib.HTTPSConnection(self.proxyHost, self.proxyPort, timeout = 10)
-                connection.set_tunnel(sasuri_obj.hostname, 443)
                 # If proxy is used, full url is needed.
-                path = "https://{0}:{1}{2}".format(sasuri_obj.hostname, 443, (sasuri_obj.path + '?' + sasuri_obj.query))
-                connection.request(method=method, url=(path), body=data, headers=headers)
-                resp = connection.getresponse()
-                connection.close()
+                url = "https://{0}:{1}{2}".format(sasuri_obj.hostname, 443, (sasuri_obj.path + '?' + sasuri_obj.query))
+            # a kept-alive connection may have been closed by the server in between,
+            # so retry once on a fresh one, but only when the request cannot have
+            # been handled: a snapshot PUT is not idempotent.
+            for attempt in range(0, 2):
+                connection, reused = HttpUtil.connection_pool.acquire(sasuri_obj.hostname, self.proxyHost, self.proxyPort, timeout)
+                if(hasattr(data, 'seek')):
+                    data.seek(0)
+                retry = reused and attempt == 0
+                try:
+                    try:
+                        connection.request(method=method, url=url, body=data, headers=headers)
+                    except socket.error as e:
+                        if(not self.IsStaleConnectionError(e)):
+                            retry = False
+                        raise
+                    try:
+                        httpResp = connection.getresponse()
+                    except httplib.BadStatusLine as e:
+                        # the reused socket was closed without an answer, a
+                        # snapshot PUT may still have been taken by the server.
+                        if(self.IsSnapshotRequest(method, sasuri_obj)):
+                            retry = False
+                        raise
+                    except Exception:
+                        retry = False
+                        raise
+                    retry = False
+                    resp = HttpResponseBuffer(httpResp)
+                except (httplib.HTTPException, socket.error) as e:
+                    connection.close()
+                    if(retry):
+                        self.logger.log("pooled connection to " + str(sasuri_obj.hostname) + " was closed, retrying on a new connection: " + str(e))
+                        continue
+                    raise
+                except Exception:
+                    connection.close()
+                    raise
+                if(httpResp.will_close):
+                    connection.close()
+                else:
+                    HttpUtil.connection_pool.release(sasuri_obj.hostname, self.proxyHost, self.proxyPort, connection)
+                break
             result = CommonVariables.success
         except Exception as e:
             errorMsg = str(datetime.datetime.now()) +  " Failed to call http with error: %s, stack trace: %s" % (str(e), traceback.format_exc())
@@ -16,6 +16,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 import datetime
 import httplib
 import os
@@ -26,41 +27,115 @@ import urlparse
 from blobwriter import BlobWriter
 from Utils.WAAgentUtil import waagent
 
+# characters that are not printable are dropped from the console output.
+NON_PRINTABLE_CHARS = ''.join([chr(c) for c in range(256) if chr(c) not in string.printable])
+
+class LogBuffer(object):
+    """
+    keeps the log as a list of chunks instead of one growing string, so appending
+    is O(1). once the buffer holds more than max_bytes the oldest chunks are dropped.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.chunks = collections.deque()
+        self.size = 0
+        self.dropped_bytes = 0
+
+    def append(self, chunk):
+        self.chunks.append(chunk)
+        self.size += len(chunk)
+        while(self.size > self.max_bytes and len(self.chunks) > 1):
+            dropped = self.chunks.popleft()
+            self.size -= len(dropped)
+            self.dropped_bytes += len(dropped)
+
+    def get_chunks(self):
+        return self.chunks_since(0)
+
+    def end_position(self):
+        """
+        the number of bytes ever appended, used as a mark for chunks_since.
+        """
+        return self.dropped_bytes + self.size
+
+    def chunks_since(self, position):
+        chunks = []
+        if(position < self.dropped_bytes):
+            chunks.append("[" + str(self.dropped_bytes - position) + " bytes of older log dropped]\n")
+        chunk_position = self.dropped_bytes
+        for chunk in self.chunks:
+            if(chunk_position >= position):
+                chunks.append(chunk)
+            chunk_position += len(chunk)
+        return chunks
+
+    def getvalue(self):
+        return ''.join(self.get_chunks())
+
+    def __len__(self):
+        return self.size
+
 class Backuplogger(object):
+    # byte cap of each of the local and the blob log buffers
+    max_buffer_bytes = 4 * 1024 * 1024
+
     def __init__(self, hutil):
-        self.msg = ''
-        self.log_message = ''
+        # msg holds the lines not written to the local log yet, blob_log everything for the log blob.
+        self.msg = LogBuffer(Backuplogger.max_buffer_bytes)
+        self.blob_log = LogBuffer(Backuplogger.max_buffer_bytes)
+        self.blob_header = None
+        self.blob_committed_position = 0
+        # the task id of the run, page blobs are only appended to within one run.
+        self.run_id = None
         self.con_path = '/dev/console'
+        self.con = None
+        self.con_failed = False
         self.enforced_local_flag_value = True
         self.hutil = hutil
 
     def enforce_local_flag(self, enforced_local):
         self.enforced_local_flag_value = enforced_local
 
+    def set_run_id(self, run_id):
+        if(run_id is not None and run_id != ""):
+            self.run_id = run_id
+
     """description of class"""
     def log(self, msg, local=False, level='Info'):
         log_msg = "{0}  {1}  {2} \n".format(str(datetime.datetime.now()) , level , msg)
         self.log_to_con(log_msg)
         if self.enforced_local_flag_value != None:
             local = self.enforced_local_flag_value
+        self.blob_log.append(log_msg)
         if(local):
-            self.log_message += log_msg
             self.hutil.log(log_msg)
         else:
-            self.msg += log_msg
+            self.msg.append(log_msg)
 
     def log_to_con(self, msg):
+        # the console stays open for the whole run, opening it per line is too slow inside the freeze window.
+        if(self.con_failed):
+            return
         try:
-            with open(self.con_path, "w") as C :
-                message = filter(lambda x : x in string.printable, msg)
-                C.write(message.encode('ascii','ignore'))
+            if(self.con is None):
+                self.con = open(self.con_path, "w")
+            if(isinstance(msg, unicode)):
+                msg = msg.encode('ascii','ignore')
+            self.con.write(msg.translate(None, NON_PRINTABLE_CHARS))
+            self.con.flush()
         except IOError as e:
-            pass
+            self.con_failed = True
+            try:
+                if(self.con is not None):
+                    self.con.close()
+            except IOError as e:
+                pass
+            self.con = None
 
     def commit(self, logbloburi):
         #commit to local file system first, then commit to the network.
         try:
-            self.hutil.log(self.msg)
+            self.hutil.log(self.msg.getvalue())
         except Exception as e:
             pass 
         try:
@@ -69,22 +144,30 @@ class Backuplogger(object):
             self.hutil.log('commit to blob failed')
 
     def commit_to_local(self):
-        self.hutil.log(self.msg)
+        self.hutil.log(self.msg.getvalue())
 
     def commit_to_blob(self, logbloburi):
-        log_to_blob = ""
+        """
+        the whole log is sent for block blobs, page blobs only get what was
+        logged since the last commit appended. the header and the tail of the
+        wala log are only sent with the first commit of the run to a page blob.
+        """
+        log_to_blob = []
+        appended_log = []
+        run_start_log = []
         blobWriter = BlobWriter(self.hutil)
         # append the wala log at the end.
         try:
-            # distro information
-            if(self.hutil is not None and self.hutil.patching is not None and self.hutil.patching.distro_info is not None):
-                distro_str = ""
-                if(len(self.hutil.patching.distro_info)>1):
-                    distro_str = self.hutil.patching.distro_info[0] + " " + self.hutil.patching.distro_info[1]
-                else:
-                    distro_str = self.hutil.patching.distro_info[0]
-                self.msg = "Distro Info:" + distro_str + "\n" + self.msg
-            self.msg = "Guest Agent Version is :" + waagent.GuestAgentVersion + "\n" + self.msg
+            if(self.blob_header is None):
+                self.blob_header = "Guest Agent Version is :" + waagent.GuestAgentVersion + "\n"
+                # distro information
+                if(self.hutil is not None and self.hutil.patching is not None and self.hutil.patching.distro_info is not None):
+                    distro_str = ""
+                    if(len(self.hutil.patching.distro_info)>1):
+                        distro_str = self.hutil.patching.distro_info[0] + " " + self.hutil.patching.distro_info[1]
+                    else:
+                        distro_str = self.hutil.patching.distro_info[0]
+                    self.blob_header += "Distro Info:" + distro_str + "\n"
             with open("/var/log/waagent.log", 'rb') as file:
                 file.seek(0, os.SEEK_END)
                 length = file.tell()
@@ -93,8 +176,12 @@ class Backuplogger(object):
                     seek_len_abs = length
                 file.seek(0 - seek_len_abs, os.SEEK_END)
                 tail_wala_log = file.read()
-                log_to_blob = self.log_message + self.msg + "Tail of WALA Log:" + tail_wala_log
+            wala_tail = ["Tail of WALA Log:", tail_wala_log]
+            log_to_blob = [self.blob_header] + self.blob_log.get_chunks() + wala_tail
+            appended_log = self.blob_log.chunks_since(self.blob_committed_position)
+            run_start_log = [self.blob_header] + wala_tail
+            self.blob_committed_position = self.blob_log.end_position()
         except Exception as e:
             errMsg = 'Failed to get the waagent log with error: %s, stack trace: %s' % (str(e), traceback.format_exc())
             self.hutil.log(errMsg)
-        blobWriter.WriteBlob(log_to_blob, logbloburi)
+        blobWriter.WriteBlob(log_to_blob, logbloburi, appended_log, self.run_id, run_start_log)
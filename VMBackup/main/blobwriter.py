@@ -16,7 +16,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import json
 import time
+import base64
 import datetime
 import traceback
 import urlparse
@@ -31,24 +34,125 @@ class BlobProperties():
     def __str__(self):
         return ' blobType: ' + str(self.blobType) + ' contentLength: ' + str(self.contentLength)
 
+class ChunkedBody(object):
+    """
+    file-like request body over a list of string chunks, httplib sends it
+    block by block so the chunks never have to be joined into one string.
+    """
+    def __init__(self, chunks):
+        self.chunks = [str(chunk) for chunk in chunks]
+        self.length = sum([len(chunk) for chunk in self.chunks])
+        self.seek(0)
+
+    def seek(self, offset):
+        # only rewinding is needed, for the retries.
+        self.chunk_index = 0
+        self.chunk_offset = 0
+
+    def read(self, size = -1):
+        pieces = []
+        while(self.chunk_index < len(self.chunks) and size != 0):
+            chunk = self.chunks[self.chunk_index]
+            if(size < 0):
+                end = len(chunk)
+            else:
+                end = min(len(chunk), self.chunk_offset + size)
+                size -= (end - self.chunk_offset)
+            pieces.append(chunk[self.chunk_offset:end])
+            if(end == len(chunk)):
+                self.chunk_index += 1
+                self.chunk_offset = 0
+            else:
+                self.chunk_offset = end
+        return ''.join(pieces)
+
+    def __len__(self):
+        return self.length
+
+class PageBlobOffsets(object):
+    """
+    remembers, per page blob, how many bytes of the log were committed and the
+    content of the last partially filled page, so the next commit (possibly from
+    another process of the same run) only uploads the new tail.
+    an entry only holds for the run (task id) that saved it, so the first commit
+    of a later run to the same blob starts the blob over.
+    """
+    max_entries = 16
+
+    def __init__(self):
+        self.store_offsets_file = './pageblob_offsets_FD76C85E-406F-4CFA-8EB0-CF18B123365C'
+
+    def blob_key(self, blobUri):
+        # the sas token can change between the enable and the daemon, the blob stays the same.
+        return blobUri.split("?")[0]
+
+    def load(self):
+        offsets = []
+        if(os.path.exists(self.store_offsets_file)):
+            try:
+                with open(self.store_offsets_file,'r') as f:
+                    offsets = json.load(f)
+            except (IOError, ValueError):
+                offsets = []
+        return offsets
+
+    def get(self, blobUri, run_id):
+        key = self.blob_key(blobUri)
+        for entry in self.load():
+            if(entry['blob'] == key and entry.get('run') == run_id):
+                return entry['offset'], base64.b64decode(entry['tail'])
+        return None, None
+
+    def save(self, blobUri, run_id, offset, tail):
+        key = self.blob_key(blobUri)
+        offsets = [entry for entry in self.load() if entry['blob'] != key]
+        offsets.append({'blob' : key, 'run' : run_id, 'offset' : offset, 'tail' : base64.b64encode(tail)})
+        offsets = offsets[-PageBlobOffsets.max_entries:]
+        tmp_file = self.store_offsets_file + '.tmp'
+        with open(tmp_file,'w') as f:
+            json.dump(offsets, f)
+        os.rename(tmp_file, self.store_offsets_file)
+
 class BlobWriter(object):
     """description of class"""
+    PAGE_SIZE_BYTES = 512
+    PAGE_UPLOAD_LIMIT_BYTES = 4194304 # 4 MB
+    STATUS_BLOB_LIMIT_BYTES = 10485760 # 10 MB
+
     def __init__(self, hutil):
         self.hutil = hutil
     """
     network call should have retry.
+    msg can be a string or a list of string chunks.
+    when appended_msg and run_id are given, msg is still the whole content for block
+    blobs, but page blobs only get appended_msg added after what the run committed
+    before. run_start_msg goes before it on the first commit of the run.
     """
-    def WriteBlob(self,msg,blobUri):
+    def WriteBlob(self,msg,blobUri,appended_msg=None,run_id=None,run_start_msg=''):
         try:
             # get the blob type
             if(blobUri is not None):
-                blobType = self.GetBlobType(blobUri)
-                if (str(blobType).lower() == "pageblob"):
+                blobProperties = self.GetBlobProperties(blobUri)
+                blobType = "BlockBlob"
+                if(blobProperties is not None):
+                    blobType = blobProperties.blobType
+                self.hutil.log("WriteBlob: Blob-Type :"+str(blobType))
+                if (str(blobType).lower() == "pageblob" and appended_msg is not None and run_id is not None):
+                    if(isinstance(appended_msg, list)):
+                        appended_msg = ''.join(appended_msg)
+                    if(isinstance(run_start_msg, list)):
+                        run_start_msg = ''.join(run_start_msg)
+                    self.AppendPageBlob(appended_msg, blobUri, int(blobProperties.contentLength), run_id, run_start_msg)
+                elif (str(blobType).lower() == "pageblob"):
+                    if(isinstance(msg, list)):
+                        msg = ''.join(msg)
                     # Clear Page-Blob Contents
                     self.ClearPageBlob(blobUri)
                     # Write to Page-Blob
                     self.WritePageBlob(msg, blobUri)
                 else:
+                    if(isinstance(msg, list)):
+                        msg = ChunkedBody(msg)
                     self.WriteBlockBlob(msg, blobUri)
             else:
                 self.hutil.log("bloburi is None")
@@ -66,6 +170,8 @@ class BlobWriter(object):
                     headers = {}
                     headers["x-ms-blob-type"] = 'BlockBlob'
                     self.hutil.log(str(headers))
+                    if(hasattr(msg, 'seek')):
+                        msg.seek(0)
                     result = http_util.Call(method = 'PUT', sasuri_obj = sasuri_obj, data = msg, headers = headers, fallback_to_curl = True)
                     if(result == CommonVariables.success):
                         self.hutil.log("blob written succesfully")
@@ -152,6 +258,65 @@ class BlobWriter(object):
         else:
             self.hutil.log("WritePageBlob: bloburi is None")
 
+    def AppendPageBlob(self, message, blobUri, blobContentLength, run_id, run_start_message):
+        """
+        uploads only the new message after the last offset the run committed to the blob.
+        the last partial page is re-sent together with the new data to keep the
+        writes 512-byte aligned, and the blob grows in geometric steps.
+        """
+        page_blob_offsets = PageBlobOffsets()
+        offset, tail = page_blob_offsets.get(blobUri, run_id)
+        if(offset is None or offset > blobContentLength):
+            self.hutil.log("AppendPageBlob: first commit of the run to the blob, starting from the beginning")
+            self.ClearPageBlob(blobUri)
+            offset, tail = 0, ''
+            message = run_start_message + message
+        page_start = offset - len(tail)
+        content = tail + message
+        maxMsgLen = max(BlobWriter.STATUS_BLOB_LIMIT_BYTES, blobContentLength)
+        if(page_start + len(content) > maxMsgLen):
+            # the blob is full, start over with the run start message and the latest part of the log.
+            self.hutil.log("AppendPageBlob: blob limit reached, rewriting from the beginning")
+            self.ClearPageBlob(blobUri)
+            page_start = 0
+            kept_len = max(0, maxMsgLen - len(run_start_message))
+            content = run_start_message[:maxMsgLen] + message[max(0, len(message) - kept_len):]
+        msgLen = len(content)
+        paddedLen = msgLen
+        if((msgLen % BlobWriter.PAGE_SIZE_BYTES) != 0):
+            paddedLen = msgLen + (BlobWriter.PAGE_SIZE_BYTES - (msgLen % BlobWriter.PAGE_SIZE_BYTES))
+        padded_content = content.ljust(paddedLen)
+        required_size = page_start + paddedLen
+        if(blobContentLength < required_size):
+            new_size = min(maxMsgLen, max(required_size, 2 * blobContentLength))
+            new_size = new_size - (new_size % BlobWriter.PAGE_SIZE_BYTES)
+            if(self.try_resize_page_blob(blobUri, new_size) == True):
+                self.hutil.log("AppendPageBlob: page-blob resized successfully new size:"+str(new_size))
+            else:
+                self.hutil.log("AppendPageBlob: page-blob resize failed, the log is not appended")
+                return
+        self.hutil.log("AppendPageBlob: writing " + str(paddedLen) + " bytes at offset " + str(page_start))
+        retry_times = 3
+        while(retry_times > 0):
+            try:
+                result = CommonVariables.success
+                bytes_sent = 0
+                while (bytes_sent < paddedLen):
+                    pageContent = padded_content[bytes_sent:bytes_sent+BlobWriter.PAGE_UPLOAD_LIMIT_BYTES]
+                    result = self.put_page_update(pageContent, blobUri, page_start + bytes_sent)
+                    if(result != CommonVariables.success):
+                        self.hutil.log("AppendPageBlob: page failed to write")
+                        break
+                    bytes_sent = bytes_sent + len(pageContent)
+                if(result == CommonVariables.success):
+                    partial_len = msgLen % BlobWriter.PAGE_SIZE_BYTES
+                    page_blob_offsets.save(blobUri, run_id, page_start + msgLen, content[msgLen - partial_len:])
+                    self.hutil.log("AppendPageBlob: page-blob appended succesfully")
+                    retry_times = 0
+            except Exception as e:
+                self.hutil.log("AppendPageBlob: Failed to append to page-blob with error: %s, stack trace: %s" % (str(e), traceback.format_exc()))
+            retry_times = retry_times - 1
+
     def ClearPageBlob(self, blobUri):
         if(blobUri is not None):
             retry_times = 3
@@ -199,7 +364,9 @@ class BlobWriter(object):
                     http_util = HttpUtil(self.hutil)
                     sasuri_obj = urlparse.urlparse(blobUri)
                     headers = {}
-                    result, httpResp, errMsg = http_util.HttpCallGetResponse('GET', sasuri_obj, None, headers = headers)
+                    # HEAD returns the same properties without sending the blob content back,
+                    # which keeps the pooled connection reusable.
+                    result, httpResp, errMsg = http_util.HttpCallGetResponse('HEAD', sasuri_obj, None, headers = headers)
                     self.hutil.log("GetBlobProperties: HttpCallGetResponse : result :" + str(result) + ", errMsg :" + str(errMsg))
                     blobProperties = self.httpresponse_get_blob_properties(httpResp)
                     self.hutil.log("GetBlobProperties: blobProperties :" + str(blobProperties))
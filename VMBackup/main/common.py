@@ -37,6 +37,7 @@ class CommonVariables:
     vmType = 'vmType'
     VmTypeV1 = 'microsoft.classiccompute/virtualmachines'
     VmTypeV2 = 'microsoft.compute/virtualmachines'
+    default_snapshot_threads = 16
 
 
     status_transitioning = 'transitioning'
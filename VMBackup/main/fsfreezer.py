@@ -18,39 +18,53 @@
 
 import subprocess
 from mounts import Mounts
-import datetime
 import threading
 import os
+import errno
+import fcntl
 import time
 import sys
 import signal
 from DiskUtil import DiskUtil 
 
+# from linux/fs.h, _IOWR('X', 119, int) and _IOWR('X', 120, int)
+FIFREEZE = 0xC0045877
+FITHAW = 0xC0045878
+
 class FreezeError(object):
     def __init__(self):
         self.errorcode = None
         self.fstype = None
         self.path = None
+        self.latency = None
+        self.message = None
     def __str__(self):
         return "errorcode:" + str(self.errorcode) + " fstype:" + str(self.fstype) + " path" + str(self.path)
 
 class FreezeResult(object):
     def __init__(self):
         self.errors = []
+        # (mount point, milliseconds) of every freeze/thaw that was issued
+        self.latencies = []
     def __str__(self):
         error_str = ""
         for error in self.errors:
             error_str+=(str(error)) + "\n"
         return error_str
+    def latency_str(self):
+        return ", ".join([str(path) + ":" + str(latency) + "ms" for path, latency in self.latencies])
 
 class FreezeHandler(object):
-    def __init__(self,logger):
+    def __init__(self,logger,timeline=None):
         # sig_handle valid values(0:nothing done,1: freezed successfully, 2:freeze failed)
         self.sig_handle = 0
         self.child= None
         self.logger=logger
+        self.timeline=timeline
 
     def sigusr1_handler(self,signal,frame):
+        if(self.timeline is not None):
+            self.timeline.mark('safefreezeSignal')
         self.logger.log('freezed',False)
         self.sig_handle=1
 
@@ -76,7 +90,10 @@ class FreezeHandler(object):
         signal.signal(signal.SIGCHLD,self.sigchld_handler)
 
 class FsFreezer:
-    def __init__(self, patching, logger):
+    # seconds to wait for the FIFREEZE/FITHAW calls of one batch of mounts.
+    ioctl_timeout = 30
+
+    def __init__(self, patching, logger, timeline = None):
         """
         """
         self.patching = patching
@@ -90,7 +107,7 @@ class FsFreezer:
             self.mounts = None
         self.frozen_items = set()
         self.unfrozen_items = set()
-        self.freeze_handler = FreezeHandler(self.logger)
+        self.freeze_handler = FreezeHandler(self.logger, timeline)
 
 
     def should_skip(self, mount):
@@ -175,112 +192,147 @@ class FsFreezer:
         self.logger.enforce_local_flag(True)
         return thaw_result, is_inconsistent
 
+    def freeze_ioctl(self, path, request):
+        """
+        issue FIFREEZE/FITHAW on the mount point directly instead of spawning fsfreeze.
+        returns 0 on success or the errno of the failure.
+        """
+        try:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                fcntl.ioctl(fd, request, 0)
+            finally:
+                os.close(fd)
+        except (IOError, OSError) as e:
+            return e.errno
+        return 0
+
     def freeze(self, mount):
         """
-        for xfs we should use the xfs_freeze, or we just use fsfreeze
+        works for every file system that supports FIFREEZE, xfs included.
+        runs on a worker thread, so it only records what happened on the FreezeError.
         """
         global unfreeze_done
         freeze_error = FreezeError()
         path = mount.mount_point
+        freeze_error.path = path
+        freeze_error.fstype = mount.fstype
         freeze_return_code = 0
         if not unfreeze_done:
             if(path in self.frozen_items):
-                self.logger.log("skipping the mount point because we already freezed it")
+                freeze_error.message = "skipping the mount point because we already freezed it"
+            elif(self.should_skip(mount)):
+                freeze_error.message = "skip for the unknown file systems"
             else:
-                self.logger.log('freeze...')
-                if(self.should_skip(mount)):
-                    self.logger.log('skip for the unknown file systems')
-                else:
-                    before_freeze = datetime.datetime.utcnow()
-                    self.frozen_items.add(path)
-                    freeze_return_code = subprocess.call(['fsfreeze', '-f', path])
-                    after_freeze=datetime.datetime.utcnow()
-                    time_taken=after_freeze-before_freeze
-                    self.logger.log('time taken for freeze :' + str(time_taken))
-                self.logger.log('freeze_result...' + str(freeze_return_code))
-            freeze_error.errorcode = freeze_return_code
-
-        if(freeze_return_code != 0):
-            freeze_error.path = path
+                self.frozen_items.add(path)
+                before_freeze = time.time()
+                freeze_return_code = self.freeze_ioctl(path, FIFREEZE)
+                freeze_error.latency = int((time.time() - before_freeze) * 1000)
+        freeze_error.errorcode = freeze_return_code
         return freeze_error
 
     def unfreeze(self, mount):
         """
-        for xfs we should use the xfs_freeze -u, or we just use fsfreeze -u
+        runs on a worker thread, so it only records what happened on the FreezeError.
         """
         freeze_error = FreezeError()
         path = mount.mount_point
-        self.logger.log('unfreeze...')
-        unfreeze_return_code = 0 
+        freeze_error.path = path
+        freeze_error.fstype = mount.fstype
+        unfreeze_return_code = 0
         if(self.should_skip(mount)):
-            self.logger.log('skip for the type ')
+            freeze_error.message = "skip for the type"
+        elif(path in self.unfrozen_items):
+            freeze_error.message = "the item is already unfreezed, so skip it"
         else:
-            if(not path in self.unfrozen_items):
-                freeze_return_code = 0
-                self.unfrozen_items.add(path)
-                unfreeze_return_code = subprocess.call(['fsfreeze', '-u', path])
-            else:
-                self.logger.log('the item is already unfreezed, so skip it')
-        self.logger.log('unfreeze_result...' + str(unfreeze_return_code))
+            self.unfrozen_items.add(path)
+            before_thaw = time.time()
+            unfreeze_return_code = self.freeze_ioctl(path, FITHAW)
+            if(unfreeze_return_code == errno.EINVAL):
+                # EINVAL means the file system is not frozen, which is what we want.
+                unfreeze_return_code = 0
+            freeze_error.latency = int((time.time() - before_thaw) * 1000)
         freeze_error.errorcode = unfreeze_return_code
-        if(unfreeze_return_code != 0):
-            freeze_error.path = path
         return freeze_error
 
-    def freezeall(self):
-        global unfreeze_done
-        unfreeze_done= False
+    def run_on_mounts(self, operation, mounts):
+        """
+        runs operation for all the mounts in parallel and returns the FreezeErrors in mount order.
+        a mount whose FIFREEZE/FITHAW has not returned after ioctl_timeout seconds is reported
+        as failed, its thread is left behind and what it returns later is dropped.
+        """
+        freeze_errors = [None] * len(mounts)
+        freeze_errors_lock = threading.Lock()
+        def worker(index, mount):
+            try:
+                freezeError = operation(mount)
+            except Exception as e:
+                freezeError = FreezeError()
+                freezeError.errorcode = -1
+                freezeError.path = mount.mount_point
+                freezeError.message = str(e)
+            with freeze_errors_lock:
+                if(freeze_errors[index] is None):
+                    freeze_errors[index] = freezeError
+        threads = []
+        for index in range(0, len(mounts)):
+            thread = threading.Thread(target = worker, args = (index, mounts[index]))
+            thread.daemon = True
+            threads.append(thread)
+            thread.start()
+        deadline = time.time() + self.ioctl_timeout
+        for thread in threads:
+            thread.join(max(0, deadline - time.time()))
+        with freeze_errors_lock:
+            for index in range(0, len(mounts)):
+                if(freeze_errors[index] is None):
+                    freezeError = FreezeError()
+                    freezeError.errorcode = -1
+                    freezeError.path = mounts[index].mount_point
+                    freezeError.fstype = mounts[index].fstype
+                    freezeError.message = "did not finish within " + str(self.ioctl_timeout) + " seconds"
+                    freeze_errors[index] = freezeError
+            return list(freeze_errors)
+
+    def collect_result(self, operation_name, freeze_errors, freeze_result):
+        for freezeError in freeze_errors:
+            if(freezeError.message is not None):
+                self.logger.log(operation_name + ' ' + str(freezeError.path) + ': ' + freezeError.message)
+            self.logger.log(operation_name + '_result... ' + str(freezeError.path) + ' ' + str(freezeError.errorcode) + ' time taken(ms): ' + str(freezeError.latency))
+            if(freezeError.latency is not None):
+                freeze_result.latencies.append((freezeError.path, freezeError.latency))
+            if(freezeError.errorcode != 0):
+                freeze_result.errors.append(freezeError)
+
+    def split_root(self):
         self.root_seen = False
-        freeze_result = FreezeResult()
+        other_mounts = []
         for mount in self.mounts.mounts:
             if(mount.mount_point == '/'):
                 self.root_seen = True
                 self.root_mount = mount
             elif(mount.mount_point):
-                try:
-                    freezeError = self.freeze(mount)
-                    if(freezeError.errorcode != 0):
-                        freeze_result.errors.append(freezeError)
-                except Exception, e:
-                    freezeError = FreezeError()
-                    freezeError.errorcode = -1
-                    freezeError.path = mount.mount_point
-                    freeze_result.errors.append(freezeError)
-                    self.logger.log(str(e))
+                other_mounts.append(mount)
+        return other_mounts
 
+    def freezeall(self):
+        global unfreeze_done
+        unfreeze_done= False
+        freeze_result = FreezeResult()
+        other_mounts = self.split_root()
+        # root is frozen last so the other mounts can still be reached while they are frozen.
+        self.collect_result('freeze', self.run_on_mounts(self.freeze, other_mounts), freeze_result)
         if(self.root_seen):
-            freezeError = self.freeze(self.root_mount)
-            if(freezeError.errorcode != 0):
-                freeze_result.errors.append(freezeError)
+            self.collect_result('freeze', self.run_on_mounts(self.freeze, [self.root_mount]), freeze_result)
         return freeze_result
 
     def unfreezeall(self):
         global unfreeze_done
-        self.root_seen = False
         unfreeze_result = FreezeResult()
-        try:
-            commandToExecute="kill $(ps aux | grep \'fsfreeze\' | awk \'{print $2}\')"
-            subprocess.call(commandToExecute,shell=True)
-        except Exception,e:
-            self.logger.log('killing fsfreeze running process failed')
         unfreeze_done= True
-        for mount in self.mounts.mounts:
-            if(mount.mount_point == '/'):
-                self.root_seen = True
-                self.root_mount = mount
-            elif(mount.mount_point):
-                try:
-                    freezeError = self.unfreeze(mount)
-                    if(freezeError.errorcode != 0):
-                        unfreeze_result.errors.append(freezeError)
-                except Exception,e:
-                    freezeError = FreezeError()
-                    freezeError.errorcode = -1
-                    freezeError.path = mount.mount_point
-                    unfreeze_result.errors.append(freezeError)
+        other_mounts = self.split_root()
+        # root is thawed first, the reverse of the freeze order.
         if(self.root_seen):
-            freezeError = self.unfreeze(self.root_mount)
-            if(freezeError.errorcode != 0):
-                unfreeze_result.errors.append(freezeError)
+            self.collect_result('unfreeze', self.run_on_mounts(self.unfreeze, [self.root_mount]), unfreeze_result)
+        self.collect_result('unfreeze', self.run_on_mounts(self.unfreeze, other_mounts), unfreeze_result)
         return unfreeze_result
-
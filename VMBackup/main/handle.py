@@ -50,12 +50,14 @@ from backuplogger import Backuplogger
 from blobwriter import BlobWriter
 from taskidentity import TaskIdentity
 from MachineIdentity import MachineIdentity
+from timeline import Timeline
 import ExtensionErrorCodeHelper
 
 #Main function is the only entrence to this extension handler
 
 def main():
-    global MyPatching,backup_logger,hutil,run_result,run_status,error_msg,freezer,freeze_result,snapshot_info_array
+    global MyPatching,backup_logger,hutil,run_result,run_status,error_msg,freezer,freeze_result,snapshot_info_array,timeline
+    timeline = Timeline()
     run_result = CommonVariables.success
     run_status = 'success'
     error_msg = ''
@@ -162,10 +164,13 @@ def set_do_seq_flag():
 
 def snapshot(): 
     try: 
-        global hutil,backup_logger,run_result,run_status,error_msg,freezer,freeze_result,snapshot_result,snapshot_done,para_parser,snapshot_info_array
+        global hutil,backup_logger,run_result,run_status,error_msg,freezer,freeze_result,snapshot_result,snapshot_done,para_parser,snapshot_info_array,timeline
+        timeline.start('freeze')
         freeze_result = freezer.freezeall() 
+        timeline.end('freeze')
         all_failed= False
         backup_logger.log('T:S freeze result ' + str(freeze_result)) 
+        backup_logger.log('T:S freeze latency ' + freeze_result.latency_str())
         if(freeze_result is not None and len(freeze_result.errors) > 0): 
             run_result = CommonVariables.error 
             run_status = 'error' 
@@ -175,7 +180,7 @@ def snapshot():
             backup_logger.log(error_msg, True, 'Warning') 
         else: 
             backup_logger.log('T:S doing snapshot now...') 
-            snap_shotter = Snapshotter(backup_logger) 
+            snap_shotter = Snapshotter(backup_logger, timeline) 
             snapshot_result,snapshot_info_array, all_failed = snap_shotter.snapshotall(para_parser) 
             backup_logger.log('T:S snapshotall ends...') 
             if(snapshot_result is not None and len(snapshot_result.errors) > 0): 
@@ -201,8 +206,10 @@ def snapshot():
 
 def freeze_snapshot(timeout):
     try:
-        global hutil,backup_logger,run_result,run_status,error_msg,freezer,freeze_result,para_parser,snapshot_info_array
+        global hutil,backup_logger,run_result,run_status,error_msg,freezer,freeze_result,para_parser,snapshot_info_array,timeline
+        timeline.start('freeze')
         freeze_result = freezer.freeze_safe(timeout)
+        timeline.end('freeze')
         all_failed= False
         is_inconsistent_freeze = False
         is_inconsistent_snapshot =  False
@@ -216,7 +223,7 @@ def freeze_snapshot(timeout):
             backup_logger.log(error_msg, True, 'Warning')
         else:
             backup_logger.log('T:S doing snapshot now...')
-            snap_shotter = Snapshotter(backup_logger)
+            snap_shotter = Snapshotter(backup_logger, timeline)
             snapshot_result,snapshot_info_array, all_failed, is_inconsistent_snapshot = snap_shotter.snapshotall(para_parser)
             backup_logger.log('T:S snapshotall ends...')
             if(snapshot_result is not None and len(snapshot_result.errors) > 0):
@@ -230,12 +237,16 @@ def freeze_snapshot(timeout):
                     error_msg = error_msg + ExtensionErrorCodeHelper.ExtensionErrorCodeHelper.StatusCodeStringBuilder(hutil.ExtErrorCode)
                 run_status = 'error'
                 backup_logger.log(error_msg, True, 'Error')
+                timeline.start('thaw')
                 thaw_result, is_inconsistent_freeze = freezer.thaw_safe()
+                timeline.end('thaw')
                 if is_inconsistent_freeze and is_inconsistent_snapshot:
                     set_do_seq_flag()
                 backup_logger.log('T:S thaw result ' + str(thaw_result))
             else:
+                timeline.start('thaw')
                 thaw_result, is_inconsistent_freeze = freezer.thaw_safe()
+                timeline.end('thaw')
                 if is_inconsistent_freeze and is_inconsistent_snapshot:
                     set_do_seq_flag()
                 backup_logger.log('T:S thaw result ' + str(thaw_result))
@@ -258,16 +269,19 @@ def freeze_snapshot(timeout):
     #snapshot_done = True
 
 def daemon():
-    global MyPatching,backup_logger,hutil,run_result,run_status,error_msg,freezer,para_parser,snapshot_done,snapshot_info_array
+    global MyPatching,backup_logger,hutil,run_result,run_status,error_msg,freezer,para_parser,snapshot_done,snapshot_info_array,timeline
     #this is using the most recent file timestamp.
     hutil.do_parse_context('Executing')
-    freezer = FsFreezer(patching= MyPatching, logger = backup_logger)
+    timeline.start('mountEnumeration')
+    freezer = FsFreezer(patching= MyPatching, logger = backup_logger, timeline = timeline)
+    timeline.end('mountEnumeration')
     global_error_result = None
     # precheck
     freeze_called = False
     configfile='/etc/azure/vmbackup.conf'
     thread_timeout=str(60)
     safe_freeze_on = True
+    timeline.start('configRead')
     try:
         if(freezer.mounts is not None):
             hutil.partitioncount = len(freezer.mounts.mounts)
@@ -280,6 +294,7 @@ def daemon():
     except Exception as e:
         errMsg='cannot read config file or file not present'
         backup_logger.log(errMsg, True, 'Warning')
+    timeline.end('configRead')
     backup_logger.log("final thread timeout" + thread_timeout, True)
     backup_logger.log(" safe freeze flag " + str(safe_freeze_on), True)
     
@@ -297,6 +312,7 @@ def daemon():
         protected_settings = hutil._context._config['runtimeSettings'][0]['handlerSettings'].get('protectedSettings')
         public_settings = hutil._context._config['runtimeSettings'][0]['handlerSettings'].get('publicSettings')
         para_parser = ParameterParser(protected_settings, public_settings)
+        backup_logger.set_run_id(para_parser.taskId)
 
         commandToExecute = para_parser.commandToExecute
         #validate all the required parameter here
@@ -345,9 +361,11 @@ def daemon():
                     end_time=datetime.datetime.utcnow()
                     time_taken=end_time-start_time
                     backup_logger.log('total time taken..' + str(time_taken), True)
+                    timeline.start('thaw')
                     for i in range(0,3):
                         unfreeze_result = freezer.unfreezeall()
                         backup_logger.log('unfreeze result ' + str(unfreeze_result))
+                        backup_logger.log('unfreeze latency ' + unfreeze_result.latency_str())
                         if(unfreeze_result is not None):
                             if len(unfreeze_result.errors) > 0:
                                 error_msg += ('unfreeze with error: ' + str(unfreeze_result.errors))
@@ -355,6 +373,7 @@ def daemon():
                             else:
                                 backup_logger.log('unfreeze result is None')
                                 break;
+                    timeline.end('thaw')
                     backup_logger.log('unfreeze ends...')
                 
         else:
@@ -386,10 +405,15 @@ def daemon():
             error_msg  += ('Enable failed.' + str(global_error_result))
         status_report_msg = None
         HandlerUtil.HandlerUtility.add_to_telemetery_data("extErrorCode", str(ExtensionErrorCodeHelper.ExtensionErrorCodeHelper.ExtensionErrorCodeNameDict[hutil.ExtErrorCode]))
+        # the status report can only carry the phases up to itself, the log blob gets all of them.
+        HandlerUtil.HandlerUtility.add_to_telemetery_data("freezeTimeline", timeline.to_json())
+        timeline.start('statusReport')
         status_report(run_status,run_result,error_msg, snapshot_info_array)
+        timeline.end('statusReport')
     except Exception as e:
         errMsg = 'Failed to log status in extension'
         backup_logger.log(errMsg, True, 'Error')
+    backup_logger.log("freeze timeline: " + timeline.to_json(), True)
     if(para_parser is not None and para_parser.logsBlobUri is not None and para_parser.logsBlobUri != ""):
         backup_logger.commit(para_parser.logsBlobUri)
     else:
@@ -440,6 +464,7 @@ def enable():
         protected_settings = hutil._context._config['runtimeSettings'][0]['handlerSettings'].get('protectedSettings')
         public_settings = hutil._context._config['runtimeSettings'][0]['handlerSettings'].get('publicSettings')
         para_parser = ParameterParser(protected_settings, public_settings)
+        backup_logger.set_run_id(para_parser.taskId)
 
         if(para_parser.commandStartTimeUTCTicks is not None and para_parser.commandStartTimeUTCTicks != ""):
             utcTicksLong = long(para_parser.commandStartTimeUTCTicks)
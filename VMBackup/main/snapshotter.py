@@ -17,12 +17,14 @@
 # limitations under the License.
 
 import os
+import time
 import urlparse
 import httplib
 import traceback
 import datetime
+import threading
+import Queue
 import ConfigParser
-import multiprocessing as mp
 from common import CommonVariables
 from HttpUtil import HttpUtil
 from Utils import Status
@@ -55,11 +57,12 @@ class SnapshotResult(object):
 
 class Snapshotter(object):
     """description of class"""
-    def __init__(self, logger):
+    def __init__(self, logger, timeline = None):
         self.logger = logger
+        self.timeline = timeline
         self.configfile='/etc/azure/vmbackup.conf'
 
-    def snapshot(self, sasuri, sasuri_index, meta_data, snapshot_result_error, snapshot_info_indexer_queue, global_logger, global_error_logger):
+    def snapshot(self, sasuri, sasuri_index, meta_data, deadline = None):
         temp_logger=''
         error_logger=''
         snapshot_error = SnapshotError()
@@ -88,16 +91,27 @@ class Snapshotter(object):
                 http_util = HttpUtil(self.logger)
                 sasuri_obj = urlparse.urlparse(sasuri + '&comp=snapshot')
                 temp_logger = temp_logger + str(datetime.datetime.now()) + ' start calling the snapshot rest api. '
-                # initiate http call for blob-snapshot and get http response
-                result, httpResp, errMsg = http_util.HttpCallGetResponse('PUT', sasuri_obj, body_content, headers = headers)
-                if(result == CommonVariables.success and httpResp != None):
-                    # retrieve snapshot information from http response
-                    snapshot_info_indexer, snapshot_error, message = self.httpresponse_get_snapshot_info(httpResp, sasuri_index, sasuri)
-                    temp_logger = temp_logger + str(datetime.datetime.now()) + ' httpresponse_get_snapshot_info message: ' + str(message)
+                # the request must not outlive the freeze window.
+                request_timeout = 10
+                if(deadline is not None):
+                    request_timeout = min(request_timeout, deadline - time.time())
+                if(request_timeout <= 0):
+                    error_logger = error_logger + str(datetime.datetime.now()) + " snapshot deadline exceeded before the request was sent "
+                    snapshot_error.errorcode = CommonVariables.error
+                    snapshot_error.sasuri = sasuri
                 else:
-                    # HttpCall failed
-                    error_logger = error_logger + str(datetime.datetime.now()) + " snapshot HttpCallGetResponse failed "
-                    error_logger = error_logger + str(datetime.datetime.now()) + str(errMsg)
+                    # initiate http call for blob-snapshot and get http response
+                    request_start = self.timeline_now()
+                    result, httpResp, errMsg = http_util.HttpCallGetResponse('PUT', sasuri_obj, body_content, headers = headers, timeout = request_timeout)
+                    self.timeline_record('snapshot' + str(sasuri_index), request_start)
+                    if(result == CommonVariables.success and httpResp != None):
+                        # retrieve snapshot information from http response
+                        snapshot_info_indexer, snapshot_error, message = self.httpresponse_get_snapshot_info(httpResp, sasuri_index, sasuri)
+                        temp_logger = temp_logger + str(datetime.datetime.now()) + ' httpresponse_get_snapshot_info message: ' + str(message)
+                    else:
+                        # HttpCall failed
+                        error_logger = error_logger + str(datetime.datetime.now()) + " snapshot HttpCallGetResponse failed "
+                        error_logger = error_logger + str(datetime.datetime.now()) + str(errMsg)
                 end_time = datetime.datetime.utcnow()
                 time_taken=end_time-start_time
                 temp_logger = temp_logger + str(datetime.datetime.now()) + ' time taken for snapshot ' + str(time_taken)
@@ -107,10 +121,20 @@ class Snapshotter(object):
             snapshot_error.errorcode = CommonVariables.error
             snapshot_error.sasuri = sasuri
         temp_logger=temp_logger + str(datetime.datetime.now()) + ' snapshot ends..'
-        global_logger.put(temp_logger)
-        global_error_logger.put(error_logger)
-        snapshot_result_error.put(snapshot_error)
-        snapshot_info_indexer_queue.put(snapshot_info_indexer)
+        return snapshot_error, snapshot_info_indexer, temp_logger, error_logger
+
+    def snapshot_worker(self, work_queue, results, results_lock, meta_data, deadline):
+        while True:
+            try:
+                sasuri_index, sasuri = work_queue.get_nowait()
+            except Queue.Empty:
+                return
+            result = self.snapshot(sasuri, sasuri_index, meta_data, deadline)
+            with results_lock:
+                # a slot filled in already was given up after the deadline,
+                # the late result is dropped.
+                if(results[sasuri_index] is None):
+                    results[sasuri_index] = result
 
     def snapshot_seq(self, sasuri, sasuri_index, meta_data):
         result = None
@@ -140,7 +164,9 @@ class Snapshotter(object):
                 sasuri_obj = urlparse.urlparse(sasuri + '&comp=snapshot')
                 self.logger.log("start calling the snapshot rest api")
                 # initiate http call for blob-snapshot and get http response
+                request_start = self.timeline_now()
                 result, httpResp, errMsg = http_util.HttpCallGetResponse('PUT', sasuri_obj, body_content, headers = headers)
+                self.timeline_record('snapshot' + str(sasuri_index), request_start)
                 if(result == CommonVariables.success and httpResp != None):
                     # retrieve snapshot information from http response
                     snapshot_info_indexer, snapshot_error, message = self.httpresponse_get_snapshot_info(httpResp, sasuri_index, sasuri)
@@ -164,55 +190,66 @@ class Snapshotter(object):
         is_inconsistent = False
         exceptOccurred = False
         try:
-            mp_jobs = []
-            global_logger = mp.Queue()
-            global_error_logger = mp.Queue()
-            snapshot_result_error = mp.Queue()
-            snapshot_info_indexer_queue = mp.Queue()
-            time_before_snapshot_start = datetime.datetime.now()
             blobs = paras.blobs
             if blobs is not None:
+                timeout = self.get_value_from_configfile('timeout')
+                if timeout == None:
+                    timeout = 60
+                # the safefreeze binary thaws on its own once the timeout is up,
+                # so every snapshot request has to finish before that.
+                deadline = time.time() + int(timeout) - 1
+                max_threads = self.get_value_from_configfile('snapshotthreads')
+                if max_threads == None:
+                    max_threads = CommonVariables.default_snapshot_threads
+                max_threads = max(1, min(int(max_threads), len(blobs)))
+
                 # initialize snapshot_info_array
-                mp_jobs = []
+                work_queue = Queue.Queue()
                 blob_index = 0
                 for blob in blobs:
                     blobUri = blob.split("?")[0]
                     self.logger.log("index: " + str(blob_index) + " blobUri: " + str(blobUri))
                     snapshot_info_array.append(Status.SnapshotInfoObj(False, blobUri, None))
-                    mp_jobs.append(mp.Process(target=self.snapshot,args=(blob, blob_index, paras.backup_metadata, snapshot_result_error, snapshot_info_indexer_queue, global_logger, global_error_logger)))
+                    work_queue.put((blob_index, blob))
                     blob_index = blob_index + 1
 
-                for job in mp_jobs:
-                    job.start()
+                results = [None] * len(blobs)
+                results_lock = threading.Lock()
+                workers = []
+                for i in range(0, max_threads):
+                    worker = threading.Thread(target = self.snapshot_worker, args = (work_queue, results, results_lock, paras.backup_metadata, deadline))
+                    worker.daemon = True
+                    workers.append(worker)
+                    worker.start()
+                self.logger.log("started " + str(max_threads) + " snapshot threads")
 
-                time_after_snapshot_start = datetime.datetime.now()
-                timeout = self.get_value_from_configfile('timeout')
-                if timeout == None:
-                    timeout = 60
+                for worker in workers:
+                    worker.join(max(0, deadline - time.time()))
+                    if worker.is_alive():
+                        is_inconsistent = True
+                self.logger.log('end of snapshot process')
 
-                if (time_after_snapshot_start - time_before_snapshot_start) > datetime.timedelta(seconds=int(timeout-1)):
-                    is_inconsistent = True
+                with results_lock:
+                    for index in range(0, len(results)):
+                        if(results[index] is None):
+                            snapshot_error = SnapshotError()
+                            snapshot_error.errorcode = CommonVariables.error
+                            snapshot_error.sasuri = blobs[index]
+                            results[index] = (snapshot_error, SnapshotInfoIndexerObj(index, False, None, None), '', str(datetime.datetime.now()) + ' snapshot did not finish before the deadline ')
+                    results = list(results)
 
-                for job in mp_jobs:
-                    job.join()
-                self.logger.log('end of snapshot process')
-                logging = [global_logger.get() for job in mp_jobs]
-                self.logger.log(str(logging))
-                error_logging = [global_error_logger.get() for job in mp_jobs]
-                self.logger.log(error_logging,False,'Error')
-                if not snapshot_result_error.empty():
-                    results = [snapshot_result_error.get() for job in mp_jobs]
-                    for result in results:
-                        if(result.errorcode != CommonVariables.success):
-                            snapshot_result.errors.append(result)
-                if not snapshot_info_indexer_queue.empty():
-                    snapshot_info_indexers = [snapshot_info_indexer_queue.get() for job in mp_jobs]
-                    for snapshot_info_indexer in snapshot_info_indexers:
-                        # update snapshot_info_array element properties from snapshot_info_indexer object
-                        self.get_snapshot_info(snapshot_info_indexer, snapshot_info_array[snapshot_info_indexer.index])
-                        if (snapshot_info_array[snapshot_info_indexer.index].isSuccessful == True):
-                            all_failed = False
-                        self.logger.log("index: " + str(snapshot_info_indexer.index) + " blobSnapshotUri: " + str(snapshot_info_array[snapshot_info_indexer.index].snapshotUri))
+                for index in range(0, len(results)):
+                    snapshot_error, snapshot_info_indexer, temp_logger, error_logger = results[index]
+                    self.logger.log(temp_logger)
+                    if(error_logger != ''):
+                        self.logger.log(error_logger, False, 'Error')
+                    if(snapshot_error.errorcode != CommonVariables.success):
+                        snapshot_result.errors.append(snapshot_error)
+                    # update snapshot_info_array element properties from snapshot_info_indexer object
+                    self.get_snapshot_info(snapshot_info_indexer, snapshot_info_array[index])
+                    if (snapshot_info_array[index].isSuccessful == True):
+                        all_failed = False
+                    self.logger.log("index: " + str(index) + " blobSnapshotUri: " + str(snapshot_info_array[index].snapshotUri))
 
                 return snapshot_result, snapshot_info_array, all_failed, is_inconsistent, exceptOccurred
             else:
@@ -256,6 +293,15 @@ class Snapshotter(object):
             exceptOccurred = True
             return snapshot_result, snapshot_info_array, all_failed, is_inconsistent, exceptOccurred
 
+    def timeline_now(self):
+        if(self.timeline is not None):
+            return self.timeline.now()
+        return None
+
+    def timeline_record(self, name, start):
+        if(self.timeline is not None):
+            self.timeline.record(name, start, self.timeline.now())
+
     def get_value_from_configfile(self, key):
         value = None
         configfile = '/etc/azure/vmbackup.conf'
@@ -279,6 +325,7 @@ class Snapshotter(object):
             snapshot_result, snapshot_info_array, all_failed, is_inconsistent, exceptOccurred =  self.snapshotall_parallel(paras)
             if exceptOccurred and is_inconsistent == False:
                 snapshot_result, snapshot_info_array, all_failed, is_inconsistent, exceptOccurred =  self.snapshotall_seq(paras)
+        self.logger.log("http connection pool stats: " + str(HttpUtil.connection_pool.stats()))
         return snapshot_result, snapshot_info_array, all_failed, is_inconsistent
 
     def httpresponse_get_snapshot_info(self, resp, sasuri_index, sasuri):
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+#
+# VM Backup extension
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import ctypes
+import ctypes.util
+import threading
+
+CLOCK_MONOTONIC = 1
+
+class timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+def _load_clock_gettime():
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno = True)
+        clock_gettime = librt.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        return clock_gettime
+    except Exception:
+        return None
+
+_clock_gettime = _load_clock_gettime()
+
+def monotonic():
+    """
+    seconds from CLOCK_MONOTONIC, falls back to the elapsed time of os.times()
+    which is also monotonic on linux but only has clock tick resolution.
+    """
+    if(_clock_gettime is not None):
+        t = timespec()
+        if(_clock_gettime(CLOCK_MONOTONIC, ctypes.pointer(t)) == 0):
+            return t.tv_sec + t.tv_nsec * 1e-9
+    return os.times()[4]
+
+class Timeline(object):
+    """
+    records the phases of one backup run with monotonic timestamps.
+    every phase is kept as [name, start, end] in milliseconds from the
+    creation of the timeline, so the whole run fits in one compact record.
+    """
+    def __init__(self):
+        self.origin = monotonic()
+        self.phases = []
+        self.open_phases = {}
+        # reentrant, mark() is called from the SIGUSR1 handler which can
+        # interrupt the main thread while it holds the lock.
+        self.lock = threading.RLock()
+
+    def now(self):
+        return int((monotonic() - self.origin) * 1000)
+
+    def start(self, name):
+        with self.lock:
+            self.open_phases[name] = self.now()
+
+    def end(self, name):
+        with self.lock:
+            end = self.now()
+            start = self.open_phases.pop(name, end)
+            self.phases.append([name, start, end])
+
+    def mark(self, name):
+        with self.lock:
+            now = self.now()
+            self.phases.append([name, now, now])
+
+    def record(self, name, start, end):
+        """
+        start and end are values returned by now(), used by callers that
+        time their work themselves, e.g. the snapshot threads.
+        """
+        with self.lock:
+            self.phases.append([name, start, end])
+
+    def to_json(self):
+        with self.lock:
+            phases = sorted(self.phases, key = lambda phase: phase[1])
+            return json.dumps({'v' : 1, 'phases' : phases}, separators = (',', ':'))
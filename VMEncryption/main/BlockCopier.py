@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+#
+# VMEncryption extension
+#
+# Copyright 2015 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.7+
+#
+
+import ctypes
+import ctypes.util
+import errno
+import mmap
+import os
+import os.path
+import stat
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+_pread = _libc.pread64
+_pread.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_longlong]
+_pread.restype = ctypes.c_ssize_t
+
+_pwrite = _libc.pwrite64
+_pwrite.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_longlong]
+_pwrite.restype = ctypes.c_ssize_t
+
+
+class CopyBuffer(object):
+    """
+    page aligned anonymous memory, so it can be used with O_DIRECT.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.memory = mmap.mmap(-1, size)
+        self.address = ctypes.addressof(ctypes.c_char.from_buffer(self.memory))
+
+
+class BlockCopier(object):
+    """
+    copies byte ranges between block devices and files with pread/pwrite
+    into reusable aligned buffers instead of spawning dd processes.
+    block devices are opened with O_DIRECT where it is supported.
+    """
+    def __init__(self, logger):
+        self.logger = logger
+        self.buffers = {}
+        self.fds = {}
+
+    def get_buffer(self, size, buffer_index=0):
+        """
+        a bigger buffer replaces the old one without keeping its content.
+        """
+        copy_buffer = self.buffers.get(buffer_index)
+        if copy_buffer is None or copy_buffer.size < size:
+            copy_buffer = CopyBuffer(size)
+            self.buffers[buffer_index] = copy_buffer
+        return copy_buffer
+
+    def _open(self, path, for_write, direct=True):
+        key = (path, for_write)
+        if key in self.fds:
+            return self.fds[key]
+
+        flags = os.O_WRONLY | os.O_CREAT if for_write else os.O_RDONLY
+        use_direct = False
+        if direct and hasattr(os, 'O_DIRECT') and os.path.exists(path) and stat.S_ISBLK(os.stat(path).st_mode):
+            use_direct = True
+        fd = None
+        if use_direct:
+            try:
+                fd = os.open(path, flags | os.O_DIRECT)
+            except OSError as e:
+                self.logger.log("O_DIRECT is not available for {0}: {1}".format(path, e))
+                use_direct = False
+        if fd is None:
+            fd = os.open(path, flags)
+        self.fds[key] = (fd, use_direct)
+        return self.fds[key]
+
+    def _reopen_buffered(self, path, for_write):
+        fd, use_direct = self.fds.pop((path, for_write))
+        os.close(fd)
+        return self._open(path, for_write, direct=False)
+
+    def _transfer(self, function, path, for_write, offset, length, copy_buffer, buffer_offset):
+        fd, use_direct = self._open(path, for_write)
+        done = 0
+        while done < length:
+            result = function(fd, copy_buffer.address + buffer_offset + done, length - done, offset + done)
+            if result < 0:
+                error_number = ctypes.get_errno()
+                if error_number == errno.EINTR:
+                    continue
+                if error_number == errno.EINVAL and use_direct:
+                    # the device does not accept this alignment, fall back to buffered io.
+                    self.logger.log("O_DIRECT transfer on {0} failed with EINVAL, retrying buffered".format(path))
+                    fd, use_direct = self._reopen_buffered(path, for_write)
+                    continue
+                raise OSError(error_number, os.strerror(error_number), path)
+            if result == 0:
+                # end of file
+                break
+            done += result
+        return done
+
+    def read(self, path, offset, length, buffer_index=0, buffer_offset=0):
+        """
+        reads length bytes at offset of path into the buffer, returns the bytes read.
+        """
+        copy_buffer = self.get_buffer(buffer_offset + length, buffer_index)
+        return self._transfer(_pread, path, False, offset, length, copy_buffer, buffer_offset)
+
+    def write(self, path, offset, length, buffer_index=0, sync=True):
+        """
+        writes the first length bytes of the buffer at offset of path.
+        """
+        copy_buffer = self.get_buffer(length, buffer_index)
+        written = self._transfer(_pwrite, path, True, offset, length, copy_buffer, 0)
+        if written != length:
+            raise IOError(errno.EIO, "short write to {0}: {1} of {2}".format(path, written, length))
+        if sync:
+            os.fsync(self.fds[(path, True)][0])
+        return written
+
+    def write_file(self, path, length, buffer_index=0):
+        """
+        replaces the file at path with the first length bytes of the buffer, durably.
+        """
+        self.close_path(path)
+        copy_buffer = self.get_buffer(length, buffer_index)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        try:
+            done = 0
+            while done < length:
+                done += os.write(fd, buffer(copy_buffer.memory, done, length - done))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def close_path(self, path):
+        for for_write in [False, True]:
+            if (path, for_write) in self.fds:
+                fd, use_direct = self.fds.pop((path, for_write))
+                os.close(fd)
+
+    def close(self):
+        for fd, use_direct in self.fds.values():
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self.fds = {}
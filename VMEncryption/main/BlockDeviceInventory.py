@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+#
+# VMEncryption extension
+#
+# Copyright 2015 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.7+
+#
+
+import os
+import os.path
+import stat
+
+from CommandExecutor import *
+from Common import *
+
+
+class BlockDeviceInventory(object):
+    """
+    a snapshot of the block devices read from sysfs, the udev database and
+    /proc/mounts, with the same fields lsblk reports in DeviceItem.
+    only lvs (and blkid where there is no udev database) is spawned.
+    the snapshot does not follow changes, so it has to be rebuilt after
+    luksOpen, mount, mkfs and the like.
+    """
+    sys_class_block_path = '/sys/class/block'
+    udev_data_paths = ['/run/udev/data', '/dev/.udev/data', '/dev/.udev/db']
+
+    def __init__(self, logger, distro_patcher, command_executor, lvm_items):
+        self.logger = logger
+        self.distro_patcher = distro_patcher
+        self.command_executor = command_executor
+        self.lvm_items = lvm_items
+
+        self.items_by_name = {}
+        self.items_by_majmin = {}
+        self.items_by_uuid = {}
+        self.children = {}
+        self.parents = {}
+        self.names = []
+
+        self.load()
+
+    @staticmethod
+    def is_supported():
+        return os.path.isdir(BlockDeviceInventory.sys_class_block_path)
+
+    def read_sys_file(self, *path):
+        try:
+            with open(os.path.join(*path), 'r') as f:
+                return f.read().strip()
+        except IOError:
+            return None
+
+    def load(self):
+        sys_names = sorted(os.listdir(BlockDeviceInventory.sys_class_block_path))
+        # lsblk does not list ram disks either.
+        sys_names = [sys_name for sys_name in sys_names if not sys_name.startswith('ram')]
+
+        device_items_by_sys_name = {}
+        for sys_name in sys_names:
+            device_item = self.load_device_item(sys_name)
+            if device_item is not None:
+                device_items_by_sys_name[sys_name] = device_item
+
+        for sys_name, device_item in device_items_by_sys_name.items():
+            children = []
+            sys_path = os.path.realpath(os.path.join(BlockDeviceInventory.sys_class_block_path, sys_name))
+            # the partitions are subdirectories of the disk.
+            for entry in sorted(os.listdir(sys_path)):
+                if entry in device_items_by_sys_name and os.path.exists(os.path.join(sys_path, entry, 'partition')):
+                    children.append(entry)
+            holders_path = os.path.join(sys_path, 'holders')
+            if os.path.isdir(holders_path):
+                for holder in sorted(os.listdir(holders_path)):
+                    if holder in device_items_by_sys_name:
+                        children.append(holder)
+            self.children[device_item.name] = [device_items_by_sys_name[child].name for child in children]
+            for child in children:
+                self.parents.setdefault(device_items_by_sys_name[child].name, []).append(device_item.name)
+
+        for sys_name in sys_names:
+            if sys_name in device_items_by_sys_name:
+                device_item = device_items_by_sys_name[sys_name]
+                self.names.append(device_item.name)
+                self.items_by_name[device_item.name] = device_item
+                self.items_by_majmin[device_item.majmin] = device_item
+                if device_item.uuid:
+                    self.items_by_uuid[device_item.uuid] = device_item
+
+        self.load_mount_points()
+        if self.get_udev_data_path() is None:
+            self.load_blkid()
+
+    def load_device_item(self, sys_name):
+        sys_path = os.path.join(BlockDeviceInventory.sys_class_block_path, sys_name)
+        majmin = self.read_sys_file(sys_path, 'dev')
+        size = self.read_sys_file(sys_path, 'size')
+        if majmin is None or size is None:
+            return None
+
+        device_item = DeviceItem()
+        device_item.name = sys_name
+        device_item.majmin = majmin
+        # the size in sysfs is always in 512 byte sectors.
+        device_item.size = int(size) * 512
+
+        if os.path.exists(os.path.join(sys_path, 'partition')):
+            device_item.type = 'part'
+        elif os.path.isdir(os.path.join(sys_path, 'dm')):
+            dm_name = self.read_sys_file(sys_path, 'dm', 'name')
+            dm_uuid = self.read_sys_file(sys_path, 'dm', 'uuid') or ''
+            if dm_name:
+                device_item.name = dm_name
+            if dm_uuid.startswith('CRYPT-'):
+                device_item.type = 'crypt'
+            elif dm_uuid.startswith('LVM-'):
+                device_item.type = 'lvm'
+                for lvm_item in self.lvm_items:
+                    if majmin == lvm_item.lv_kernel_major + ':' + lvm_item.lv_kernel_minor:
+                        device_item.name = lvm_item.vg_name + '/' + lvm_item.lv_name
+            elif dm_uuid.startswith('mpath-'):
+                device_item.type = 'mpath'
+            else:
+                device_item.type = 'dm'
+        elif os.path.isdir(os.path.join(sys_path, 'md')):
+            device_item.type = self.read_sys_file(sys_path, 'md', 'level') or 'md'
+        elif sys_name.startswith('loop'):
+            # like lsblk, loop devices without a backing file are not listed.
+            if device_item.size == 0:
+                return None
+            device_item.type = 'loop'
+        elif sys_name.startswith('sr'):
+            device_item.type = 'rom'
+        else:
+            device_item.type = 'disk'
+            device_item.model = self.read_sys_file(sys_path, 'device', 'model') or ''
+
+        udev_properties = self.load_udev_properties(majmin)
+        device_item.file_system = udev_properties.get('ID_FS_TYPE', '')
+        device_item.uuid = udev_properties.get('ID_FS_UUID', '')
+        device_item.label = udev_properties.get('ID_FS_LABEL', '')
+        device_item.mount_point = ''
+        if device_item.model is None:
+            device_item.model = ''
+        return device_item
+
+    def get_udev_data_path(self):
+        for udev_data_path in BlockDeviceInventory.udev_data_paths:
+            if os.path.isdir(udev_data_path):
+                return udev_data_path
+        return None
+
+    def load_udev_properties(self, majmin):
+        udev_properties = {}
+        udev_data_path = self.get_udev_data_path()
+        if udev_data_path is None:
+            return udev_properties
+        try:
+            with open(os.path.join(udev_data_path, 'b' + majmin), 'r') as f:
+                for line in f:
+                    if line.startswith('E:') and '=' in line:
+                        key, value = line[2:].rstrip('\n').split('=', 1)
+                        udev_properties[key] = value
+        except IOError:
+            pass
+        return udev_properties
+
+    def load_blkid(self):
+        """
+        without a udev database the file systems are probed with a single blkid call.
+        """
+        proc_comm = ProcessCommunicator()
+        blkid_cmd = "{0} -o export".format(self.distro_patcher.blkid_path)
+        if self.command_executor.Execute(blkid_cmd, communicator=proc_comm, suppress_logging=True) != 0:
+            return
+        for block in proc_comm.stdout.split('\n\n'):
+            properties = {}
+            for line in block.splitlines():
+                if '=' in line:
+                    key, value = line.split('=', 1)
+                    properties[key] = value
+            device_item = self.get_item_by_path(properties.get('DEVNAME'))
+            if device_item is not None:
+                device_item.file_system = properties.get('TYPE', '')
+                device_item.uuid = properties.get('UUID', '')
+                device_item.label = properties.get('LABEL', '')
+                if device_item.uuid:
+                    self.items_by_uuid[device_item.uuid] = device_item
+
+    def load_mount_points(self):
+        mount_sources = []
+        for line in file('/proc/mounts'):
+            fields = [s.decode('string_escape') for s in line.split()]
+            mount_sources.append((fields[0], fields[1]))
+        if os.path.exists('/proc/swaps'):
+            for line in file('/proc/swaps').readlines()[1:]:
+                fields = line.split()
+                if fields:
+                    mount_sources.append((fields[0].decode('string_escape'), '[SWAP]'))
+
+        for source, mount_point in mount_sources:
+            device_item = self.get_item_by_path(source)
+            # like lsblk, only the first mount point of a device is reported.
+            if device_item is not None and not device_item.mount_point:
+                device_item.mount_point = mount_point
+
+    def get_item_by_path(self, dev_path):
+        """
+        dev_path could be any node of the device, /dev/sdc, /dev/mapper/x, /dev/disk/by-uuid/y and so on.
+        """
+        if not dev_path or not dev_path.startswith('/'):
+            return None
+        try:
+            dev_stat = os.stat(dev_path)
+        except OSError:
+            return None
+        if not stat.S_ISBLK(dev_stat.st_mode):
+            return None
+        majmin = "{0}:{1}".format(os.major(dev_stat.st_rdev), os.minor(dev_stat.st_rdev))
+        return self.items_by_majmin.get(majmin)
+
+    def get_item_by_name(self, name):
+        return self.items_by_name.get(name)
+
+    def get_item_by_majmin(self, majmin):
+        return self.items_by_majmin.get(majmin)
+
+    def get_item_by_uuid(self, uuid):
+        return self.items_by_uuid.get(uuid)
+
+    def get_children(self, name):
+        return [self.items_by_name[child] for child in self.children.get(name, [])]
+
+    def get_parents(self, name):
+        return [self.items_by_name[parent] for parent in self.parents.get(name, [])]
+
+    def get_tree(self, name):
+        """
+        the device followed by all the devices on top of it, in the order of lsblk.
+        """
+        device_items = [self.items_by_name[name]]
+        for child in self.children.get(name, []):
+            device_items.extend(self.get_tree(child))
+        return device_items
+
+    def get_device_items(self, dev_path):
+        """
+        the same items as lsblk: every device if dev_path is None, otherwise the device and its children.
+        """
+        if dev_path is None:
+            device_items = []
+            for name in self.names:
+                if name not in self.parents:
+                    device_items.extend(self.get_tree(name))
+            return device_items
+
+        device_item = self.get_item_by_path(dev_path)
+        if device_item is None:
+            self.logger.log(msg="no block device found for {0}".format(dev_path), level=CommonVariables.WarningLevel)
+            return []
+        return self.get_tree(device_item.name)
@@ -32,6 +32,8 @@ class CommonVariables:
     sector_size = 512
     luks_header_size = 4096 * 512
     default_block_size = 52428800
+    max_copy_buffer_size = 52428800 * 8
+    default_encryption_parallelism = 4
     min_filesystem_size_support = 52428800 * 3
     #TODO for the sles 11, we should use the ext3
     default_file_system = 'ext4'
@@ -50,6 +52,9 @@ class CommonVariables:
     AADClientCertThumbprintKey = 'AADClientCertThumbprint'
     KeyEncryptionAlgorithmKey = 'KeyEncryptionAlgorithm'
     DiskFormatQuerykey = "DiskFormatQuery"
+    SkipFreeSpaceKey = 'SkipFreeSpace'
+    EncryptionParallelismKey = 'EncryptionParallelism'
+    EncryptionBandwidthKey = 'EncryptionBandwidthMBps'
     PassphraseKey = 'Passphrase'
 
     """
@@ -24,20 +24,30 @@ import re
 import shlex
 import sys
 from subprocess import *
-import shutil
 import traceback
-import uuid
 import glob
+import threading
+import contextlib
 
 from EncryptionConfig import EncryptionConfig
 from DecryptionMarkConfig import DecryptionMarkConfig
 from EncryptionMarkConfig import EncryptionMarkConfig
 from TransactionalCopyTask import TransactionalCopyTask
+from FreeSpaceMap import FreeSpaceMap
+from BlockDeviceInventory import BlockDeviceInventory
+from MountConfigTable import MountConfigTable
 from CommandExecutor import *
 from Common import *
 
 class DiskUtil(object):
     os_disk_lvm = None
+    # the crypt mount config and fstab are edited by the devices encrypted at the same time.
+    config_files_lock = threading.RLock()
+    # the tables are read once and shared, see mount_config_batch.
+    mount_config_tables = {}
+    mount_config_batch_depth = 0
+    fstab_path = '/etc/fstab'
+    fstab_azure_backup_path = '/etc/fstab.azure.backup'
 
     def __init__(self, hutil, patching, logger, encryption_environment):
         self.encryption_environment = encryption_environment
@@ -48,6 +58,58 @@ class DiskUtil(object):
         self.vmbus_sys_path = '/sys/bus/vmbus/devices'
 
         self.command_executor = CommandExecutor(self.logger)
+        self.block_device_inventory = None
+        self.encryption_status_facts = None
+        # shared by the copies of the devices encrypted at the same time.
+        self.copy_bandwidth_limiter = None
+        # how many copies may run at the same time, they share the copy memory budget.
+        self.copy_parallelism = 1
+
+    def get_block_device_inventory(self):
+        """
+        returns None if sysfs is not available, then lsblk is used.
+        """
+        if self.block_device_inventory is None and BlockDeviceInventory.is_supported():
+            try:
+                self.block_device_inventory = BlockDeviceInventory(logger=self.logger,
+                                                                   distro_patcher=self.distro_patcher,
+                                                                   command_executor=self.command_executor,
+                                                                   lvm_items=self.get_lvm_items())
+            except (IOError, OSError) as e:
+                self.logger.log(msg="failed to read the block devices from sysfs: {0}".format(e),
+                                level=CommonVariables.WarningLevel)
+        return self.block_device_inventory
+
+    def get_physical_disks(self, device_item):
+        """
+        the names of the disks under the device, e.g. all the disks of a raid or a volume group.
+        """
+        block_device_inventory = self.get_block_device_inventory()
+        if block_device_inventory is None or block_device_inventory.get_item_by_name(device_item.name) is None:
+            return [device_item.name]
+        physical_disks = []
+        device_names = [device_item.name]
+        while device_names:
+            device_name = device_names.pop()
+            parents = block_device_inventory.get_parents(device_name)
+            if not parents:
+                if device_name not in physical_disks:
+                    physical_disks.append(device_name)
+            device_names.extend([parent.name for parent in parents])
+        return physical_disks
+
+    def invalidate_block_device_inventory(self):
+        self.block_device_inventory = None
+
+    def invalidate_encryption_status(self):
+        self.encryption_status_facts = None
+
+    def invalidate_device_state(self):
+        """
+        has to be called after anything that adds, removes, formats or mounts a block device.
+        """
+        self.invalidate_block_device_inventory()
+        self.invalidate_encryption_status()
 
     def copy(self, ongoing_item_config, status_prefix=''):
         copy_task = TransactionalCopyTask(logger=self.logger,
@@ -56,18 +118,16 @@ class DiskUtil(object):
                                           ongoing_item_config=ongoing_item_config,
                                           patching=self.distro_patcher,
                                           encryption_environment=self.encryption_environment,
-                                          status_prefix=status_prefix)
+                                          status_prefix=status_prefix,
+                                          bandwidth_limiter=self.copy_bandwidth_limiter,
+                                          parallelism=self.copy_parallelism)
         try:
-            mem_fs_result = copy_task.prepare_mem_fs()
-            if mem_fs_result != CommonVariables.process_success:
-                return CommonVariables.tmpfs_error
-            else:
-                return copy_task.begin_copy()
+            return copy_task.begin_copy()
         except Exception as e:
-            message = "Failed to perform dd copy: {0}, stack trace: {1}".format(e, traceback.format_exc())
+            message = "Failed to perform the data copy: {0}, stack trace: {1}".format(e, traceback.format_exc())
             self.logger.log(msg=message, level=CommonVariables.ErrorLevel)
         finally:
-            copy_task.clear_mem_fs()
+            copy_task.close()
 
     def format_disk(self, dev_path, file_system):
         mkfs_command = ""
@@ -80,7 +140,9 @@ class DiskUtil(object):
         elif file_system == "btrfs":
             mkfs_command = "mkfs.btrfs"
         mkfs_cmd = "{0} {1}".format(mkfs_command, dev_path)
-        return self.command_executor.Execute(mkfs_cmd)
+        return_code = self.command_executor.Execute(mkfs_cmd)
+        self.invalidate_device_state()
+        return return_code
 
     def make_sure_path_exists(self, path):
         mkdir_cmd = self.distro_patcher.mkdir_path + ' -p ' + path
@@ -99,36 +161,32 @@ class DiskUtil(object):
         if not os.path.exists(self.encryption_environment.azure_crypt_mount_config_path):
             self.logger.log("{0} does not exist".format(self.encryption_environment.azure_crypt_mount_config_path))
         else:
-            with open(self.encryption_environment.azure_crypt_mount_config_path,'r') as f:
-                for line in f:
-                    if not line.strip():
-                        continue
-
-                    crypt_mount_item_properties = line.strip().split()
-
-                    crypt_item = CryptItem()
-                    crypt_item.mapper_name = crypt_mount_item_properties[0]
-                    crypt_item.dev_path = crypt_mount_item_properties[1]
+            with self.mount_config_batch():
+                crypt_mount_entries = self.get_crypt_mount_table().get_entries()
+            for crypt_mount_item_properties in crypt_mount_entries:
+                crypt_item = CryptItem()
+                crypt_item.mapper_name = crypt_mount_item_properties[0]
+                crypt_item.dev_path = crypt_mount_item_properties[1]
 
-                    header_file_path = None
-                    if crypt_mount_item_properties[2] and crypt_mount_item_properties[2] != "None":
-                        header_file_path = crypt_mount_item_properties[2]
+                header_file_path = None
+                if crypt_mount_item_properties[2] and crypt_mount_item_properties[2] != "None":
+                    header_file_path = crypt_mount_item_properties[2]
 
-                    crypt_item.luks_header_path = header_file_path
-                    crypt_item.mount_point = crypt_mount_item_properties[3]
+                crypt_item.luks_header_path = header_file_path
+                crypt_item.mount_point = crypt_mount_item_properties[3]
 
-                    if crypt_item.mount_point == "/":
-                        rootfs_crypt_item_found = True
+                if crypt_item.mount_point == "/":
+                    rootfs_crypt_item_found = True
 
-                    crypt_item.file_system = crypt_mount_item_properties[4]
-                    crypt_item.uses_cleartext_key = True if crypt_mount_item_properties[5] == "True" else False
+                crypt_item.file_system = crypt_mount_item_properties[4]
+                crypt_item.uses_cleartext_key = True if crypt_mount_item_properties[5] == "True" else False
 
-                    try:
-                        crypt_item.current_luks_slot = int(crypt_mount_item_properties[6])
-                    except IndexError:
-                        crypt_item.current_luks_slot = -1
+                try:
+                    crypt_item.current_luks_slot = int(crypt_mount_item_properties[6])
+                except IndexError:
+                    crypt_item.current_luks_slot = -1
 
-                    crypt_items.append(crypt_item)
+                crypt_items.append(crypt_item)
 
             encryption_status = json.loads(self.get_encryption_status())
 
@@ -136,23 +194,9 @@ class DiskUtil(object):
                 crypt_item = CryptItem()
                 crypt_item.mapper_name = "osencrypt"
 
-                proc_comm = ProcessCommunicator()
-                grep_result = self.command_executor.ExecuteInBash("cryptsetup status osencrypt | grep device:", communicator=proc_comm)
-
-                if grep_result == 0:
-                    crypt_item.dev_path = proc_comm.stdout.strip().split()[1]
-                else:
-                    proc_comm = ProcessCommunicator()
-                    self.command_executor.Execute("dmsetup table --target crypt", communicator=proc_comm)
-
-                    for line in proc_comm.stdout.splitlines():
-                        if 'osencrypt' in line:
-                            majmin = filter(lambda p: re.match(r'\d+:\d+', p), line.split())[0]
-                            src_device = filter(lambda d: d.majmin == majmin, self.get_device_items(None))[0]
-                            crypt_item.dev_path = '/dev/' + src_device.name
-                            break
+                crypt_item.dev_path = self.get_encryption_status_facts().get_osencrypt_dev_path()
 
-                rootfs_dev = next((m for m in self.get_mount_items() if m["dest"] == "/"))
+                rootfs_dev = next((m for m in self.get_encryption_status_facts().mount_items if m["dest"] == "/"))
                 crypt_item.file_system = rootfs_dev["fs"]
 
                 if not crypt_item.dev_path:
@@ -171,11 +215,80 @@ class DiskUtil(object):
 
         return crypt_items
 
+    @contextlib.contextmanager
+    def mount_config_batch(self):
+        """
+        the fstab and crypt mount config edits made within are written once, at the end
+        of the outermost batch, which raises if the files could not be written.
+        if a batch raises, the edits made within it are dropped, also those of an inner
+        batch, whose enclosing batch goes on with the tables as they were before it.
+        """
+        with DiskUtil.config_files_lock:
+            snapshots = dict((path, mount_config_table.get_snapshot())
+                             for path, mount_config_table in DiskUtil.mount_config_tables.items())
+            DiskUtil.mount_config_batch_depth += 1
+            try:
+                yield
+            except:
+                DiskUtil.mount_config_batch_depth -= 1
+                for path, mount_config_table in DiskUtil.mount_config_tables.items():
+                    if DiskUtil.mount_config_batch_depth > 0 and path in snapshots:
+                        mount_config_table.restore(snapshots[path])
+                    else:
+                        mount_config_table.load()
+                raise
+            DiskUtil.mount_config_batch_depth -= 1
+            if DiskUtil.mount_config_batch_depth == 0:
+                try:
+                    for mount_config_table in DiskUtil.mount_config_tables.values():
+                        mount_config_table.commit()
+                except:
+                    # the tables follow the files again, whatever of the edits made it there.
+                    for mount_config_table in DiskUtil.mount_config_tables.values():
+                        mount_config_table.load()
+                    raise
+
+    def get_mount_config_table(self, path, key_fields, backup_path=None):
+        """
+        only to be used within mount_config_batch.
+        """
+        mount_config_table = DiskUtil.mount_config_tables.get(path)
+        if mount_config_table is None:
+            mount_config_table = MountConfigTable(path=path,
+                                                  key_fields=key_fields,
+                                                  logger=self.logger,
+                                                  backup_path=backup_path)
+            DiskUtil.mount_config_tables[path] = mount_config_table
+        else:
+            mount_config_table.reload_if_changed()
+        return mount_config_table
+
+    def get_crypt_mount_table(self):
+        """
+        <target name> <source device> <key file> <mount point> <file system> <uses cleartext key> <luks slot>
+        """
+        crypt_mount_config_path = self.encryption_environment.azure_crypt_mount_config_path
+        return self.get_mount_config_table(crypt_mount_config_path, [0], crypt_mount_config_path + '.backup')
+
+    def get_fstab_table(self):
+        """
+        indexed by the device and the mount point.
+        """
+        return self.get_mount_config_table(DiskUtil.fstab_path, [0, 1], DiskUtil.fstab_path + '.backup')
+
+    def get_fstab_azure_backup_table(self):
+        """
+        the fstab lines of the devices being encrypted, to put back if they are decrypted.
+        """
+        return self.get_mount_config_table(DiskUtil.fstab_azure_backup_path, [1])
+
     def add_crypt_item(self, crypt_item):
         """
         TODO we should judge that the second time.
         format is like this:
         <target name> <source device> <key file> <options>
+        within a mount_config_batch True only means the line is added to the batch,
+        the outermost batch raises if it can't be written.
         """
         try:
             if not crypt_item.luks_header_path:
@@ -189,41 +302,23 @@ class DiskUtil(object):
                                   str(crypt_item.uses_cleartext_key) + " " +
                                   str(crypt_item.current_luks_slot))
 
-            if os.path.exists(self.encryption_environment.azure_crypt_mount_config_path):
-                with open(self.encryption_environment.azure_crypt_mount_config_path,'r') as f:
-                    existing_content = f.read()
-                    if existing_content is not None and existing_content.strip() != "":
-                        new_mount_content = existing_content + "\n" + mount_content_item
-                    else:
-                        new_mount_content = mount_content_item
-            else:
-                new_mount_content = mount_content_item
-
-            with open(self.encryption_environment.azure_crypt_mount_config_path,'w') as wf:
-                wf.write('\n')
-                wf.write(new_mount_content)
-                wf.write('\n')
+            with self.mount_config_batch():
+                self.get_crypt_mount_table().append(mount_content_item)
             return True
         except Exception as e:
             return False
 
     def remove_crypt_item(self, crypt_item):
+        """
+        within a mount_config_batch True only means the line is removed in the batch,
+        the outermost batch raises if the change can't be written.
+        """
         if not os.path.exists(self.encryption_environment.azure_crypt_mount_config_path):
             return False
 
         try:
-            mount_lines = []
-
-            with open(self.encryption_environment.azure_crypt_mount_config_path, 'r') as f:
-                mount_lines = f.readlines()
-
-            filtered_mount_lines = filter(lambda line: not crypt_item.mapper_name in line, mount_lines)
-
-            with open(self.encryption_environment.azure_crypt_mount_config_path, 'w') as wf:
-                wf.write('\n')
-                wf.write('\n'.join(filtered_mount_lines))
-                wf.write('\n')
-
+            with self.mount_config_batch():
+                self.get_crypt_mount_table().remove(0, crypt_item.mapper_name)
             return True
 
         except Exception as e:
@@ -231,8 +326,17 @@ class DiskUtil(object):
 
     def update_crypt_item(self, crypt_item):
         self.logger.log("Updating entry for crypt item {0}".format(crypt_item))
-        self.remove_crypt_item(crypt_item)
-        self.add_crypt_item(crypt_item)
+        try:
+            with self.mount_config_batch():
+                self.remove_crypt_item(crypt_item)
+                # without the new line the old one is kept.
+                if not self.add_crypt_item(crypt_item):
+                    raise Exception("adding the new entry failed")
+            return True
+        except Exception as e:
+            self.logger.log(msg="updating entry for crypt item {0} failed: {1}".format(crypt_item, e),
+                            level=CommonVariables.ErrorLevel)
+            return False
 
     def create_luks_header(self, mapper_name):
         luks_header_file_path = self.encryption_environment.luks_header_base_path + mapper_name
@@ -250,6 +354,7 @@ class DiskUtil(object):
 
     def encrypt_disk(self, dev_path, passphrase_file, mapper_name, header_file):
         return_code = self.luks_format(passphrase_file=passphrase_file, dev_path=dev_path, header_file=header_file)
+        self.invalidate_device_state()
         if return_code != CommonVariables.process_success:
             self.logger.log(msg=('cryptsetup luksFormat failed, return_code is:{0}'.format(return_code)), level=CommonVariables.ErrorLevel)
             return return_code
@@ -270,14 +375,64 @@ class DiskUtil(object):
 
     def expand_fs(self, dev_path):
         expandfs_cmd = self.distro_patcher.resize2fs_path + " " + str(dev_path)
-        return self.command_executor.Execute(expandfs_cmd)
+        return_code = self.command_executor.Execute(expandfs_cmd)
+        self.invalidate_device_state()
+        return return_code
 
     def shrink_fs(self, dev_path, size_shrink_to):
         """
         size_shrink_to is in sector (512 byte)
         """
         shrinkfs_cmd = self.distro_patcher.resize2fs_path + ' ' + str(dev_path) + ' ' + str(size_shrink_to) + 's'
-        return self.command_executor.Execute(shrinkfs_cmd)
+        return_code = self.command_executor.Execute(shrinkfs_cmd)
+        self.invalidate_device_state()
+        return return_code
+
+    def get_free_space_map(self, dev_path, file_system):
+        """
+        reads the unused blocks of an unmounted ext or xfs file system,
+        returns None for other file systems or if the tools fail.
+        """
+        if file_system is None:
+            return None
+        file_system = file_system.lower()
+        proc_comm = ProcessCommunicator()
+        if file_system in ["ext2", "ext3", "ext4"]:
+            dumpe2fs_cmd = "{0} {1}".format(self.distro_patcher.dumpe2fs_path, dev_path)
+            if self.command_executor.Execute(dumpe2fs_cmd, communicator=proc_comm, suppress_logging=True) != CommonVariables.process_success:
+                return None
+            return FreeSpaceMap.parse_dumpe2fs(proc_comm.stdout)
+        elif file_system == "xfs":
+            geometry_cmd = "{0} -r -c 'sb 0' -c 'print blocksize agblocks' {1}".format(self.distro_patcher.xfs_db_path, dev_path)
+            if self.command_executor.Execute(geometry_cmd, communicator=proc_comm, suppress_logging=True) != CommonVariables.process_success:
+                return None
+            geometry_output = proc_comm.stdout
+            freesp_cmd = "{0} -r -c 'freesp -d' {1}".format(self.distro_patcher.xfs_db_path, dev_path)
+            if self.command_executor.Execute(freesp_cmd, communicator=proc_comm, suppress_logging=True) != CommonVariables.process_success:
+                return None
+            return FreeSpaceMap.parse_xfs_db(geometry_output, proc_comm.stdout)
+        return None
+
+    def save_free_space_map(self, dev_path, file_system, total_size):
+        """
+        saves the free space of dev_path before its data copy starts, the copy skips the
+        slices in it. it has to be read before anything is copied, the file system
+        metadata is encrypted by the copy.
+        """
+        free_space_map_path = self.encryption_environment.azure_crypt_free_space_map_path
+        if os.path.exists(free_space_map_path):
+            os.remove(free_space_map_path)
+        try:
+            free_space_map = self.get_free_space_map(dev_path, file_system)
+        except Exception as e:
+            self.logger.log(msg="reading the free space of {0} failed: {1}".format(dev_path, e), level=CommonVariables.WarningLevel)
+            free_space_map = None
+        if free_space_map is None:
+            self.logger.log(msg="no free space map for {0}, copying the whole device".format(dev_path), level=CommonVariables.WarningLevel)
+            return False
+        free_space_map.save(free_space_map_path, dev_path, total_size)
+        self.logger.log(msg="{0} bytes of {1} are free and will not be copied".format(free_space_map.get_free_size(), dev_path))
+        return True
 
     def check_shrink_fs(self, dev_path, size_shrink_to):
         return_code = self.check_fs(dev_path)
@@ -393,7 +548,9 @@ class DiskUtil(object):
         else:
             cryptsetup_cmd = "{0} luksOpen {1} {2} -d {3} -q".format(self.distro_patcher.cryptsetup_path , dev_path , mapper_name , passphrase_file)
 
-        return self.command_executor.Execute(cryptsetup_cmd)
+        return_code = self.command_executor.Execute(cryptsetup_cmd)
+        self.invalidate_device_state()
+        return return_code
 
     def luks_close(self, mapper_name):
         """
@@ -402,90 +559,43 @@ class DiskUtil(object):
         self.hutil.log("dev mapper name to cryptsetup luksOpen " + (mapper_name))
         cryptsetup_cmd = "{0} luksClose {1} -q".format(self.distro_patcher.cryptsetup_path, mapper_name)
 
-        return self.command_executor.Execute(cryptsetup_cmd)
+        return_code = self.command_executor.Execute(cryptsetup_cmd)
+        self.invalidate_device_state()
+        return return_code
 
     #TODO error handling.
     def append_mount_info(self, dev_path, mount_point):
-        shutil.copy2('/etc/fstab', '/etc/fstab.backup.' + str(str(uuid.uuid4())))
         mount_content_item = dev_path + " " + mount_point + "  auto defaults 0 0"
-        new_mount_content = ""
-        with open("/etc/fstab",'r') as f:
-            existing_content = f.read()
-            new_mount_content = existing_content + "\n" + mount_content_item
-        with open("/etc/fstab",'w') as wf:
-            wf.write(new_mount_content)
+        with self.mount_config_batch():
+            self.get_fstab_table().append(mount_content_item)
 
     def remove_mount_info(self, mount_point):
         if not mount_point:
             self.logger.log("remove_mount_info: mount_point is empty")
             return
 
-        shutil.copy2('/etc/fstab', '/etc/fstab.backup.' + str(str(uuid.uuid4())))
-
-        filtered_contents = []
-        removed_lines = []
-
-        with open('/etc/fstab', 'r') as f:
-            for line in f.readlines():
-                line = line.strip()
-                pattern = '\s' + re.escape(mount_point) + '\s'
-
-                if re.search(pattern, line):
-                    self.logger.log("removing fstab line: {0}".format(line))
-                    removed_lines.append(line)
-                    continue
-
-                filtered_contents.append(line)
-
-        with open('/etc/fstab', 'w') as f:
-            f.write('\n')
-            f.write('\n'.join(filtered_contents))
-            f.write('\n')
+        with self.mount_config_batch():
+            removed_lines = self.get_fstab_table().remove(1, mount_point)
+            for line in removed_lines:
+                self.logger.log("removing fstab line: {0}".format(line))
 
-        self.logger.log("fstab updated successfully")
-
-        with open('/etc/fstab.azure.backup', 'a+') as f:
-            f.write('\n')
-            f.write('\n'.join(removed_lines))
-            f.write('\n')
-
-        self.logger.log("fstab.azure.backup updated successfully")
+            fstab_azure_backup_table = self.get_fstab_azure_backup_table()
+            for line in removed_lines:
+                fstab_azure_backup_table.append(line)
 
     def restore_mount_info(self, mount_point):
         if not mount_point:
             self.logger.log("restore_mount_info: mount_point is empty")
             return
 
-        shutil.copy2('/etc/fstab', '/etc/fstab.backup.' + str(str(uuid.uuid4())))
-
-        filtered_contents = []
-        removed_lines = []
-
-        with open('/etc/fstab.azure.backup', 'r') as f:
-            for line in f.readlines():
-                line = line.strip()
-                pattern = '\s' + re.escape(mount_point) + '\s'
-
-                if re.search(pattern, line):
-                    self.logger.log("removing fstab.azure.backup line: {0}".format(line))
-                    removed_lines.append(line)
-                    continue
-
-                filtered_contents.append(line)
+        with self.mount_config_batch():
+            removed_lines = self.get_fstab_azure_backup_table().remove(1, mount_point)
+            for line in removed_lines:
+                self.logger.log("removing fstab.azure.backup line: {0}".format(line))
 
-        with open('/etc/fstab.azure.backup', 'w') as f:
-            f.write('\n')
-            f.write('\n'.join(filtered_contents))
-            f.write('\n')
-
-        self.logger.log("fstab.azure.backup updated successfully")
-
-        with open('/etc/fstab', 'a+') as f:
-            f.write('\n')
-            f.write('\n'.join(removed_lines))
-            f.write('\n')
-
-        self.logger.log("fstab updated successfully")
+            fstab_table = self.get_fstab_table()
+            for line in removed_lines:
+                fstab_table.append(line)
 
     def mount_filesystem(self, dev_path, mount_point, file_system=None):
         """
@@ -498,7 +608,9 @@ class DiskUtil(object):
         else: 
             mount_cmd = self.distro_patcher.mount_path + ' ' + dev_path + ' ' + mount_point + ' -t ' + file_system
 
-        return self.command_executor.Execute(mount_cmd)
+        return_code = self.command_executor.Execute(mount_cmd)
+        self.invalidate_device_state()
+        return return_code
 
     def mount_crypt_item(self, crypt_item, passphrase):
         self.logger.log("trying to mount the crypt item:" + str(crypt_item))
@@ -507,7 +619,9 @@ class DiskUtil(object):
 
     def umount(self, path):
         umount_cmd = self.distro_patcher.umount_path + ' ' + path
-        return self.command_executor.Execute(umount_cmd)
+        return_code = self.command_executor.Execute(umount_cmd)
+        self.invalidate_device_state()
+        return return_code
 
     def umount_all_crypt_items(self):
         for crypt_item in self.get_crypt_items():
@@ -516,7 +630,9 @@ class DiskUtil(object):
 
     def mount_all(self):
         mount_all_cmd = self.distro_patcher.mount_path + ' -a'
-        return self.command_executor.Execute(mount_all_cmd)
+        return_code = self.command_executor.Execute(mount_all_cmd)
+        self.invalidate_device_state()
+        return return_code
 
     def get_mount_items(self):
         items = []
@@ -532,44 +648,25 @@ class DiskUtil(object):
 
         return items
 
+    def get_encryption_status_facts(self):
+        """
+        the mounts and the lvm and dm state are read once and kept until invalidate_encryption_status.
+        """
+        if self.encryption_status_facts is None:
+            self.encryption_status_facts = EncryptionStatusFacts(self)
+        return self.encryption_status_facts
+
     def get_encryption_status(self):
         encryption_status = {
             "data": "NotEncrypted",
             "os": "NotEncrypted"
         }
 
-        mount_items = self.get_mount_items()
-
-        os_drive_encrypted = False
-        data_drives_found = False
-        data_drives_encrypted = True
-        for mount_item in mount_items:
-            if mount_item["fs"] in ["ext2", "ext4", "ext3", "xfs"] and \
-                not "/mnt" == mount_item["dest"] and \
-                not "/" == mount_item["dest"] and \
-                not "/oldroot/mnt/resource" == mount_item["dest"] and \
-                not "/oldroot/boot" == mount_item["dest"] and \
-                not "/oldroot" == mount_item["dest"] and \
-                not "/mnt/resource" == mount_item["dest"] and \
-                not "/boot" == mount_item["dest"]:
-
-                data_drives_found = True
+        facts = self.get_encryption_status_facts()
+        os_drive_encrypted = facts.os_drive_encrypted
+        data_drives_found = facts.data_drives_found
+        data_drives_encrypted = facts.data_drives_encrypted
 
-                if not "/dev/mapper" in mount_item["src"]:
-                    self.logger.log("Data volume {0} is mounted from {1}".format(mount_item["dest"], mount_item["src"]))
-                    data_drives_encrypted = False
-
-            if self.is_os_disk_lvm():
-                grep_result = self.command_executor.ExecuteInBash('pvdisplay | grep /dev/mapper/osencrypt', suppress_logging=True)
-                if grep_result == 0 and not os.path.exists('/volumes.lvm'):
-                    self.logger.log("OS PV is encrypted")
-                    os_drive_encrypted = True
-            elif mount_item["dest"] == "/" and \
-                "/dev/mapper" in mount_item["src"] or \
-                "/dev/dm" in mount_item["src"]:
-                self.logger.log("OS volume {0} is mounted from {1}".format(mount_item["dest"], mount_item["src"]))
-                os_drive_encrypted = True
-    
         if not data_drives_found:
             encryption_status["data"] = "NotMounted"
         elif data_drives_encrypted:
@@ -748,6 +845,15 @@ class DiskUtil(object):
         return device_items_to_return
 
     def get_device_items(self, dev_path):
+        block_device_inventory = self.get_block_device_inventory()
+        if block_device_inventory is not None:
+            if dev_path:
+                self.logger.log(msg=("getting blk info for: " + str(dev_path)))
+            return block_device_inventory.get_device_items(dev_path)
+        else:
+            return self.get_device_items_lsblk(dev_path)
+
+    def get_device_items_lsblk(self, dev_path):
         if self.distro_patcher.distro_info[0].lower() == 'suse' and self.distro_patcher.distro_info[1] == '11':
             return self.get_device_items_sles(dev_path)
         else:
@@ -858,7 +964,12 @@ class DiskUtil(object):
             DiskUtil.os_disk_lvm = False
             return False
 
-        lvm_items = filter(lambda item: item.vg_name == "rootvg", self.get_lvm_items())
+        block_device_inventory = self.get_block_device_inventory()
+        if block_device_inventory is not None:
+            lvm_items = block_device_inventory.lvm_items
+        else:
+            lvm_items = self.get_lvm_items()
+        lvm_items = filter(lambda item: item.vg_name == "rootvg", lvm_items)
 
         current_lv_names = set([item.lv_name for item in lvm_items])
         expected_lv_names = set(['homelv', 'optlv', 'rootlv', 'swaplv', 'tmplv', 'usrlv', 'varlv'])
@@ -951,3 +1062,76 @@ class DiskUtil(object):
                         device = d.split(':')[1]
                         break
         return device
+
+
+class EncryptionStatusFacts(object):
+    """
+    evaluates the mounts for get_encryption_status in one pass, pvdisplay runs
+    at most once and the osencrypt device is only looked up when asked for.
+    """
+    non_data_mount_points = ["/mnt", "/", "/oldroot/mnt/resource", "/oldroot/boot", "/oldroot", "/mnt/resource", "/boot"]
+
+    def __init__(self, disk_util):
+        self.disk_util = disk_util
+        self.logger = disk_util.logger
+        self.command_executor = disk_util.command_executor
+        self.mount_items = disk_util.get_mount_items()
+        self.osencrypt_dev_path = None
+
+        self.os_drive_encrypted = False
+        self.data_drives_found = False
+        self.data_drives_encrypted = True
+
+        os_disk_lvm = len(self.mount_items) > 0 and disk_util.is_os_disk_lvm()
+        for mount_item in self.mount_items:
+            if mount_item["fs"] in ["ext2", "ext4", "ext3", "xfs"] and \
+                mount_item["dest"] not in EncryptionStatusFacts.non_data_mount_points:
+
+                self.data_drives_found = True
+
+                if not "/dev/mapper" in mount_item["src"]:
+                    self.logger.log("Data volume {0} is mounted from {1}".format(mount_item["dest"], mount_item["src"]))
+                    self.data_drives_encrypted = False
+
+            if not os_disk_lvm and \
+                (mount_item["dest"] == "/" and "/dev/mapper" in mount_item["src"] or \
+                "/dev/dm" in mount_item["src"]):
+                self.logger.log("OS volume {0} is mounted from {1}".format(mount_item["dest"], mount_item["src"]))
+                self.os_drive_encrypted = True
+
+        if os_disk_lvm and self.is_os_pv_encrypted():
+            self.logger.log("OS PV is encrypted")
+            self.os_drive_encrypted = True
+
+    def is_os_pv_encrypted(self):
+        proc_comm = ProcessCommunicator()
+        if self.command_executor.Execute('pvdisplay', communicator=proc_comm, suppress_logging=True) != 0:
+            return False
+        return '/dev/mapper/osencrypt' in proc_comm.stdout and not os.path.exists('/volumes.lvm')
+
+    def get_osencrypt_dev_path(self):
+        if self.osencrypt_dev_path is not None:
+            return self.osencrypt_dev_path
+
+        proc_comm = ProcessCommunicator()
+        self.command_executor.Execute("cryptsetup status osencrypt", communicator=proc_comm)
+        for line in (proc_comm.stdout or '').splitlines():
+            if line.strip().startswith('device:'):
+                self.osencrypt_dev_path = line.strip().split()[1]
+                return self.osencrypt_dev_path
+
+        proc_comm = ProcessCommunicator()
+        self.command_executor.Execute("dmsetup table --target crypt", communicator=proc_comm)
+
+        for line in (proc_comm.stdout or '').splitlines():
+            if 'osencrypt' in line:
+                majmin = filter(lambda p: re.match(r'\d+:\d+', p), line.split())[0]
+                block_device_inventory = self.disk_util.get_block_device_inventory()
+                if block_device_inventory is not None:
+                    src_device = block_device_inventory.get_item_by_majmin(majmin)
+                else:
+                    src_device = filter(lambda d: d.majmin == majmin, self.disk_util.get_device_items(None))[0]
+                self.osencrypt_dev_path = '/dev/' + src_device.name
+                break
+
+        return self.osencrypt_dev_path
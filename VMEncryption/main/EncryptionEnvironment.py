@@ -16,6 +16,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
+import glob
 import os
 import os.path
 import subprocess
@@ -35,12 +37,41 @@ class EncryptionEnvironment(object):
         self.azure_decrypt_request_queue_path = os.path.join(self.encryption_config_path, 'azure_decrypt_request_queue.ini')
         self.azure_crypt_ongoing_item_config_path = os.path.join(self.encryption_config_path, 'azure_crypt_ongoing_item.ini')
         self.azure_crypt_current_transactional_copy_path = os.path.join(self.encryption_config_path, 'azure_crypt_copy_progress.ini')
+        self.azure_crypt_copy_checkpoint_path = os.path.join(self.encryption_config_path, 'azure_crypt_copy_checkpoint')
+        self.azure_crypt_free_space_map_path = os.path.join(self.encryption_config_path, 'azure_crypt_free_space_map')
         self.luks_header_base_path = os.path.join(self.encryption_config_path, 'azureluksheader')
         self.cleartext_key_base_path = os.path.join(self.encryption_config_path, 'cleartext_key')
         self.copy_header_slice_file_path = os.path.join(self.encryption_config_path, 'copy_header_slice_file')
         self.copy_slice_item_backup_file = os.path.join(self.encryption_config_path, 'copy_slice_item.bak')
         self.os_encryption_markers_path = os.path.join(self.encryption_config_path, 'os_encryption_markers')
         self.bek_backup_path = os.path.join(self.encryption_config_path, 'bek_backup')
+        # set on the environments of get_item_environment
+        self.item_id = None
+
+    def get_item_environment(self, item_id):
+        """
+        a copy of the environment with its own ongoing item files, so several
+        devices can be encrypted and resumed independently.
+        """
+        item_environment = copy.copy(self)
+        item_environment.item_id = item_id
+        file_id = item_id.replace('/', '_')
+        item_environment.azure_crypt_ongoing_item_config_path = os.path.join(self.encryption_config_path, 'azure_crypt_ongoing_item_{0}.ini'.format(file_id))
+        item_environment.azure_crypt_copy_checkpoint_path = os.path.join(self.encryption_config_path, 'azure_crypt_copy_checkpoint_{0}'.format(file_id))
+        item_environment.azure_crypt_free_space_map_path = os.path.join(self.encryption_config_path, 'azure_crypt_free_space_map_{0}'.format(file_id))
+        item_environment.copy_header_slice_file_path = os.path.join(self.encryption_config_path, 'copy_header_slice_file_{0}'.format(file_id))
+        item_environment.copy_slice_item_backup_file = os.path.join(self.encryption_config_path, 'copy_slice_item_{0}.bak'.format(file_id))
+        return item_environment
+
+    def get_ongoing_item_environments(self):
+        """
+        the item environments that have an ongoing item config to resume.
+        """
+        item_environments = []
+        prefix = os.path.join(self.encryption_config_path, 'azure_crypt_ongoing_item_')
+        for config_path in sorted(glob.glob(prefix + '*.ini')):
+            item_environments.append(self.get_item_environment(config_path[len(prefix):-len('.ini')]))
+        return item_environments
 
     def get_se_linux(self):
         proc = Popen([self.patching.getenforce_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
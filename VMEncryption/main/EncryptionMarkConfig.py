@@ -29,6 +29,9 @@ class EncryptionMarkConfig(object):
         self.command = None
         self.volume_type = None
         self.diskFormatQuery = None
+        self.skip_free_space = None
+        self.parallelism = None
+        self.bandwidth = None
         self.encryption_mark_config = ConfigUtil(self.encryption_environment.azure_crypt_request_queue_path,
                                                  'encryption_request_queue',
                                                  self.logger)
@@ -39,6 +42,33 @@ class EncryptionMarkConfig(object):
     def get_encryption_disk_format_query(self):
         return self.encryption_mark_config.get_config(CommonVariables.EncryptionDiskFormatQueryKey)
 
+    def get_skip_free_space(self):
+        """
+        whether the in place encryption only copies the blocks used by the file system.
+        """
+        skip_free_space = self.encryption_mark_config.get_config(CommonVariables.SkipFreeSpaceKey)
+        return skip_free_space is not None and str(skip_free_space).lower() == 'true'
+
+    def get_parallelism(self):
+        """
+        how many physical disks are encrypted at the same time.
+        """
+        parallelism = self.encryption_mark_config.get_config(CommonVariables.EncryptionParallelismKey)
+        try:
+            return max(1, int(parallelism))
+        except (TypeError, ValueError):
+            return CommonVariables.default_encryption_parallelism
+
+    def get_bandwidth(self):
+        """
+        the copy bandwidth shared by all the disks in bytes per second, 0 is unlimited.
+        """
+        bandwidth = self.encryption_mark_config.get_config(CommonVariables.EncryptionBandwidthKey)
+        try:
+            return max(0, int(float(bandwidth) * 1024 * 1024))
+        except (TypeError, ValueError):
+            return 0
+
     def config_file_exists(self):
         """
         we should compare the timestamp of the file with the current system time
@@ -54,6 +84,12 @@ class EncryptionMarkConfig(object):
         key_value_pairs.append(volume_type)
         disk_format_query = ConfigKeyValuePair(CommonVariables.EncryptionDiskFormatQueryKey, self.diskFormatQuery)
         key_value_pairs.append(disk_format_query)
+        skip_free_space = ConfigKeyValuePair(CommonVariables.SkipFreeSpaceKey, self.skip_free_space)
+        key_value_pairs.append(skip_free_space)
+        parallelism = ConfigKeyValuePair(CommonVariables.EncryptionParallelismKey, self.parallelism)
+        key_value_pairs.append(parallelism)
+        bandwidth = ConfigKeyValuePair(CommonVariables.EncryptionBandwidthKey, self.bandwidth)
+        key_value_pairs.append(bandwidth)
         self.encryption_mark_config.save_configs(key_value_pairs)
 
     def clear_config(self):
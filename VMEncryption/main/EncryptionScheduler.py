@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+#
+# VMEncryption extension
+#
+# Copyright 2015 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.7+
+#
+
+import Queue
+import threading
+import time
+import traceback
+
+from Common import CommonVariables
+
+
+class BandwidthLimiter(object):
+    """
+    a token bucket shared by the copies that run at the same time.
+    bytes_per_second of 0 or None does not limit anything.
+    """
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second
+        self.available = float(bytes_per_second or 0)
+        self.last_time = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self, size):
+        if not self.bytes_per_second:
+            return
+        with self.lock:
+            now = time.time()
+            self.available = min(float(self.bytes_per_second),
+                                 self.available + (now - self.last_time) * self.bytes_per_second)
+            self.last_time = now
+            # a batch bigger than one second of budget is let through once the bucket is full.
+            self.available -= size
+            wait_seconds = 0
+            if self.available < 0:
+                wait_seconds = -self.available / self.bytes_per_second
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+
+
+class AggregatedProgress(object):
+    """
+    collects the status messages of the devices encrypted at the same time
+    and reports them together, at most once per min_interval_seconds.
+    """
+    min_interval_seconds = 30
+
+    def __init__(self, hutil, operation, total_count):
+        self.hutil = hutil
+        self.operation = operation
+        self.total_count = total_count
+        self.done_count = 0
+        self.messages = {}
+        self.item_names = []
+        self.last_report_time = None
+        self.lock = threading.Lock()
+
+    def get_item_hutil(self, item_name):
+        with self.lock:
+            self.item_names.append(item_name)
+        return ItemProgressHandler(self, item_name)
+
+    def update(self, item_name, message):
+        with self.lock:
+            self.messages[item_name] = message
+            self.report(force=False)
+
+    def finish(self, item_name):
+        with self.lock:
+            self.done_count += 1
+            self.messages.pop(item_name, None)
+            self.report(force=True)
+
+    def report(self, force):
+        now = time.time()
+        if not force and self.last_report_time is not None and \
+           now - self.last_report_time < AggregatedProgress.min_interval_seconds:
+            return
+        self.last_report_time = now
+        message = '{0}: {1}/{2} done'.format(self.operation, self.done_count, self.total_count)
+        active_messages = [self.messages[item_name] for item_name in self.item_names if item_name in self.messages]
+        if active_messages:
+            message += '; ' + '; '.join(active_messages)
+        self.hutil.do_status_report(operation=self.operation,
+                                    status=CommonVariables.extension_success_status,
+                                    status_code=str(CommonVariables.success),
+                                    message=message)
+
+
+class ItemProgressHandler(object):
+    """
+    stands in for the handler util of one device, its status reports go to the aggregated progress.
+    """
+    def __init__(self, aggregated_progress, item_name):
+        self.aggregated_progress = aggregated_progress
+        self.item_name = item_name
+
+    def do_status_report(self, operation, status, status_code, message):
+        self.aggregated_progress.update(self.item_name, message)
+
+    def __getattr__(self, name):
+        return getattr(self.aggregated_progress.hutil, name)
+
+
+class EncryptionWorkItem(object):
+    def __init__(self, name, physical_disks, function):
+        """
+        function is called without arguments and returns True on success.
+        """
+        self.name = name
+        self.physical_disks = set(physical_disks)
+        self.function = function
+        self.succeeded = None
+
+
+class EncryptionScheduler(object):
+    """
+    runs the work items of different physical disks at the same time, at most
+    max_parallel of them. the items sharing a physical disk, e.g. the partitions
+    of one disk or a raid over several, are run one after the other in one lane.
+    after a failure no new lane is started, the running ones finish.
+    """
+    def __init__(self, logger, max_parallel):
+        self.logger = logger
+        self.max_parallel = max(1, max_parallel)
+
+    def get_lanes(self, work_items):
+        lanes = []
+        for work_item in work_items:
+            disks = set(work_item.physical_disks)
+            lane_items = [work_item]
+            remaining_lanes = []
+            for lane_disks, items in lanes:
+                if lane_disks & disks:
+                    disks |= lane_disks
+                    lane_items = items + lane_items
+                else:
+                    remaining_lanes.append((lane_disks, items))
+            lanes = remaining_lanes + [(disks, lane_items)]
+        return [items for lane_disks, items in lanes]
+
+    def run_lane(self, lane_items):
+        for work_item in lane_items:
+            try:
+                work_item.succeeded = bool(work_item.function())
+            except Exception as e:
+                self.logger.log(msg="encrypting {0} failed: {1}, stack trace: {2}".format(work_item.name, e, traceback.format_exc()),
+                                level=CommonVariables.ErrorLevel)
+                work_item.succeeded = False
+            if not work_item.succeeded:
+                return False
+        return True
+
+    def run(self, work_items):
+        """
+        returns the work items that are not done: first the ones that failed,
+        then the ones that never ran because a failure stopped their lane or
+        kept it from starting.
+        """
+        lanes = self.get_lanes(work_items)
+        self.logger.log("encrypting {0} items in {1} lanes, {2} at a time".format(len(work_items), len(lanes), self.max_parallel))
+
+        lane_queue = Queue.Queue()
+        for lane_items in lanes:
+            lane_queue.put(lane_items)
+        failed = threading.Event()
+
+        def worker():
+            while not failed.is_set():
+                try:
+                    lane_items = lane_queue.get_nowait()
+                except Queue.Empty:
+                    return
+                if not self.run_lane(lane_items):
+                    failed.set()
+
+        threads = []
+        for i in range(min(self.max_parallel, len(lanes))):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        not_run_items = [work_item for work_item in work_items if work_item.succeeded is None]
+        if not_run_items:
+            self.logger.log(msg="not encrypted after a failure: {0}".format(', '.join(work_item.name for work_item in not_run_items)),
+                            level=CommonVariables.WarningLevel)
+        failed_items = [work_item for work_item in work_items if work_item.succeeded is False]
+        return failed_items + not_run_items
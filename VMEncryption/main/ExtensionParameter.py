@@ -59,6 +59,9 @@ class ExtensionParameter(object):
 
         self.VolumeType = public_settings.get(CommonVariables.VolumeTypeKey)
         self.DiskFormatQuery = public_settings.get(CommonVariables.DiskFormatQuerykey)
+        self.SkipFreeSpace = public_settings.get(CommonVariables.SkipFreeSpaceKey)
+        self.EncryptionParallelism = public_settings.get(CommonVariables.EncryptionParallelismKey)
+        self.EncryptionBandwidth = public_settings.get(CommonVariables.EncryptionBandwidthKey)
 
         """
         private settings
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+#
+# VMEncryption extension
+#
+# Copyright 2015 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.7+
+#
+
+import bisect
+import json
+import os
+import os.path
+import re
+
+
+class FreeSpaceMap(object):
+    """
+    the byte ranges of a device that the file system does not use.
+    everything outside of these ranges is treated as allocated, so a map
+    that could not be read completely only makes the copy do more work.
+    """
+    def __init__(self, free_ranges):
+        merged = []
+        for offset, length in sorted(free_ranges):
+            if length <= 0:
+                continue
+            if merged and merged[-1][0] + merged[-1][1] >= offset:
+                last_offset, last_length = merged[-1]
+                merged[-1] = (last_offset, max(last_length, offset + length - last_offset))
+            else:
+                merged.append((offset, length))
+        self.free_ranges = merged
+        self.offsets = [offset for offset, length in merged]
+
+    def is_free(self, offset, length):
+        """
+        true if the whole range from offset is unused by the file system.
+        """
+        position = bisect.bisect_right(self.offsets, offset) - 1
+        if position < 0:
+            return False
+        free_offset, free_length = self.free_ranges[position]
+        return offset + length <= free_offset + free_length
+
+    def get_free_size(self):
+        return sum(length for offset, length in self.free_ranges)
+
+    def save(self, path, source_path, total_size):
+        """
+        the map is only valid for the device it was read from, so that is saved along with it.
+        """
+        with open(path + '.tmp', 'w') as f:
+            f.write(json.dumps({'source' : source_path,
+                                'size' : total_size,
+                                'free' : self.free_ranges}, separators=(',', ':')))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + '.tmp', path)
+
+    @staticmethod
+    def load(path, source_path, total_size):
+        """
+        returns None if there is no map for this device.
+        """
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r') as f:
+                saved = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if saved.get('source') != source_path or saved.get('size') != total_size:
+            return None
+        return FreeSpaceMap([(long(offset), long(length)) for offset, length in saved.get('free', [])])
+
+    @staticmethod
+    def parse_dumpe2fs(output):
+        """
+        reads the indented "Free blocks:" lists under every "Group N:" of dumpe2fs.
+        the superblock summary has a "Free blocks:" line too, but that one is a count.
+        """
+        block_size = None
+        in_group = False
+        free_ranges = []
+        for line in output.splitlines():
+            if re.match(r'^Group \d+:', line):
+                in_group = True
+            elif line.startswith('Block size:'):
+                block_size = long(line.split(':', 1)[1])
+            elif in_group and line[:1].isspace() and line.strip().startswith('Free blocks:'):
+                if block_size is None:
+                    return None
+                for block_range in line.split(':', 1)[1].split(','):
+                    block_range = block_range.strip()
+                    if not block_range:
+                        continue
+                    first_block, _, last_block = block_range.partition('-')
+                    first_block = long(first_block)
+                    last_block = long(last_block) if last_block else first_block
+                    free_ranges.append((first_block * block_size, (last_block - first_block + 1) * block_size))
+        if block_size is None:
+            return None
+        return FreeSpaceMap(free_ranges)
+
+    @staticmethod
+    def parse_xfs_db(geometry_output, freesp_output):
+        """
+        geometry_output is the blocksize and agblocks of the superblock,
+        freesp_output the free extents as "agno agbno len" rows from freesp -d.
+        """
+        geometry = {}
+        for line in geometry_output.splitlines():
+            match = re.match(r'^\s*(\w+)\s*=\s*(\d+)\s*$', line)
+            if match:
+                geometry[match.group(1)] = long(match.group(2))
+        if 'blocksize' not in geometry or 'agblocks' not in geometry:
+            return None
+        block_size = geometry['blocksize']
+        ag_blocks = geometry['agblocks']
+
+        free_ranges = []
+        for line in freesp_output.splitlines():
+            match = re.match(r'^\s*(\d+)\s+(\d+)\s+(\d+)\s*$', line)
+            if match:
+                ag_number, ag_block, length = [long(value) for value in match.groups()]
+                free_ranges.append(((ag_number * ag_blocks + ag_block) * block_size, length * block_size))
+        return FreeSpaceMap(free_ranges)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+#
+# VMEncryption extension
+#
+# Copyright 2015 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.7+
+#
+
+import os
+import os.path
+import shutil
+
+
+class MountConfigTable(object):
+    """
+    a whitespace separated table like /etc/fstab or the azure crypt mount config,
+    read once and indexed by the values of key_fields, e.g. the device and the
+    mount point of fstab. comments, blank lines and the order of the lines are kept.
+    edits stay in memory until commit, which replaces the file atomically and
+    keeps the previous content in a single backup file.
+    """
+    def __init__(self, path, key_fields, logger, backup_path=None):
+        self.path = path
+        self.key_fields = key_fields
+        self.logger = logger
+        self.backup_path = backup_path
+        self.lines = []
+        self.index = {}
+        self.file_signature = None
+        self.dirty = False
+        self.load()
+
+    def get_file_signature(self):
+        try:
+            file_stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (file_stat.st_ino, file_stat.st_size, file_stat.st_mtime)
+
+    def load(self):
+        self.file_signature = self.get_file_signature()
+        self.lines = []
+        if self.file_signature is not None:
+            with open(self.path, 'r') as f:
+                self.lines = f.read().splitlines()
+        self.dirty = False
+        self.build_index()
+
+    def get_snapshot(self):
+        return (list(self.lines), self.dirty)
+
+    def restore(self, snapshot):
+        """
+        puts back the edits in memory as they were when get_snapshot was called.
+        """
+        lines, dirty = snapshot
+        self.lines = list(lines)
+        self.dirty = dirty
+        self.build_index()
+
+    def reload_if_changed(self):
+        """
+        picks up the changes made to the file by anything else since it was read.
+        """
+        if not self.dirty and self.get_file_signature() != self.file_signature:
+            self.load()
+
+    @staticmethod
+    def get_fields(line):
+        stripped = line.strip()
+        if not stripped or stripped.startswith('#'):
+            return None
+        return stripped.split()
+
+    def build_index(self):
+        self.index = {}
+        for line_number, line in enumerate(self.lines):
+            fields = MountConfigTable.get_fields(line)
+            if fields is None:
+                continue
+            for key_field in self.key_fields:
+                if key_field < len(fields):
+                    self.index.setdefault((key_field, fields[key_field]), []).append(line_number)
+
+    def get_entries(self):
+        """
+        the split fields of every line that is not blank or a comment.
+        """
+        entries = []
+        for line in self.lines:
+            fields = MountConfigTable.get_fields(line)
+            if fields is not None:
+                entries.append(fields)
+        return entries
+
+    def find(self, key_field, value):
+        """
+        the lines whose key_field is value.
+        """
+        return [self.lines[line_number] for line_number in self.index.get((key_field, value), [])]
+
+    def append(self, line):
+        self.lines.append(line)
+        line_number = len(self.lines) - 1
+        fields = MountConfigTable.get_fields(line)
+        if fields is not None:
+            for key_field in self.key_fields:
+                if key_field < len(fields):
+                    self.index.setdefault((key_field, fields[key_field]), []).append(line_number)
+        self.dirty = True
+
+    def remove(self, key_field, value):
+        """
+        removes the lines whose key_field is value and returns them.
+        """
+        line_numbers = set(self.index.get((key_field, value), []))
+        if not line_numbers:
+            return []
+        removed_lines = [self.lines[line_number] for line_number in sorted(line_numbers)]
+        self.lines = [line for line_number, line in enumerate(self.lines) if line_number not in line_numbers]
+        self.build_index()
+        self.dirty = True
+        return removed_lines
+
+    def commit(self):
+        """
+        writes the edits with a temporary file and a rename, so a crash leaves
+        either the old or the new table, never a truncated one.
+        """
+        if not self.dirty:
+            return
+        exists = os.path.exists(self.path)
+        if exists and self.backup_path is not None:
+            shutil.copy2(self.path, self.backup_path)
+
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            if self.lines:
+                f.write('\n'.join(self.lines))
+                f.write('\n')
+            f.flush()
+            os.fsync(f.fileno())
+        if exists:
+            shutil.copymode(self.path, temp_path)
+            path_stat = os.stat(self.path)
+            os.chown(temp_path, path_stat.st_uid, path_stat.st_gid)
+        os.rename(temp_path, self.path)
+
+        directory_fd = os.open(os.path.dirname(self.path) or '.', os.O_RDONLY)
+        try:
+            os.fsync(directory_fd)
+        finally:
+            os.close(directory_fd)
+
+        self.file_signature = self.get_file_signature()
+        self.dirty = False
+        self.logger.log("{0} updated with {1} lines".format(self.path, len(self.lines)))
@@ -21,6 +21,8 @@ import os.path
 import uuid
 import time
 import datetime
+import json
+import traceback
 from Common import CommonVariables
 from ConfigParser import ConfigParser
 from ConfigUtil import ConfigUtil
@@ -83,12 +85,56 @@ class OnGoingItemConfig(object):
             return long(device_size_value)
 
     def get_current_slice_index(self):
+        checkpoint = self.load_checkpoint()
+        if checkpoint is not None and checkpoint[1:] == self.get_checkpoint_key():
+            return long(checkpoint[0])
         current_slice_index_value = self.ongoing_item_config.get_config(CommonVariables.OngoingItemCurrentSliceIndexKey)
         if current_slice_index_value is None or current_slice_index_value == "":
             return None
         else:
             return long(current_slice_index_value)
 
+    def get_checkpoint_key(self):
+        """
+        the checkpoint only belongs to the copy described by these values of the config file.
+        """
+        return [str(self.get_current_source_path()),
+                str(self.get_current_destination()),
+                str(self.get_current_total_copy_size()),
+                str(self.get_current_block_size()),
+                str(self.get_from_end())]
+
+    def load_checkpoint(self):
+        checkpoint_path = self.encryption_environment.azure_crypt_copy_checkpoint_path
+        if not os.path.exists(checkpoint_path):
+            return None
+        try:
+            with open(checkpoint_path, 'r') as f:
+                checkpoint = json.load(f)
+            if isinstance(checkpoint, list) and len(checkpoint) == 6:
+                return checkpoint
+        except (IOError, ValueError) as e:
+            self.logger.log(msg="failed to load the copy checkpoint: {0}".format(e), level=CommonVariables.WarningLevel)
+        return None
+
+    def commit_slice_index(self):
+        """
+        durably records current_slice_index of the ongoing copy without rewriting the whole config file.
+        the record is small and replaced with a rename, so it is either the old or the new one after a crash.
+        """
+        checkpoint = [self.current_slice_index,
+                      str(self.current_source_path),
+                      str(self.current_destination),
+                      str(self.current_total_copy_size),
+                      str(self.current_block_size),
+                      str(self.from_end)]
+        checkpoint_path = self.encryption_environment.azure_crypt_copy_checkpoint_path
+        with open(checkpoint_path + '.tmp', 'w') as f:
+            f.write(json.dumps(checkpoint, separators=(',', ':')))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(checkpoint_path + '.tmp', checkpoint_path)
+
     def get_from_end(self):
         return self.ongoing_item_config.get_config(CommonVariables.OngoingItemFromEndKey)
 
@@ -133,6 +179,8 @@ class OnGoingItemConfig(object):
         self.current_destination = self.get_current_destination()
 
     def commit(self):
+        # the checkpoint goes first, it is only used while its key matches the config file.
+        self.commit_slice_index()
         key_value_pairs = []
         original_dev_name_path_pair = ConfigKeyValuePair(CommonVariables.OngoingItemOriginalDevNamePathKey, self.original_dev_name_path)
         key_value_pairs.append(original_dev_name_path_pair)
@@ -188,6 +236,10 @@ class OnGoingItemConfig(object):
                 time_stamp = datetime.datetime.now()
                 new_name = "{0}_{1}".format(self.encryption_environment.azure_crypt_ongoing_item_config_path, time_stamp)
                 os.rename(self.encryption_environment.azure_crypt_ongoing_item_config_path, new_name)
+                if os.path.exists(self.encryption_environment.azure_crypt_copy_checkpoint_path):
+                    os.remove(self.encryption_environment.azure_crypt_copy_checkpoint_path)
+                if os.path.exists(self.encryption_environment.azure_crypt_free_space_map_path):
+                    os.remove(self.encryption_environment.azure_crypt_free_space_map_path)
             else:
                 self.logger.log(msg=("the config file not exist: {0}".format(self.encryption_environment.azure_crypt_ongoing_item_config_path)), level = CommonVariables.WarningLevel)
             return True
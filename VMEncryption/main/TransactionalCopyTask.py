@@ -20,12 +20,13 @@ import subprocess
 import os
 import os.path
 import sys
-import shlex
-from subprocess import *
 from CommandExecutor import CommandExecutor
 from Common import CommonVariables
 from ConfigUtil import ConfigUtil
-from OnGoingItemConfig import *
+from BlockCopier import BlockCopier
+from FreeSpaceMap import FreeSpaceMap
+import threading
+import time
 
 
 class TransactionalCopyTask(object):
@@ -33,7 +34,7 @@ class TransactionalCopyTask(object):
     copy_total_size is in byte, skip_target_size is also in byte
     slice_size is in byte 50M
     """
-    def __init__(self, logger, hutil, disk_util, ongoing_item_config, patching, encryption_environment, status_prefix=''):
+    def __init__(self, logger, hutil, disk_util, ongoing_item_config, patching, encryption_environment, status_prefix='', bandwidth_limiter=None, parallelism=1):
         """
         copy_total_size is in bytes.
         """
@@ -56,239 +57,357 @@ class TransactionalCopyTask(object):
         self.patching = patching
         self.disk_util = disk_util
         self.hutil = hutil
-        self.tmpfs_mount_point = "/mnt/azure_encrypt_tmpfs"
-        self.slice_file_path = self.tmpfs_mount_point + "/slice_file"
-        self.copy_command = self.patching.dd_path
-
-    def resume_copy_internal(self, copy_slice_item_backup_file_size, skip_block, original_total_copy_size):
-        block_size_of_slice_item_backup = 512
-        #copy the left slice
-        if copy_slice_item_backup_file_size <= original_total_copy_size:
-            skip_of_slice_item_backup_file = copy_slice_item_backup_file_size / block_size_of_slice_item_backup
-            left_count = ((original_total_copy_size - copy_slice_item_backup_file_size) / block_size_of_slice_item_backup)
-            total_count = original_total_copy_size / block_size_of_slice_item_backup
-            original_device_skip_count = (self.block_size * skip_block) / block_size_of_slice_item_backup 
-            if left_count != 0:
-                dd_cmd = str(self.copy_command) \
-                       + ' if=' + self.source_dev_full_path \
-                       + ' of=' + self.encryption_environment.copy_slice_item_backup_file \
-                       + ' bs=' + str(block_size_of_slice_item_backup) \
-                       + ' skip=' + str(original_device_skip_count + skip_of_slice_item_backup_file) \
-                       + ' seek=' + str(skip_of_slice_item_backup_file) \
-                       + ' count=' + str(left_count)
-
-                return_code = self.command_executer.Execute(dd_cmd)
-                if return_code != CommonVariables.process_success:
-                    return return_code
-
-            dd_cmd = str(self.copy_command) \
-                   + ' if=' + self.encryption_environment.copy_slice_item_backup_file \
-                   + ' of=' + self.destination \
-                   + ' bs=' + str(block_size_of_slice_item_backup) \
-                   + ' seek=' + str(original_device_skip_count) \
-                   + ' count=' + str(total_count)
-
-            return_code = self.command_executer.Execute(dd_cmd)
-            if return_code != CommonVariables.process_success:
-                return return_code
-            else:
-                self.current_slice_index += 1
-                self.ongoing_item_config.current_slice_index = self.current_slice_index
-                self.ongoing_item_config.commit()
-                if os.path.exists(self.encryption_environment.copy_slice_item_backup_file):
-                    os.remove(self.encryption_environment.copy_slice_item_backup_file)
-                return return_code
+        self.block_copier = BlockCopier(logger)
+        self.bandwidth_limiter = bandwidth_limiter
+        self.parallelism = parallelism
+        # only present when the free space of the source was saved before its copy started.
+        self.free_space_map = FreeSpaceMap.load(encryption_environment.azure_crypt_free_space_map_path,
+                                                self.source_dev_full_path,
+                                                self.total_size)
+
+    def get_slice_range(self, slice_index):
+        """
+        returns the (offset, size) of the slice. copying from the end, slice 0 is the
+        partial slice at the end of the device, otherwise the partial slice is the last one.
+        """
+        if self.from_end.lower() == 'true':
+            if slice_index == 0:
+                return (self.total_size - self.last_slice_size, self.last_slice_size)
+            skip_block = (self.total_slice_size - slice_index - 1)
+            return (skip_block * self.block_size, self.block_size)
         else:
-            self.logger.log(msg="copy_slice_item_backup_file_size is bigger than original_total_copy_size",
-                            level=CommonVariables.ErrorLevel)
-            return CommonVariables.backup_slice_file_error
+            if slice_index == (self.total_slice_size - 1):
+                return (slice_index * self.block_size, self.last_slice_size)
+            return (slice_index * self.block_size, self.block_size)
 
-    def resume_copy(self):
+    def get_batch_range(self, slice_index, slice_count):
+        """
+        returns the (offset, size) of the contiguous range covered by slice_count slices from slice_index.
+        """
+        first_offset, first_size = self.get_slice_range(slice_index)
+        last_offset, last_size = self.get_slice_range(slice_index + slice_count - 1)
         if self.from_end.lower() == 'true':
-            skip_block = (self.total_slice_size - self.current_slice_index - 1)
+            return (last_offset, first_offset + first_size - last_offset)
         else:
-            skip_block = self.current_slice_index
+            return (first_offset, last_offset + last_size - first_offset)
 
-        return_code = CommonVariables.process_success
+    def is_slice_free(self, slice_index):
+        if self.free_space_map is None:
+            return False
+        slice_offset, slice_size = self.get_slice_range(slice_index)
+        return slice_size > 0 and self.free_space_map.is_free(slice_offset, slice_size)
+
+    def get_next_batch(self, slice_index, slice_count):
+        """
+        skips the free slices from slice_index, returns the first slice to copy
+        and the number of slices up to slice_count that are copied with it.
+        """
+        while slice_index < self.total_slice_size and self.is_slice_free(slice_index):
+            slice_index += 1
+        batch_count = 0
+        while batch_count < slice_count and slice_index + batch_count < self.total_slice_size \
+                and not self.is_slice_free(slice_index + batch_count):
+            batch_count += 1
+        return (slice_index, batch_count)
+
+    def resume_copy_internal(self, copy_slice_item_backup_file_size, slice_index):
+        slice_offset, slice_size = self.get_slice_range(slice_index)
+        if 0 < slice_size and copy_slice_item_backup_file_size <= slice_size:
+            # a single slice, the backup may only hold the beginning of the slice, the rest is still intact on the source.
+            slice_count = 1
+            batch_offset, batch_size = slice_offset, slice_size
+        else:
+            # a batch of slices, the backup is only renamed in place once it is complete.
+            slice_count = 1
+            batch_offset, batch_size = self.get_batch_range(slice_index, slice_count)
+            while batch_size < copy_slice_item_backup_file_size and slice_index + slice_count < self.total_slice_size:
+                slice_count += 1
+                batch_offset, batch_size = self.get_batch_range(slice_index, slice_count)
+            if batch_size != copy_slice_item_backup_file_size:
+                self.logger.log(msg="copy_slice_item_backup_file_size {0} does not match the slices from {1}".format(copy_slice_item_backup_file_size, slice_index),
+                                level=CommonVariables.ErrorLevel)
+                return CommonVariables.backup_slice_file_error
+
+        try:
+            self.block_copier.get_buffer(batch_size)
+            self.block_copier.read(path=self.encryption_environment.copy_slice_item_backup_file,
+                                   offset=0,
+                                   length=copy_slice_item_backup_file_size)
+            left_size = batch_size - copy_slice_item_backup_file_size
+            if left_size != 0:
+                self.block_copier.read(path=self.source_dev_full_path,
+                                       offset=batch_offset + copy_slice_item_backup_file_size,
+                                       length=left_size,
+                                       buffer_offset=copy_slice_item_backup_file_size)
+                self.write_backup(batch_size)
+            self.block_copier.close_path(self.encryption_environment.copy_slice_item_backup_file)
+            self.block_copier.write(path=self.destination,
+                                    offset=batch_offset,
+                                    length=batch_size)
+        except (IOError, OSError) as e:
+            self.logger.log(msg="resuming the slice copy failed: {0}".format(e), level=CommonVariables.ErrorLevel)
+            return CommonVariables.copy_data_error
+
+        self.current_slice_index += slice_count
+        self.commit_slice_index()
+        if os.path.exists(self.encryption_environment.copy_slice_item_backup_file):
+            os.remove(self.encryption_environment.copy_slice_item_backup_file)
+        return CommonVariables.process_success
 
-        if self.current_slice_index == 0:
-            if self.last_slice_size > 0:
-                if os.path.exists(self.encryption_environment.copy_slice_item_backup_file):
-                    copy_slice_item_backup_file_size = os.path.getsize(self.encryption_environment.copy_slice_item_backup_file)
-                    return_code = self.resume_copy_internal(copy_slice_item_backup_file_size=copy_slice_item_backup_file_size,
-                                                           skip_block=skip_block,
-                                                           original_total_copy_size=self.last_slice_size)
-                else:
-                    self.logger.log(msg="1. the slice item backup file not exists.",
-                                    level=CommonVariables.WarningLevel)
-            else:
-                self.logger.log(msg="the last slice",
-                                level=CommonVariables.WarningLevel)
+    def resume_copy(self):
+        return_code = CommonVariables.process_success
+        if self.current_slice_index >= self.total_slice_size:
+            self.logger.log(msg="all the slices are copied already", level=CommonVariables.WarningLevel)
+        elif os.path.exists(self.encryption_environment.copy_slice_item_backup_file):
+            copy_slice_item_backup_file_size = os.path.getsize(self.encryption_environment.copy_slice_item_backup_file)
+            return_code = self.resume_copy_internal(copy_slice_item_backup_file_size, self.current_slice_index)
         else:
-            if os.path.exists(self.encryption_environment.copy_slice_item_backup_file):
-                copy_slice_item_backup_file_size = os.path.getsize(self.encryption_environment.copy_slice_item_backup_file)
-                return_code = self.resume_copy_internal(copy_slice_item_backup_file_size, skip_block=skip_block, original_total_copy_size=self.block_size)
-            else:
-                self.logger.log(msg="2. unfortunately the slice item backup file not exists.",
-                                level=CommonVariables.WarningLevel)
+            self.logger.log(msg="the slice item backup file not exists.",
+                            level=CommonVariables.WarningLevel)
         return return_code
 
-    def copy_last_slice(self, skip_block):
-        block_size_of_last_slice = 512
-        skip_of_last_slice = (skip_block * self.block_size) / block_size_of_last_slice
-        count_of_last_slice = self.last_slice_size / block_size_of_last_slice
+    def write_backup(self, size, buffer_index=0):
+        """
+        the backup is written to a temp file and renamed, so an existing backup file is always complete.
+        """
+        backup_file = self.encryption_environment.copy_slice_item_backup_file
+        self.block_copier.write_file(backup_file + '.tmp', size, buffer_index)
+        os.rename(backup_file + '.tmp', backup_file)
 
-        copy_result = self.copy_internal(from_device=self.source_dev_full_path,
-                                         to_device = self.destination,
-                                         skip=skip_of_last_slice,
-                                         seek=skip_of_last_slice,
-                                         block_size=block_size_of_last_slice,
-                                         count = count_of_last_slice)
-        return copy_result
+    def start_read(self, slice_index, slice_count, buffer_index):
+        """
+        reads the batch into the buffer on a background thread, so it overlaps writing the previous batch.
+        """
+        batch_offset, batch_size = self.get_batch_range(slice_index, slice_count)
+        if self.bandwidth_limiter is not None:
+            self.bandwidth_limiter.acquire(batch_size)
+        pending_read = PendingRead(slice_index, slice_count, batch_offset, batch_size, buffer_index)
+        def read():
+            try:
+                if batch_size > 0:
+                    pending_read.read_size = self.block_copier.read(path=self.source_dev_full_path,
+                                                                    offset=batch_offset,
+                                                                    length=batch_size,
+                                                                    buffer_index=buffer_index)
+            except Exception as e:
+                pending_read.error = e
+        pending_read.thread = threading.Thread(target=read)
+        pending_read.thread.daemon = True
+        pending_read.thread.start()
+        return pending_read
+
+    def write_batch(self, pending_read):
+        """
+        saves the batch to the backup slice file, then writes it to the destination.
+        """
+        if pending_read.error is not None:
+            self.logger.log(msg="reading {0} bytes at {1} from {2} failed: {3}".format(pending_read.batch_size, pending_read.batch_offset, self.source_dev_full_path, pending_read.error),
+                            level=CommonVariables.ErrorLevel)
+            return CommonVariables.copy_data_error
+        if pending_read.read_size != pending_read.batch_size:
+            self.logger.log(msg="read {0} of {1} bytes at {2} from {3}".format(pending_read.read_size, pending_read.batch_size, pending_read.batch_offset, self.source_dev_full_path),
+                            level=CommonVariables.ErrorLevel)
+            return CommonVariables.copy_data_error
+        if pending_read.batch_size > 0:
+            try:
+                self.write_backup(pending_read.batch_size, pending_read.buffer_index)
+                self.block_copier.write(path=self.destination,
+                                        offset=pending_read.batch_offset,
+                                        length=pending_read.batch_size,
+                                        buffer_index=pending_read.buffer_index)
+            except (IOError, OSError) as e:
+                self.logger.log(msg="writing {0} bytes at {1} to {2} failed: {3}".format(pending_read.batch_size, pending_read.batch_offset, self.destination, e),
+                                level=CommonVariables.ErrorLevel)
+                return CommonVariables.copy_data_error
+            #the copy done correctly, so clear the backup slice file item.
+            os.remove(self.encryption_environment.copy_slice_item_backup_file)
+        return CommonVariables.process_success
+
+    def get_copied_size(self, slice_index):
+        if slice_index <= 0:
+            return 0
+        if slice_index >= self.total_slice_size:
+            return self.total_size
+        batch_offset, batch_size = self.get_batch_range(0, slice_index)
+        return batch_size
+
+    def commit_slice_index(self):
+        self.ongoing_item_config.current_slice_index = self.current_slice_index
+        self.ongoing_item_config.commit_slice_index()
 
     def begin_copy(self):
         """
-        check the device_item size first, cut it
+        copies the slices with double buffering: the next batch of slices is read while
+        the current one is written. the number of slices per batch is tuned by the
+        measured throughput, the slice boundaries and indexes stay the same so the
+        ongoing item config can always be resumed.
         """
         self.resume_copy()
-        if self.from_end.lower() == 'true':
-            while self.current_slice_index < self.total_slice_size:
-                skip_block = (self.total_slice_size - self.current_slice_index - 1)
-
-                if self.current_slice_index == 0:
-                    if self.last_slice_size > 0:
-                        copy_result = self.copy_last_slice(skip_block)
-                        if copy_result != CommonVariables.process_success:
-                            return copy_result
-                    else:
-                        self.logger.log(msg = "the last slice size is zero, so skip the 0 index.")
-                else:
-                    copy_result = self.copy_internal(from_device=self.source_dev_full_path,
-                                                     to_device=self.destination,
-                                                     skip=skip_block,
-                                                     seek=skip_block,
-                                                     block_size=self.block_size)
-
-                    if copy_result != CommonVariables.process_success:
-                        return copy_result
-
-                self.current_slice_index += 1
-
-                if self.status_prefix:
-                    msg = self.status_prefix + ': ' \
-                        + str(int(self.current_slice_index / (float)(self.total_slice_size) * 100.0)) \
-                        + '%'
-
-                    self.hutil.do_status_report(operation='DataCopy',
-                                                status=CommonVariables.extension_success_status,
-                                                status_code=str(CommonVariables.success),
-                                                message=msg)
-
-                self.ongoing_item_config.current_slice_index = self.current_slice_index
-                self.ongoing_item_config.commit()
-
-            return CommonVariables.process_success
-        else:
-            while self.current_slice_index < self.total_slice_size:
-                skip_block = self.current_slice_index
-
-                if self.current_slice_index == (self.total_slice_size - 1):
-                    if self.last_slice_size > 0:
-                        copy_result = self.copy_last_slice(skip_block)
-                        if copy_result != CommonVariables.process_success:
-                            return copy_result
-                    else:
-                        self.logger.log(msg = "the last slice size is zero, so skip the last slice index.")
-                else:
-                    copy_result = self.copy_internal(from_device=self.source_dev_full_path,
-                                                     to_device=self.destination,
-                                                     skip=skip_block,
-                                                     seek=skip_block,
-                                                     block_size=self.block_size)
-
-                    if copy_result != CommonVariables.process_success:
-                        return copy_result
-
-                self.current_slice_index += 1
-
-                if self.status_prefix:
-                    msg = self.status_prefix + ': ' \
-                        + str(int(self.current_slice_index / (float)(self.total_slice_size) * 100.0)) \
-                        + '%'
-
-                    self.hutil.do_status_report(operation='DataCopy',
-                                                status=CommonVariables.extension_success_status,
-                                                status_code=str(CommonVariables.success),
-                                                message=msg)
-
-                self.hutil.do_status_report(operation='DataCopy',
-                                            status=CommonVariables.extension_success_status,
-                                            status_code=str(CommonVariables.success),
-                                            message=msg)
-
-                self.ongoing_item_config.current_slice_index = self.current_slice_index
-                self.ongoing_item_config.commit()
+        if self.current_slice_index >= self.total_slice_size:
             return CommonVariables.process_success
 
+        progress_reporter = CopyProgressReporter(self.hutil, self.status_prefix, self.total_size, self.get_copied_size(self.current_slice_index))
+        tuner = SliceCountTuner(self.logger, self.block_size, get_copy_memory_budget(), self.parallelism)
+        if self.free_space_map is not None:
+            self.logger.log(msg="skipping the free slices of {0}".format(self.source_dev_full_path))
+        buffer_index = 0
+        next_slice_index, slice_count = self.get_next_batch(self.current_slice_index, tuner.slice_count)
+        # the backup slice file always belongs to the committed index, so the skipped slices are committed first.
+        if next_slice_index != self.current_slice_index:
+            self.current_slice_index = next_slice_index
+            self.commit_slice_index()
+        pending_read = None
+        if next_slice_index < self.total_slice_size:
+            pending_read = self.start_read(next_slice_index, slice_count, buffer_index)
+        while pending_read is not None:
+            batch_start_time = time.time()
+            pending_read.thread.join()
+
+            next_slice_index, slice_count = self.get_next_batch(pending_read.slice_index + pending_read.slice_count,
+                                                                tuner.slice_count)
+            next_read = None
+            if next_slice_index < self.total_slice_size:
+                buffer_index = 1 - buffer_index
+                next_read = self.start_read(next_slice_index, slice_count, buffer_index)
+
+            copy_result = self.write_batch(pending_read)
+            if copy_result != CommonVariables.process_success:
+                if next_read is not None:
+                    next_read.thread.join()
+                return copy_result
+
+            self.current_slice_index = next_slice_index
+            self.commit_slice_index()
+            progress_reporter.report(self.get_copied_size(self.current_slice_index))
+
+            tuner.add_sample(pending_read.batch_size, time.time() - batch_start_time)
+            pending_read = next_read
+
+        return CommonVariables.process_success
+
+    def close(self):
+        self.block_copier.close()
+
+
+class CopyProgressReporter(object):
     """
-    TODO: if the copy failed?
+    reports the copy progress with the throughput and the remaining time.
+    a status report rewrites the status file, so it is only done when the
+    percentage moved by min_percent_delta and min_interval_seconds passed,
+    or when the copy is done.
     """
-    def copy_internal(self, from_device, to_device,  block_size, skip=0, seek=0, count=1):
-        """
-        first, copy the data to the middle cache
-        """
-        dd_cmd = str(self.copy_command) \
-               + ' if=' + from_device \
-               + ' of=' + self.slice_file_path \
-               + ' bs=' + str(block_size) \
-               + ' skip=' + str(skip) \
-               + ' count=' + str(count)
-
-        return_code = self.command_executer.Execute(dd_cmd)
-        if return_code != CommonVariables.process_success:
-            self.logger.log(msg="{0} is {1}".format(dd_cmd, return_code), level=CommonVariables.ErrorLevel)
-            return return_code
-        else:
-            slice_file_size = os.path.getsize(self.slice_file_path)
-            self.logger.log(msg=("slice_file_size is: {0}".format(slice_file_size)))
-            """
-            second, copy the data in the middle cache to the backup slice.
-            """
-            backup_slice_item_cmd = str(self.copy_command) \
-                                  + ' if=' + self.slice_file_path \
-                                  + ' of=' + self.encryption_environment.copy_slice_item_backup_file \
-                                  + ' bs=' + str(block_size) \
-                                  + ' count=' + str(count)
-            backup_slice_args = shlex.split(backup_slice_item_cmd)
-            backup_process = Popen(backup_slice_args)
-            self.logger.log("backup_slice_item_cmd is:{0}".format(backup_slice_item_cmd))
-
-            """
-            third, copy the data in the middle cache to the target device.
-            """
-            dd_cmd = str(self.copy_command) + ' if=' + self.slice_file_path + ' of=' + to_device + ' bs=' + str(block_size) + ' seek=' + str(seek) + ' count=' + str(count)
-            return_code = self.command_executer.Execute(dd_cmd)
-            if return_code != CommonVariables.process_success:
-                self.logger.log(msg=("{0} is: {1}".format(dd_cmd, return_code)), level = CommonVariables.ErrorLevel)
-            else:
-                #the copy done correctly, so clear the backup slice file item.
-                backup_process.kill()
-                if os.path.exists(self.encryption_environment.copy_slice_item_backup_file):
-                    self.logger.log(msg = "clean up the backup file")
-                    os.remove(self.encryption_environment.copy_slice_item_backup_file)
-                if os.path.exists(self.slice_file_path):
-                    self.logger.log(msg = "clean up the slice file")
-                    os.remove(self.slice_file_path)
-            return return_code
-
-    def prepare_mem_fs(self):
-        self.disk_util.make_sure_path_exists(self.tmpfs_mount_point)
-        commandToExecute = self.patching.mount_path + " -t tmpfs -o size=" + str(self.block_size + 1024) + " tmpfs " + self.tmpfs_mount_point
-        self.logger.log("prepare mem fs script is: {0}".format(commandToExecute))
-        return_code = self.command_executer.Execute(commandToExecute)
-        return return_code
+    min_interval_seconds = 30
+    min_percent_delta = 1
 
-    def clear_mem_fs(self):
-        commandToExecute = self.patching.umount_path + " " + self.tmpfs_mount_point
-        return_code = self.command_executer.Execute(commandToExecute)
-        return return_code
+    def __init__(self, hutil, status_prefix, total_size, copied_size):
+        self.hutil = hutil
+        self.status_prefix = status_prefix
+        self.total_size = total_size
+        self.start_time = time.time()
+        self.start_copied_size = copied_size
+        self.last_report_time = None
+        self.last_report_percent = None
+
+    def get_percent(self, copied_size):
+        if self.total_size <= 0:
+            return 100
+        return int(copied_size / float(self.total_size) * 100.0)
+
+    def get_message(self, copied_size):
+        elapsed = time.time() - self.start_time
+        throughput = (copied_size - self.start_copied_size) / max(elapsed, 0.001)
+        msg = '{0}: {1}%, {2:.1f} MB/s'.format(self.status_prefix, self.get_percent(copied_size), throughput / (1024 * 1024))
+        if 0 < throughput and copied_size < self.total_size:
+            eta = int((self.total_size - copied_size) / throughput)
+            msg += ', ETA {0:02d}:{1:02d}:{2:02d}'.format(eta / 3600, (eta / 60) % 60, eta % 60)
+        return msg
+
+    def report(self, copied_size):
+        if not self.status_prefix:
+            return
+        now = time.time()
+        percent = self.get_percent(copied_size)
+        if copied_size < self.total_size and self.last_report_time is not None:
+            if now - self.last_report_time < CopyProgressReporter.min_interval_seconds:
+                return
+            if percent - self.last_report_percent < CopyProgressReporter.min_percent_delta:
+                return
+        self.last_report_time = now
+        self.last_report_percent = percent
+        self.hutil.do_status_report(operation='DataCopy',
+                                    status=CommonVariables.extension_success_status,
+                                    status_code=str(CommonVariables.success),
+                                    message=self.get_message(copied_size))
+
+
+class PendingRead(object):
+    def __init__(self, slice_index, slice_count, batch_offset, batch_size, buffer_index):
+        self.slice_index = slice_index
+        self.slice_count = slice_count
+        self.batch_offset = batch_offset
+        self.batch_size = batch_size
+        self.buffer_index = buffer_index
+        self.read_size = 0
+        self.error = None
+        self.thread = None
+
+
+def get_copy_memory_budget():
+    """
+    a quarter of the available memory, split by the two copy buffers of one copy.
+    """
+    available = None
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            meminfo = {}
+            for line in f:
+                fields = line.split()
+                meminfo[fields[0].rstrip(':')] = long(fields[1]) * 1024
+        available = meminfo.get('MemAvailable')
+        if available is None:
+            available = meminfo['MemFree'] + meminfo.get('Cached', 0)
+    except (IOError, KeyError, ValueError, IndexError):
+        return CommonVariables.default_block_size
+    return min(available / 8, CommonVariables.max_copy_buffer_size)
+
+
+class SliceCountTuner(object):
+    """
+    grows the number of slices read and written at once while it raises the throughput.
+    each size is measured over a window of copied bytes, once a bigger batch does
+    not help any more the best one is kept for the rest of the copy.
+    the memory budget is shared by the parallel copies.
+    """
+    window_size = 1024 * 1024 * 1024
+
+    def __init__(self, logger, block_size, memory_budget, parallelism=1):
+        self.logger = logger
+        self.max_slice_count = max(1, memory_budget / max(1, parallelism) / block_size)
+        self.slice_count = 1
+        self.best_slice_count = 1
+        self.best_throughput = 0
+        self.settled = self.max_slice_count == 1
+        self.window_bytes = 0
+        self.window_seconds = 0.0
+
+    def add_sample(self, size, seconds):
+        if self.settled:
+            return
+        self.window_bytes += size
+        self.window_seconds += seconds
+        if self.window_bytes < SliceCountTuner.window_size:
+            return
+
+        throughput = self.window_bytes / max(self.window_seconds, 0.001)
+        self.logger.log(msg="copy throughput with {0} slices per batch: {1} MB/s".format(self.slice_count, throughput / (1024 * 1024)))
+        self.window_bytes = 0
+        self.window_seconds = 0.0
+        if throughput > self.best_throughput * 1.05:
+            self.best_throughput = throughput
+            self.best_slice_count = self.slice_count
+            if self.slice_count * 2 <= self.max_slice_count:
+                self.slice_count *= 2
+                return
+        self.slice_count = self.best_slice_count
+        self.settled = True
+        self.logger.log(msg="copying with {0} slices per batch".format(self.slice_count))
@@ -32,6 +32,7 @@ import sys
 import datetime
 import time
 import tempfile
+import threading
 import traceback
 import urllib2
 import urlparse
@@ -48,6 +49,7 @@ from patch import *
 from BekUtil import *
 from DecryptionMarkConfig import DecryptionMarkConfig
 from EncryptionMarkConfig import EncryptionMarkConfig
+from EncryptionScheduler import *
 from EncryptionEnvironment import EncryptionEnvironment
 from MachineIdentity import MachineIdentity
 from OnGoingItemConfig import OnGoingItemConfig
@@ -355,15 +357,23 @@ def none_or_empty(obj):
     else:
         return False
 
+# the devices encrypted at the same time share the se linux state, it is enabled again by the last one.
+se_linux_lock = threading.Lock()
+se_linux_disable_count = [0]
+
 def toggle_se_linux_for_centos7(disable):
     if DistroPatcher.distro_info[0].lower() == 'centos' and DistroPatcher.distro_info[1].startswith('7.0'):
-        if disable:
-            se_linux_status = encryption_environment.get_se_linux()
-            if se_linux_status.lower() == 'enforcing':
-                encryption_environment.disable_se_linux()
-                return True
-        else:
-            encryption_environment.enable_se_linux()
+        with se_linux_lock:
+            if disable:
+                se_linux_disable_count[0] += 1
+                se_linux_status = encryption_environment.get_se_linux()
+                if se_linux_status.lower() == 'enforcing':
+                    encryption_environment.disable_se_linux()
+                    return True
+            else:
+                se_linux_disable_count[0] = max(0, se_linux_disable_count[0] - 1)
+                if se_linux_disable_count[0] == 0:
+                    encryption_environment.enable_se_linux()
     return False
 
 def mount_encrypted_disks(disk_util, bek_util, passphrase_file, encryption_config):
@@ -434,11 +444,17 @@ def main():
         elif re.match("^([-/]*)(daemon)", a):
             daemon()
 
-def mark_encryption(command, volume_type, disk_format_query):
+def mark_encryption(command, volume_type, disk_format_query, skip_free_space=None, parallelism=None, bandwidth=None):
     encryption_marker = EncryptionMarkConfig(logger, encryption_environment)
     encryption_marker.command = command
     encryption_marker.volume_type = volume_type
     encryption_marker.diskFormatQuery = disk_format_query
+    if skip_free_space is not None:
+        encryption_marker.skip_free_space = str(skip_free_space)
+    if parallelism is not None:
+        encryption_marker.parallelism = str(parallelism)
+    if bandwidth is not None:
+        encryption_marker.bandwidth = str(bandwidth)
     encryption_marker.commit()
     return encryption_marker
 
@@ -610,7 +626,10 @@ def enable_encryption():
                 logger.log(msg="config file exists and passphrase file exists.", level=CommonVariables.WarningLevel)
                 encryption_marker = mark_encryption(command=extension_parameter.command,
                                                     volume_type=extension_parameter.VolumeType,
-                                                    disk_format_query=extension_parameter.DiskFormatQuery)
+                                                    disk_format_query=extension_parameter.DiskFormatQuery,
+                                                    skip_free_space=extension_parameter.SkipFreeSpace,
+                                                    parallelism=extension_parameter.EncryptionParallelism,
+                                                    bandwidth=extension_parameter.EncryptionBandwidth)
                 start_daemon('EnableEncryption')
             else:
                 """
@@ -681,7 +700,10 @@ def enable_encryption():
    
                 encryption_marker = mark_encryption(command=extension_parameter.command,
                                                     volume_type=extension_parameter.VolumeType,
-                                                    disk_format_query=extension_parameter.DiskFormatQuery)
+                                                    disk_format_query=extension_parameter.DiskFormatQuery,
+                                                    skip_free_space=extension_parameter.SkipFreeSpace,
+                                                    parallelism=extension_parameter.EncryptionParallelism,
+                                                    bandwidth=extension_parameter.EncryptionBandwidth)
 
                 if kek_secret_id_created:
                     hutil.do_exit(exit_code=0,
@@ -786,11 +808,15 @@ def enable_encryption_format(passphrase, encryption_marker, disk_util):
                     else:
                         crypt_item_to_update.mount_point = os.path.join("/mnt/", mapper_name)
 
-                    logger.log(msg="removing entry for unencrypted drive from fstab", level=CommonVariables.InfoLevel)
-                    disk_util.remove_mount_info(crypt_item_to_update.mount_point)
-
                     disk_util.make_sure_path_exists(crypt_item_to_update.mount_point)
-                    update_crypt_item_result = disk_util.add_crypt_item(crypt_item_to_update)
+                    try:
+                        with disk_util.mount_config_batch():
+                            logger.log(msg="removing entry for unencrypted drive from fstab", level=CommonVariables.InfoLevel)
+                            disk_util.remove_mount_info(crypt_item_to_update.mount_point)
+                            update_crypt_item_result = disk_util.add_crypt_item(crypt_item_to_update)
+                    except Exception as e:
+                        logger.log(msg="writing the mount config failed: {0}".format(e), level=CommonVariables.ErrorLevel)
+                        update_crypt_item_result = False
                     if not update_crypt_item_result:
                         logger.log(msg="update crypt item failed", level=CommonVariables.ErrorLevel)
 
@@ -814,7 +840,7 @@ def encrypt_inplace_without_seperate_header_file(passphrase_file,
     logger.log("encrypt_inplace_without_seperate_header_file")
     current_phase = CommonVariables.EncryptionPhaseBackupHeader
     if ongoing_item_config is None:
-        ongoing_item_config = OnGoingItemConfig(encryption_environment = encryption_environment, logger = logger)
+        ongoing_item_config = OnGoingItemConfig(encryption_environment = disk_util.encryption_environment, logger = logger)
         ongoing_item_config.current_block_size = CommonVariables.default_block_size
         ongoing_item_config.current_slice_index = 0
         ongoing_item_config.device_size = device_item.size
@@ -870,15 +896,15 @@ def encrypt_inplace_without_seperate_header_file(passphrase_file,
             else:
                 ongoing_item_config.current_slice_index = 0
                 ongoing_item_config.current_source_path = original_dev_path
-                ongoing_item_config.current_destination = encryption_environment.copy_header_slice_file_path
+                ongoing_item_config.current_destination = disk_util.encryption_environment.copy_header_slice_file_path
                 ongoing_item_config.current_total_copy_size = CommonVariables.default_block_size
                 ongoing_item_config.from_end = False
-                ongoing_item_config.header_slice_file_path = encryption_environment.copy_header_slice_file_path
+                ongoing_item_config.header_slice_file_path = disk_util.encryption_environment.copy_header_slice_file_path
                 ongoing_item_config.original_dev_path = original_dev_path
                 ongoing_item_config.commit()
-                if os.path.exists(encryption_environment.copy_header_slice_file_path):
+                if os.path.exists(disk_util.encryption_environment.copy_header_slice_file_path):
                     logger.log(msg="the header slice file is there, remove it.", level = CommonVariables.WarningLevel)
-                    os.remove(encryption_environment.copy_header_slice_file_path)
+                    os.remove(disk_util.encryption_environment.copy_header_slice_file_path)
 
                 copy_result = disk_util.copy(ongoing_item_config=ongoing_item_config, status_prefix=status_prefix)
 
@@ -963,20 +989,26 @@ def encrypt_inplace_without_seperate_header_file(passphrase_file,
                     crypt_item_to_update.mount_point = "None"
                 else:
                     crypt_item_to_update.mount_point = mount_point
-                update_crypt_item_result = disk_util.add_crypt_item(crypt_item_to_update)
+                # the crypt mount config and fstab are written together.
+                try:
+                    with disk_util.mount_config_batch():
+                        update_crypt_item_result = disk_util.add_crypt_item(crypt_item_to_update)
+
+                        if mount_point:
+                            logger.log(msg="removing entry for unencrypted drive from fstab",
+                                       level=CommonVariables.InfoLevel)
+                            disk_util.remove_mount_info(mount_point)
+                        else:
+                            logger.log(msg=original_dev_name_path + " is not defined in fstab, no need to update",
+                                       level=CommonVariables.InfoLevel)
+                except Exception as e:
+                    logger.log(msg="writing the mount config failed: {0}".format(e), level=CommonVariables.ErrorLevel)
+                    update_crypt_item_result = False
                 if not update_crypt_item_result:
                     logger.log(msg="update crypt item failed", level=CommonVariables.ErrorLevel)
 
-                if mount_point:
-                    logger.log(msg="removing entry for unencrypted drive from fstab",
-                               level=CommonVariables.InfoLevel)
-                    disk_util.remove_mount_info(mount_point)
-                else:
-                    logger.log(msg=original_dev_name_path + " is not defined in fstab, no need to update",
-                               level=CommonVariables.InfoLevel)
-
-                if os.path.exists(encryption_environment.copy_header_slice_file_path):
-                    os.remove(encryption_environment.copy_header_slice_file_path)
+                if os.path.exists(disk_util.encryption_environment.copy_header_slice_file_path):
+                    os.remove(disk_util.encryption_environment.copy_header_slice_file_path)
 
                 current_phase = CommonVariables.EncryptionPhaseDone
                 ongoing_item_config.phase = current_phase
@@ -1003,14 +1035,16 @@ def encrypt_inplace_with_seperate_header_file(passphrase_file,
                                               disk_util,
                                               bek_util,
                                               status_prefix='',
-                                              ongoing_item_config=None):
+                                              ongoing_item_config=None,
+                                              skip_free_space=False):
     """
     if ongoing_item_config is not None, then this is a resume case.
+    if skip_free_space is True, the blocks the file system does not use are not copied.
     """
     logger.log("encrypt_inplace_with_seperate_header_file")
     current_phase = CommonVariables.EncryptionPhaseEncryptDevice
     if ongoing_item_config is None:
-        ongoing_item_config = OnGoingItemConfig(encryption_environment=encryption_environment,
+        ongoing_item_config = OnGoingItemConfig(encryption_environment=disk_util.encryption_environment,
                                                 logger=logger)
         mapper_name = str(uuid.uuid4())
         ongoing_item_config.current_block_size = CommonVariables.default_block_size
@@ -1057,6 +1091,11 @@ def encrypt_inplace_with_seperate_header_file(passphrase_file,
                                level=CommonVariables.ErrorLevel)
                     return current_phase
                 else:
+                    if skip_free_space:
+                        # the header is seperate, so the file system is still intact on the device.
+                        disk_util.save_free_space_map(dev_path=original_dev_path,
+                                                      file_system=ongoing_item_config.get_file_system(),
+                                                      total_size=ongoing_item_config.get_device_size())
                     ongoing_item_config.phase = CommonVariables.EncryptionPhaseCopyData
                     ongoing_item_config.commit()
                     current_phase = CommonVariables.EncryptionPhaseCopyData
@@ -1291,16 +1330,30 @@ def enable_encryption_all_in_place(passphrase_file, encryption_marker, disk_util
                            status_code=str(CommonVariables.success),
                            message=msg)
 
-    for device_num, device_item in enumerate(device_items_to_encrypt):
-        umount_status_code = CommonVariables.success
-        if device_item.mount_point is not None and device_item.mount_point != "":
-            umount_status_code = disk_util.umount(device_item.mount_point)
-        if umount_status_code != CommonVariables.success:
-            logger.log("error occured when do the umount for: {0} with code: {1}".format(device_item.mount_point, umount_status_code))
-        else:
+    aggregated_progress = AggregatedProgress(hutil, 'EnableEncryption', len(device_items_to_encrypt))
+    scheduler = EncryptionScheduler(logger=logger, max_parallel=encryption_marker.get_parallelism())
+    bandwidth_limiter = BandwidthLimiter(encryption_marker.get_bandwidth())
+    skip_free_space = encryption_marker.get_skip_free_space()
+    no_header_file_support = not_support_header_option_distro(DistroPatcher)
+
+    def get_encrypt_function(device_num, device_item):
+        def encrypt_device_item():
+            umount_status_code = CommonVariables.success
+            if device_item.mount_point is not None and device_item.mount_point != "":
+                umount_status_code = disk_util.umount(device_item.mount_point)
+            if umount_status_code != CommonVariables.success:
+                logger.log("error occured when do the umount for: {0} with code: {1}".format(device_item.mount_point, umount_status_code))
+                return False
+
             encrypted_items.append(device_item.uuid)
             logger.log(msg=("encrypting: {0}".format(device_item)))
-            no_header_file_support = not_support_header_option_distro(DistroPatcher)
+            # every device keeps its ongoing item config and copy backups in its own files.
+            item_disk_util = DiskUtil(hutil=aggregated_progress.get_item_hutil(device_item.name),
+                                      patching=DistroPatcher,
+                                      logger=logger,
+                                      encryption_environment=encryption_environment.get_item_environment(device_item.name))
+            item_disk_util.copy_bandwidth_limiter = bandwidth_limiter
+            item_disk_util.copy_parallelism = scheduler.max_parallel
             status_prefix = "Encrypting data volume {0}/{1}".format(device_num + 1,
                                                                     len(device_items_to_encrypt))
 
@@ -1311,24 +1364,102 @@ def enable_encryption_all_in_place(passphrase_file, encryption_marker, disk_util
 
                 encryption_result_phase = encrypt_inplace_without_seperate_header_file(passphrase_file=passphrase_file,
                                                                                        device_item=device_item,
-                                                                                       disk_util=disk_util,
+                                                                                       disk_util=item_disk_util,
                                                                                        bek_util=bek_util,
                                                                                        status_prefix=status_prefix)
             else:
                 encryption_result_phase = encrypt_inplace_with_seperate_header_file(passphrase_file=passphrase_file,
                                                                                     device_item=device_item,
-                                                                                    disk_util=disk_util,
+                                                                                    disk_util=item_disk_util,
                                                                                     bek_util=bek_util,
-                                                                                    status_prefix=status_prefix)
-                
-            if encryption_result_phase == CommonVariables.EncryptionPhaseDone:
-                continue
-            else:
-                # do exit to exit from this round
-                return device_item
+                                                                                    status_prefix=status_prefix,
+                                                                                    skip_free_space=skip_free_space)
+            aggregated_progress.finish(device_item.name)
+            return encryption_result_phase == CommonVariables.EncryptionPhaseDone
+        return encrypt_device_item
+
+    work_items = []
+    for device_num, device_item in enumerate(device_items_to_encrypt):
+        work_items.append(EncryptionWorkItem(name=device_item.name,
+                                             physical_disks=disk_util.get_physical_disks(device_item),
+                                             function=get_encrypt_function(device_num, device_item)))
+
+    failed_work_items = scheduler.run(work_items)
+    # the mounts and mappers changed under the shared disk_util.
+    disk_util.invalidate_device_state()
+    if failed_work_items:
+        # do exit to exit from this round
+        return device_items_to_encrypt[work_items.index(failed_work_items[0])]
     return None
 
 
+def resume_encryption_all_in_place(ongoing_item_configs, encryption_marker, disk_util, bek_util, bek_passphrase_file):
+    """
+    resumes the devices that were being encrypted when the machine rebooted,
+    returns the ongoing item configs that failed.
+    """
+    aggregated_progress = AggregatedProgress(hutil, 'EnableEncryption', len(ongoing_item_configs))
+    scheduler = EncryptionScheduler(logger=logger, max_parallel=encryption_marker.get_parallelism())
+    bandwidth_limiter = BandwidthLimiter(encryption_marker.get_bandwidth())
+    skip_free_space = encryption_marker.get_skip_free_space()
+    block_device_inventory = disk_util.get_block_device_inventory()
+
+    def get_resume_function(ongoing_item_config, item_name):
+        def resume_ongoing_item():
+            header_file_path = ongoing_item_config.get_header_file_path()
+            mount_point = ongoing_item_config.get_mount_point()
+            status_prefix = "Resuming encryption after reboot"
+            if not none_or_empty(mount_point):
+                logger.log("mount point is not empty {0}, trying to unmount it first.".format(mount_point))
+                umount_status_code = disk_util.umount(mount_point)
+                logger.log("unmount return code is {0}".format(umount_status_code))
+            item_disk_util = DiskUtil(hutil=aggregated_progress.get_item_hutil(item_name),
+                                      patching=DistroPatcher,
+                                      logger=logger,
+                                      encryption_environment=ongoing_item_config.encryption_environment)
+            item_disk_util.copy_bandwidth_limiter = bandwidth_limiter
+            item_disk_util.copy_parallelism = scheduler.max_parallel
+            if none_or_empty(header_file_path):
+                encryption_result_phase = encrypt_inplace_without_seperate_header_file(passphrase_file=bek_passphrase_file,
+                                                                                       device_item=None,
+                                                                                       disk_util=item_disk_util,
+                                                                                       bek_util=bek_util,
+                                                                                       status_prefix=status_prefix,
+                                                                                       ongoing_item_config=ongoing_item_config)
+                #TODO mount it back when shrink failed
+            else:
+                encryption_result_phase = encrypt_inplace_with_seperate_header_file(passphrase_file=bek_passphrase_file,
+                                                                                    device_item=None,
+                                                                                    disk_util=item_disk_util,
+                                                                                    bek_util=bek_util,
+                                                                                    status_prefix=status_prefix,
+                                                                                    ongoing_item_config=ongoing_item_config,
+                                                                                    skip_free_space=skip_free_space)
+            aggregated_progress.finish(item_name)
+            if encryption_result_phase != CommonVariables.EncryptionPhaseDone:
+                return False
+            ongoing_item_config.clear_config()
+            return True
+        return resume_ongoing_item
+
+    work_items = []
+    for ongoing_item_config in ongoing_item_configs:
+        original_dev_path = ongoing_item_config.get_original_dev_path()
+        physical_disks = [original_dev_path]
+        device_item = None
+        if block_device_inventory is not None:
+            device_item = block_device_inventory.get_item_by_path(original_dev_path)
+        if device_item is not None:
+            physical_disks = disk_util.get_physical_disks(device_item)
+        work_items.append(EncryptionWorkItem(name=original_dev_path,
+                                             physical_disks=physical_disks,
+                                             function=get_resume_function(ongoing_item_config, original_dev_path)))
+
+    failed_work_items = scheduler.run(work_items)
+    disk_util.invalidate_device_state()
+    return [ongoing_item_configs[work_items.index(work_item)] for work_item in failed_work_items]
+
+
 def disable_encryption_all_in_place(passphrase_file, decryption_marker, disk_util):
     """
     On success, returns None. Otherwise returns the crypt item for which decryption failed.
@@ -1565,42 +1696,28 @@ def daemon_encrypt_data_volumes(encryption_marker, encryption_config, disk_util,
         we need the special handling is because the half done device can be a error state: say, the file system header missing.so it could be 
         identified.
         """
-        ongoing_item_config = OnGoingItemConfig(encryption_environment=encryption_environment, logger=logger)
-
-        if ongoing_item_config.config_file_exists():
-            logger.log("OngoingItemConfig exists.")
-            ongoing_item_config.load_value_from_file()
-            header_file_path = ongoing_item_config.get_header_file_path()
-            mount_point = ongoing_item_config.get_mount_point()
-            status_prefix = "Resuming encryption after reboot"
-            if not none_or_empty(mount_point):
-                logger.log("mount point is not empty {0}, trying to unmount it first.".format(mount_point))
-                umount_status_code = disk_util.umount(mount_point)
-                logger.log("unmount return code is {0}".format(umount_status_code))
-            if none_or_empty(header_file_path):
-                encryption_result_phase = encrypt_inplace_without_seperate_header_file(passphrase_file=bek_passphrase_file,
-                                                                                       device_item=None,
-                                                                                       disk_util=disk_util,
-                                                                                       bek_util=bek_util,
-                                                                                       status_prefix=status_prefix,
-                                                                                       ongoing_item_config=ongoing_item_config)
-                #TODO mount it back when shrink failed
-            else:
-                encryption_result_phase = encrypt_inplace_with_seperate_header_file(passphrase_file=bek_passphrase_file,
-                                                                                    device_item=None,
-                                                                                    disk_util=disk_util,
-                                                                                    bek_util=bek_util,
-                                                                                    status_prefix=status_prefix,
-                                                                                    ongoing_item_config=ongoing_item_config)
+        ongoing_item_configs = []
+        # the single ongoing item config of the older versions, then one per device.
+        for item_environment in [encryption_environment] + encryption_environment.get_ongoing_item_environments():
+            ongoing_item_config = OnGoingItemConfig(encryption_environment=item_environment, logger=logger)
+            if ongoing_item_config.config_file_exists():
+                ongoing_item_config.load_value_from_file()
+                ongoing_item_configs.append(ongoing_item_config)
+
+        if ongoing_item_configs:
+            logger.log("{0} OngoingItemConfig exist.".format(len(ongoing_item_configs)))
+            failed_item_configs = resume_encryption_all_in_place(ongoing_item_configs=ongoing_item_configs,
+                                                                 encryption_marker=encryption_marker,
+                                                                 disk_util=disk_util,
+                                                                 bek_util=bek_util,
+                                                                 bek_passphrase_file=bek_passphrase_file)
             """
             if the resuming failed, we should fail.
             """
-            if encryption_result_phase != CommonVariables.EncryptionPhaseDone:
-                original_dev_path = ongoing_item_config.get_original_dev_path
+            if failed_item_configs:
+                original_dev_path = failed_item_configs[0].get_original_dev_path()
                 message='EnableEncryption: resuming encryption for {0} failed'.format(original_dev_path)
                 raise Exception(message)
-            else:
-                ongoing_item_config.clear_config()
         else:
             logger.log("OngoingItemConfig does not exist")
             failed_item = None
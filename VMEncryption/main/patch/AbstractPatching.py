@@ -43,6 +43,7 @@ class AbstractPatching(object):
         self.cat_path = '/bin/cat'
         self.cryptsetup_path = '/usr/sbin/cryptsetup'
         self.dd_path = '/usr/bin/dd'
+        self.dumpe2fs_path = '/sbin/dumpe2fs'
         self.e2fsck_path = '/sbin/e2fsck'
         self.echo_path = '/usr/bin/echo'
         self.lsblk_path = '/usr/bin/lsblk'
@@ -52,6 +53,7 @@ class AbstractPatching(object):
         self.openssl_path = '/usr/bin/openssl'
         self.resize2fs_path = '/sbin/resize2fs'
         self.umount_path = '/usr/bin/umount'
+        self.xfs_db_path = '/usr/sbin/xfs_db'
 
     def install_extras(self):
         pass
\ No newline at end of file
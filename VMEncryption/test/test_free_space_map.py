@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+#
+# VMEncryption extension
+#
+# Copyright 2015 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import unittest
+
+import env
+from FreeSpaceMap import FreeSpaceMap
+
+def read_output(name):
+    with open(os.path.join(env.test_dir, name)) as F:
+        return F.read()
+
+class TestFreeSpaceMap(unittest.TestCase):
+    def test_parse_dumpe2fs(self):
+        #The superblock summary says "Free blocks: 388" before "Block size:"
+        free_space_map = FreeSpaceMap.parse_dumpe2fs(read_output("dumpe2fs_ext4"))
+        self.assertNotEqual(None, free_space_map)
+        self.assertEqual([(1367 * 1024, 293 * 1024), (1953 * 1024, 95 * 1024)],
+                         free_space_map.free_ranges)
+        self.assertEqual(388 * 1024, free_space_map.get_free_size())
+        self.assertTrue(free_space_map.is_free(1400 * 1024, 4096))
+        self.assertFalse(free_space_map.is_free(1659 * 1024, 2048))
+        self.assertFalse(free_space_map.is_free(0, 1024))
+
+    def test_parse_dumpe2fs_full_groups(self):
+        free_space_map = FreeSpaceMap.parse_dumpe2fs(read_output("dumpe2fs_ext4_full_groups"))
+        self.assertNotEqual(None, free_space_map)
+        self.assertEqual([(421 * 1024, 196 * 1024)], free_space_map.free_ranges)
+
+    def test_parse_dumpe2fs_without_block_size(self):
+        output = read_output("dumpe2fs_ext4")
+        output = "\n".join(line for line in output.splitlines() if not line.startswith("Block size:"))
+        self.assertEqual(None, FreeSpaceMap.parse_dumpe2fs(output))
+        self.assertEqual(None, FreeSpaceMap.parse_dumpe2fs(""))
+
+    def test_parse_xfs_db(self):
+        free_space_map = FreeSpaceMap.parse_xfs_db(read_output("xfs_db_geometry"),
+                                                   read_output("xfs_db_freesp"))
+        self.assertNotEqual(None, free_space_map)
+        self.assertEqual([(25 * 4096, 16359 * 4096),
+                          ((16384 + 8) * 4096, 10 * 4096),
+                          ((16384 + 100) * 4096, 16284 * 4096)],
+                         free_space_map.free_ranges)
+        self.assertEqual(32653 * 4096, free_space_map.get_free_size())
+
+    def test_parse_xfs_db_without_geometry(self):
+        self.assertEqual(None, FreeSpaceMap.parse_xfs_db("blocksize = 4096\n",
+                                                         read_output("xfs_db_freesp")))
+
+if __name__ == '__main__':
+    unittest.main()